@@ -0,0 +1,233 @@
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from models import ImageAnnotation
+from utils import save_annotation_json, load_annotation_json, annotation_stamp
+
+# 最後の変更からディスクへ書き出すまでの待ち時間（秒）
+FLUSH_DELAY = float(os.environ.get("ANNOTATION_FLUSH_DELAY", "1.0"))
+# メモリに保持するクリーンなページ数の上限（dirtyなページは書き出されるまで保持）
+MAX_CACHED_PAGES = int(os.environ.get("ANNOTATION_CACHE_PAGES", "2000"))
+
+
+class AnnotationStore:
+    """検証済みの ImageAnnotation をメモリに保持するプロセス共通のストア
+
+    編集はメモリ上のオブジェクトに直接適用し、変更のあったページだけを
+    短いデバウンスの後（またはシャットダウン時）にまとめて書き出します。
+    書き出しは utils.save_annotation_json 経由です（JSONはアトミック書き込み、
+    SQLiteは変更のあったアノテーション行のみUPSERT）。
+
+    ページの version は変更のたびに1つ増やします。外部での書き換えを読み直したときや
+    ページを置き換えたときも、それまでに渡した版番号より小さくならないようにします。
+    """
+
+    def __init__(self, flush_delay: float = FLUSH_DELAY, max_pages: int = MAX_CACHED_PAGES):
+        self.flush_delay = flush_delay
+        self.max_pages = max_pages
+        self._pages: "OrderedDict[tuple, ImageAnnotation]" = OrderedDict()
+        self._mtimes = {}  # key -> 読み込み/書き出し時の annotation_stamp
+        self._versions = {}  # key -> これまでに付けた最大の version（ページを破棄しても残す）
+        self._dirty = set()
+        # key -> None (ページ全体) または (変更されたID集合, 削除されたID集合)
+        self._changes = {}
+        self._lock = threading.RLock()
+        self._timer = None
+        self._closed = False
+        self._change_listeners = []
+        self._flush_listeners = []
+
+    def add_change_listener(self, listener):
+        """編集時に listener(anno_dir, image_id, page) を呼ぶ（ロック中に呼ばれるので軽い処理のみ）"""
+        self._change_listeners.append(listener)
+
+    def add_flush_listener(self, listener):
+        """書き出し完了時に listener(anno_dir, image_id, stamp) を呼ぶ"""
+        self._flush_listeners.append(listener)
+
+    @staticmethod
+    def _key(anno_dir: Path, image_id: str) -> tuple:
+        return (str(anno_dir), image_id)
+
+    @staticmethod
+    def _file_mtime(anno_dir: Path, image_id: str) -> Optional[int]:
+        return annotation_stamp(image_id, Path(anno_dir))
+
+    def get(self, anno_dir: Path, image_id: str) -> Optional[ImageAnnotation]:
+        """ページを取得（未ロードならJSONから読み込んで検証）。存在しなければ None"""
+        key = self._key(anno_dir, image_id)
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                # 外部でファイルが書き換えられていたら読み直す（dirtyなページはメモリが正）
+                if key in self._dirty or self._mtimes.get(key) == self._file_mtime(anno_dir, image_id):
+                    self._pages.move_to_end(key)
+                    return page
+
+            mtime = self._file_mtime(anno_dir, image_id)
+            data = load_annotation_json(image_id, Path(anno_dir))
+            if data is None:
+                self._pages.pop(key, None)
+                self._mtimes.pop(key, None)
+                return None
+
+            if page is not None and page.model_dump() == data:
+                # 内容は同じ（ジャーナルのコンパクションなど）なのでそのまま使う
+                self._mtimes[key] = mtime
+                self._pages.move_to_end(key)
+                return page
+
+            reloaded = page is not None
+            page = ImageAnnotation(**data)
+            known = self._versions.get(key, 0)
+            if known > page.version or (reloaded and known == page.version):
+                # 外部で書き換えられた内容には新しい版番号を付ける
+                page.version = known + 1
+            self._versions[key] = page.version
+            self._pages[key] = page
+            self._mtimes[key] = mtime
+            self._evict()
+            return page
+
+    def peek(self, anno_dir: Path, image_id: str) -> Optional[ImageAnnotation]:
+        """メモリ上にあるページのみを返す（ディスクは読まない）"""
+        with self._lock:
+            return self._pages.get(self._key(anno_dir, image_id))
+
+    def put(self, anno_dir: Path, image_id: str, page: ImageAnnotation):
+        """新しいページを登録して書き出し対象にする"""
+        key = self._key(anno_dir, image_id)
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            self._mark(key, None, None)
+
+    def put_saved(self, anno_dir: Path, image_id: str, page: ImageAnnotation):
+        """バックエンドに書き込み済みの内容でページを置き換える（書き出し対象にせず、版番号は page のまま）
+
+        取り消しのように、保存先が自分で記録を書いた結果を反映するときに使います。
+        """
+        key = self._key(anno_dir, image_id)
+        with self._lock:
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            self._versions[key] = max(page.version, self._versions.get(key, 0))
+            self._dirty.discard(key)
+            self._changes.pop(key, None)
+            stamp = self._file_mtime(anno_dir, image_id)
+            self._mtimes[key] = stamp
+            self._notify_changed(key, page)
+        self._notify_flushed(anno_dir, image_id, stamp)
+
+    def mark_dirty(self, anno_dir: Path, image_id: str, changed=None, removed=None):
+        """メモリ上で編集したページを書き出し対象にする
+
+        changed / removed に変更・削除したアノテーションIDを渡すと、対応するバックエンドでは
+        その行だけを書き込みます。並び順が変わる編集では省略してページ全体を書き出します。
+        """
+        key = self._key(anno_dir, image_id)
+        with self._lock:
+            if key not in self._pages:
+                raise KeyError(f"page not loaded: {image_id}")
+            self._mark(key, changed, removed)
+
+    def _mark(self, key, changed, removed):
+        page = self._pages[key]
+        page.version = max(page.version, self._versions.get(key, 0)) + 1
+        self._versions[key] = page.version
+        if changed is None and removed is None:
+            self._changes[key] = None
+        elif key not in self._dirty or self._changes.get(key) is not None:
+            prev_changed, prev_removed = self._changes.get(key) or (set(), set())
+            self._changes[key] = (
+                prev_changed | set(changed or ()),
+                prev_removed | set(removed or ()),
+            )
+        self._dirty.add(key)
+        self._notify_changed(key, page)
+        if self._closed:
+            # シャットダウン後の変更は即時書き出し
+            self._flush_keys([key])
+            return
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _notify_changed(self, key, page: ImageAnnotation):
+        for listener in self._change_listeners:
+            try:
+                listener(Path(key[0]), key[1], page)
+            except Exception as e:
+                print(f"Annotation change listener failed: {e}")
+
+    def _notify_flushed(self, anno_dir, image_id: str, stamp):
+        for listener in self._flush_listeners:
+            try:
+                listener(Path(anno_dir), image_id, stamp)
+            except Exception as e:
+                print(f"Annotation flush listener failed: {e}")
+
+    def _evict(self):
+        # 上限を超えたら古いクリーンなページから破棄
+        if len(self._pages) <= self.max_pages:
+            return
+        for key in list(self._pages.keys()):
+            if len(self._pages) <= self.max_pages:
+                break
+            if key not in self._dirty:
+                del self._pages[key]
+                self._mtimes.pop(key, None)
+
+    def flush(self):
+        """dirtyなページをすべて書き出す"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            keys = list(self._dirty)
+        self._flush_keys(keys)
+        with self._lock:
+            # 書き出しに失敗したページは次のデバウンスで再試行
+            if self._dirty and self._timer is None and not self._closed:
+                self._timer = threading.Timer(self.flush_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_keys(self, keys):
+        for key in keys:
+            with self._lock:
+                page = self._pages.get(key)
+                if page is None or key not in self._dirty:
+                    continue
+                # ロック中にスナップショットを取り、以降の編集と分離する
+                data = page.model_dump()
+                changes = self._changes.pop(key, None)
+                self._dirty.discard(key)
+            anno_dir, image_id = key
+            changed_ids, removed_ids = changes if changes is not None else (None, None)
+            try:
+                save_annotation_json(data, image_id, Path(anno_dir), changed_ids, removed_ids)
+            except Exception as e:
+                print(f"Failed to flush annotation {image_id}: {e}")
+                with self._lock:
+                    # 差分の再構成は難しいので再試行時はページ全体を書き出す
+                    self._dirty.add(key)
+                    self._changes[key] = None
+                continue
+            stamp = self._file_mtime(anno_dir, image_id)
+            with self._lock:
+                if key not in self._dirty:
+                    self._mtimes[key] = stamp
+            self._notify_flushed(anno_dir, image_id, stamp)
+        with self._lock:
+            self._evict()
+
+    def close(self):
+        """タイマーを止めて残りを書き出す（シャットダウン時）"""
+        with self._lock:
+            self._closed = True
+        self.flush()
@@ -0,0 +1,258 @@
+import json
+import os
+import re
+import tempfile
+import time
+import uuid
+import zipfile
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from models import ImageAnnotation, ImageSize
+from utils import state_path, atomic_write_text
+from id_allocator import get_allocator
+from image_catalog import get_catalog, copy_with_sha256, read_image_entry
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+ARCHIVE_EXTENSIONS = ('.zip', '.cbz')
+
+UPLOAD_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# 途中経過をセッションファイルへ保存する間隔（件数）
+CHECKPOINT_EVERY = 20
+
+CRC_CHUNK_SIZE = 1024 * 1024
+
+
+def natural_key(name: str):
+    """ページ番号順に並べるためのキー（page2 < page10）"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+
+class UploadItem:
+    """アップロード対象の1画像（通常ファイルまたはアーカイブ内のメンバー）"""
+
+    def __init__(self, key: str, name: str, ext: str, opener: Callable):
+        self.key = key        # 再開時に同じ画像だと判定するためのキー（名前・サイズ・CRC と同じ内容の何番目か）
+        self.name = name      # 結果表示用の元ファイル名
+        self.ext = ext
+        self.open = opener    # 中身を読むバイナリストリームを返す
+
+
+def collect_items(uploads) -> List[UploadItem]:
+    """UploadFile の一覧から画像を列挙する（zip / cbz はメンバーを展開せずに列挙）
+
+    アーカイブは中央ディレクトリだけを読み、各メンバーは書き込み時にストリームで読み出します。
+    キーはファイル名・サイズ・CRC-32 で決まるので、再開時は残りのファイルだけを送っても構いません。
+    1つのリクエストに同じ内容のファイルが複数あるときだけ、何番目かをキーに加えて区別します。
+    """
+    items = []
+    seen: Dict[str, int] = {}
+
+    def unique(key: str) -> str:
+        count = seen.get(key, 0)
+        seen[key] = count + 1
+        return f"{key}#{count}"
+
+    for upload in uploads:
+        filename = Path(upload.filename or "").name
+        ext = Path(filename).suffix.lower()
+        if ext in ARCHIVE_EXTENSIONS:
+            archive = zipfile.ZipFile(upload.file)
+            members = [
+                m for m in archive.infolist()
+                if not m.is_dir()
+                and Path(m.filename).suffix.lower() in IMAGE_EXTENSIONS
+                and not Path(m.filename).name.startswith(".")
+                and not m.filename.startswith("__MACOSX/")
+            ]
+            for member in sorted(members, key=lambda m: natural_key(m.filename)):
+                items.append(UploadItem(
+                    key=unique(f"{filename}!{member.filename}:{member.file_size}:{member.CRC}"),
+                    name=f"{filename}/{member.filename}",
+                    ext=Path(member.filename).suffix.lower(),
+                    opener=lambda archive=archive, member=member: archive.open(member)
+                ))
+        else:
+            size, crc = _size_and_crc32(upload.file)
+            items.append(UploadItem(
+                key=unique(f"{filename}:{size}:{crc:08x}"),
+                name=filename,
+                ext=ext,
+                opener=lambda upload=upload: _rewound(upload.file)
+            ))
+    return items
+
+
+def _size_and_crc32(fileobj):
+    """ファイル全体のサイズと CRC-32（zip のメンバーと同じ値）"""
+    fileobj.seek(0)
+    size, crc = 0, 0
+    for chunk in iter(lambda: fileobj.read(CRC_CHUNK_SIZE), b""):
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+    return size, crc
+
+
+def _rewound(fileobj):
+    fileobj.seek(0)
+    return _NonClosing(fileobj)
+
+
+class _NonClosing:
+    """with 文で閉じられないようにするラッパー（UploadFile は Starlette 側で閉じる）"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def read(self, *args):
+        return self._fileobj.read(*args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class UploadSession:
+    """再開可能な一括アップロードの進捗 (data/.state/{ディレクトリ名}.upload-{upload_id}.json)"""
+
+    def __init__(self, anno_dir: Path, upload_id: str):
+        self.upload_id = upload_id
+        self.path = state_path(anno_dir, f"upload-{upload_id}.json")
+        self.items = {}
+        self.created_at = time.time()
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.items = data.get("items", {})
+            self.created_at = data.get("created_at", self.created_at)
+
+    def save(self):
+        atomic_write_text(self.path, json.dumps({
+            "upload_id": self.upload_id,
+            "created_at": self.created_at,
+            "items": self.items,
+        }, ensure_ascii=False))
+
+    def delete(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _write_image(item: UploadItem, image_path: Path) -> dict:
+    """一時ファイルへストリームで書き込み（同時に内容ハッシュを計算）、ヘッダを確認してから rename
+
+    戻り値は画像カタログのエントリ。
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{image_path.name}.", suffix=".tmp", dir=str(image_path.parent))
+    try:
+        with os.fdopen(fd, "wb") as out, item.open() as src:
+            sha256 = copy_with_sha256(src, out)
+        # ヘッダのみを読む（画素はデコードしない）
+        try:
+            entry = read_image_entry(Path(tmp_path), sha256)
+        except Exception:
+            raise ValueError("画像として読み込めません")
+        os.replace(tmp_path, image_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    entry["filename"] = image_path.name
+    return entry
+
+
+def run_bulk_upload(img_dir: Path, anno_dir: Path, uploads, store, manifest,
+                    upload_id: Optional[str] = None) -> dict:
+    """複数画像・アーカイブを一括登録する（同期処理。スレッドプールから呼ぶ）
+
+    同じ upload_id で再送すると、完了済みの画像は飛ばし、途中だった画像には
+    前回予約した番号をそのまま使います（残りのファイルだけの再送でも構いません）。
+    """
+    if upload_id is None:
+        upload_id = uuid.uuid4().hex
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        raise ValueError("invalid upload_id")
+
+    items = collect_items(uploads)
+    session = UploadSession(anno_dir, upload_id)
+
+    # 未割り当ての画像にまとめて連番を予約し、先に記録しておく（中断後も同じ番号を使う）
+    unassigned = [item for item in items if item.key not in session.items]
+    if unassigned:
+        ids = get_allocator(img_dir, anno_dir).reserve(len(unassigned))
+        for item, image_id in zip(unassigned, ids):
+            session.items[item.key] = {"image_id": image_id, "status": "pending"}
+        session.save()
+
+    catalog = get_catalog(img_dir)
+    results = []
+    new_pages = []
+
+    def commit():
+        # 初期アノテーションをまとめて登録して1回で書き出し、その後で進捗を記録する
+        for page in new_pages:
+            store.put(anno_dir, page.image_id, page)
+        store.flush()
+        new_pages.clear()
+        session.save()
+
+    for item in items:
+        record = session.items[item.key]
+        image_id = record["image_id"]
+        if record["status"] == "done":
+            results.append({
+                "source": item.name, "status": "skipped", "image_id": image_id,
+                "image_filename": record["image_filename"], "image_size": record["image_size"],
+            })
+            continue
+
+        image_filename = f"{image_id}{item.ext}"
+        try:
+            entry = _write_image(item, img_dir / image_filename)
+        except Exception as e:
+            record["status"] = "error"
+            results.append({"source": item.name, "status": "error", "image_id": image_id, "error": str(e)})
+            continue
+
+        catalog.register(image_id, entry)
+        width, height = entry["width"], entry["height"]
+        new_pages.append(ImageAnnotation(
+            image_id=image_id,
+            image_filename=image_filename,
+            image_size=ImageSize(width=width, height=height),
+            page_summary="",
+            annotations=[]
+        ))
+        manifest.image_added(image_id, img_dir / image_filename)
+        record.update({
+            "status": "done",
+            "image_filename": image_filename,
+            "image_size": {"width": width, "height": height},
+        })
+        results.append({
+            "source": item.name, "status": "created", "image_id": image_id,
+            "image_filename": image_filename, "image_size": record["image_size"],
+        })
+        if len(new_pages) >= CHECKPOINT_EVERY:
+            commit()
+
+    commit()
+    if all(record["status"] == "done" for record in session.items.values()):
+        # 前回の分も含めてすべて登録できたら再開用の記録は不要
+        session.delete()
+
+    return {
+        "upload_id": upload_id,
+        "created": sum(1 for r in results if r["status"] == "created"),
+        "skipped": sum(1 for r in results if r["status"] == "skipped"),
+        "errors": sum(1 for r in results if r["status"] == "error"),
+        "results": results,
+    }
@@ -0,0 +1,174 @@
+"""複数人での同時作業向けの変更通知（Server-Sent Events）
+
+GET /events の接続に、アノテーションディレクトリ（管理者・ゲスト）ごとの変更を送ります。
+
+- page: 購読したページの版ごとの変更（page_sync と同じ形式。溜まりすぎたら resync）
+- list: 画像一覧の項目（アップロード・完了ステータスの変更・アノテーション数の変化）
+- reset: 送信が追いつかずイベントを捨てたので、一覧とページを取り直してほしい
+
+未送信のイベントは接続ごとに (種類, 画像ID) でまとめて溜めます。一覧の項目は最新の内容だけを残し、
+ページの変更は EVENT_MAX_PAGE_CHANGES 件を超えたら resync に置き換えるので、
+受信の遅いクライアントがいてもメモリは EVENT_MAX_PENDING 件分までしか増えません。
+"""
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable, Optional, Set
+
+from models import ImageAnnotation
+
+# 1接続あたりに溜めておく未送信イベントの上限（超えたら捨てて reset を送る）
+EVENT_MAX_PENDING = int(os.environ.get("EVENT_MAX_PENDING", "1000"))
+# 1ページ分の変更をこれ以上溜めたら、変更の代わりに resync（差分 API で取り直す）を送る
+EVENT_MAX_PAGE_CHANGES = int(os.environ.get("EVENT_MAX_PAGE_CHANGES", "50"))
+# 1つの接続で購読できるページ数
+EVENT_MAX_PAGES = int(os.environ.get("EVENT_MAX_PAGES", "16"))
+# 送るものがないときにコメント行を送る間隔（秒。プロキシのタイムアウト防止）
+EVENT_HEARTBEAT = float(os.environ.get("EVENT_HEARTBEAT", "15"))
+
+
+def list_entry(image_id: str, page: ImageAnnotation) -> dict:
+    """画像一覧（/annotations-list）の1項目と同じ形式"""
+    return {
+        "id": image_id,
+        "has_annotation": True,
+        "is_completed": page.is_completed,
+        "annotation_count": len(page.annotations),
+        "last_modified": time.time(),
+    }
+
+
+def format_event(event_type: str, data: dict) -> str:
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class Subscription:
+    """1つの接続の購読内容と未送信イベント（イベントループのスレッドからのみ操作する）"""
+
+    def __init__(self, anno_dir: Path, pages: Iterable[str], list_updates: bool):
+        self.anno_dir = str(anno_dir)
+        self.pages: Set[str] = set(pages)
+        self.list_updates = list_updates
+        self._pending: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self.resets = 0
+
+    def push_page(self, image_id: str, change: dict):
+        event = self._pending.get(("page", image_id))
+        if event is None:
+            event = {"image_id": image_id, "changes": []}
+            self._pending[("page", image_id)] = event
+        event["version"] = change["version"]
+        if "changes" in event:
+            event["changes"].append(change)
+            if len(event["changes"]) > EVENT_MAX_PAGE_CHANGES:
+                del event["changes"]
+                event["resync"] = True
+        self._notify()
+
+    def push_list(self, entry: dict):
+        # 同じ画像の古い内容は捨てて最新だけを送る
+        self._pending.pop(("list", entry["id"]), None)
+        self._pending[("list", entry["id"])] = entry
+        self._notify()
+
+    def _notify(self):
+        if len(self._pending) > EVENT_MAX_PENDING:
+            self._pending.clear()
+            self._pending[("reset", "")] = {}
+            self.resets += 1
+        self._wakeup.set()
+
+    async def next_message(self, timeout: float) -> Optional[str]:
+        """溜まっているイベントを SSE の文字列にして返す（timeout 秒待っても何もなければ None）"""
+        if not self._pending:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        pending, self._pending = self._pending, OrderedDict()
+        chunks = []
+        images = []
+        for (kind, _), data in pending.items():
+            if kind == "list":
+                images.append(data)
+            else:
+                chunks.append(format_event(kind, data))
+        if images:
+            chunks.append(format_event("list", {"images": images}))
+        return "".join(chunks)
+
+
+class EventHub:
+    """変更をそれぞれの接続に振り分ける
+
+    通知は AnnotationStore・PageChangeLog のリスナーとして任意のスレッドから呼ばれるので、
+    振り分けはイベントループに渡して行います（ストアのロック中に呼ばれるので待たない）。
+    """
+
+    def __init__(self):
+        self._subscriptions: Set[Subscription] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        """イベントループを記録する（起動時にイベントループ内で呼ぶ）"""
+        self._loop = asyncio.get_running_loop()
+
+    def subscribe(self, anno_dir: Path, pages: Iterable[str], list_updates: bool = True) -> Subscription:
+        subscription = Subscription(anno_dir, pages, list_updates)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscriptions.discard(subscription)
+
+    def _dispatch(self, callback, *args):
+        loop = self._loop
+        if loop is None or not self._subscriptions:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            callback(*args)
+            return
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # シャットダウン後（ループが閉じている）
+            pass
+
+    # --- リスナー ---
+
+    def on_page_change(self, anno_dir: Path, image_id: str, change: dict):
+        """PageChangeLog のリスナー（記録したページの版ごとの変更）"""
+        self._dispatch(self._send_page, str(anno_dir), image_id, change)
+
+    def on_page_changed(self, anno_dir: Path, image_id: str, page: ImageAnnotation):
+        """AnnotationStore の変更リスナー（一覧の項目の更新）"""
+        if self._subscriptions:
+            self._dispatch(self._send_list, str(anno_dir), list_entry(image_id, page))
+
+    def _send_page(self, anno_dir: str, image_id: str, change: dict):
+        for subscription in list(self._subscriptions):
+            if subscription.anno_dir == anno_dir and image_id in subscription.pages:
+                subscription.push_page(image_id, change)
+
+    def _send_list(self, anno_dir: str, entry: dict):
+        for subscription in list(self._subscriptions):
+            if subscription.anno_dir == anno_dir and subscription.list_updates:
+                subscription.push_list(entry)
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self._subscriptions),
+            "resets": sum(subscription.resets for subscription in self._subscriptions),
+        }
+
+
+event_hub = EventHub()
@@ -0,0 +1,130 @@
+"""HTTP の条件付きリクエスト（ETag / Last-Modified）と Range リクエストの処理
+
+starlette 0.35 の FileResponse は 304 も Range も扱わないので、画像の配信はここを通します。
+"""
+import hashlib
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+# 内容ハッシュ付きの URL（?v=）など、内容が変わらないレスポンス
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# 毎回 ETag で確認する（変わっていなければ 304）
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+RANGE_CHUNK_SIZE = 256 * 1024
+
+
+def content_etag(body: bytes) -> str:
+    """レスポンス本文から作る強い ETag"""
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """If-None-Match に etag が含まれるか（弱い比較）"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    target = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == target:
+            return True
+    return False
+
+
+def not_modified(request: Request, etag: str, mtime: Optional[float] = None) -> bool:
+    """304 を返してよいか。If-None-Match があれば If-Modified-Since より優先する"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and mtime is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def not_modified_response(etag: str, cache_control: str, mtime: Optional[float] = None) -> Response:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if mtime is not None:
+        headers["Last-Modified"] = formatdate(mtime, usegmt=True)
+    return Response(status_code=304, headers=headers)
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Range ヘッダ（bytes=単一範囲）を (先頭, 末尾) に変換する
+
+    解釈できない・複数範囲の場合は None（全体を返す）。満たせない範囲は ValueError
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    first, last = first.strip(), last.strip()
+    if not sep or not (first.isdigit() or first == "") or not (last.isdigit() or last == "") or first == last == "":
+        return None
+    if first == "":
+        # 末尾から last バイト
+        length = int(last)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        raise ValueError("unsatisfiable range")
+    return start, min(end, size - 1)
+
+
+def _iter_file(path: Path, start: int, end: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def cached_file_response(request: Request, path: Path, etag: str, cache_control: str,
+                         media_type: Optional[str] = None) -> Response:
+    """ETag・Last-Modified・Cache-Control 付きでファイルを返す（条件付きなら 304、Range なら 206）"""
+    st = os.stat(path)
+    if not_modified(request, etag, st.st_mtime):
+        return not_modified_response(etag, cache_control, st.st_mtime)
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range が現在の ETag・更新日時と一致しなければ全体を返す
+    if range_header and (if_range is None or if_range in (etag, headers["Last-Modified"])):
+        try:
+            byte_range = parse_range(range_header, st.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{st.st_size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(_iter_file(path, start, end), status_code=206, headers=headers,
+                                     media_type=media_type)
+    return FileResponse(str(path), headers=headers, media_type=media_type, stat_result=st)
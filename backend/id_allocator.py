@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List
+
+from utils import state_path, atomic_write_text
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock_fd(fd):
+        # msvcrt.locking は先頭1バイトのロック。取れるまで再試行する
+        while True:
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+
+    def _unlock_fd(fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock_fd(fd):
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def _unlock_fd(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def scan_max_number(img_dir: Path, anno_dir: Path) -> int:
+    """画像・アノテーションの既存ファイル名から最大の番号を求める（初回のシードのみで使用）"""
+    from storage import get_storage
+
+    numbers = [0]
+    if img_dir.exists():
+        for file in img_dir.iterdir():
+            if file.suffix.lower() in IMAGE_EXTENSIONS and file.stem.isdigit():
+                numbers.append(int(file.stem))
+    for image_id in get_storage(anno_dir).page_ids():
+        if image_id.isdigit():
+            numbers.append(int(image_id))
+    return max(numbers)
+
+
+class ImageIdAllocator:
+    """画像番号（5桁の連番）の採番器
+
+    次の番号を data/.state/{アノテーションディレクトリ名}.next_id に保存し、
+    ファイルロックで排他するので複数の uvicorn ワーカーから呼ばれても重複しません。
+    カウンタが無いときだけ既存ファイルをスキャンして初期値を決めます。
+    """
+
+    def __init__(self, img_dir: Path, anno_dir: Path):
+        self.img_dir = Path(img_dir)
+        self.anno_dir = Path(anno_dir)
+        self.counter_path = state_path(self.anno_dir, "next_id")
+        self.lock_path = state_path(self.anno_dir, "next_id.lock")
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            fd = os.open(str(self.lock_path), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                _lock_fd(fd)
+                try:
+                    yield
+                finally:
+                    _unlock_fd(fd)
+            finally:
+                os.close(fd)
+
+    def _read_next(self) -> int:
+        try:
+            with open(self.counter_path, 'r', encoding='utf-8') as f:
+                return int(json.load(f)["next"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return scan_max_number(self.img_dir, self.anno_dir) + 1
+
+    def _is_taken(self, number: int) -> bool:
+        # 手作業でコピーされたファイルと衝突しないよう、採番する番号だけを確認する
+        from storage import get_storage
+
+        stem = f"{number:05d}"
+        if get_storage(self.anno_dir).stamp(stem) is not None:
+            return True
+        return any((self.img_dir / f"{stem}{ext}").exists() for ext in IMAGE_EXTENSIONS)
+
+    def _next_free(self, number: int) -> int:
+        while self._is_taken(number):
+            number += 1
+        return number
+
+    def peek(self) -> str:
+        """次に割り当てられる番号（予約はしない）"""
+        with self._locked():
+            return f"{self._next_free(self._read_next()):05d}"
+
+    def reserve(self, count: int = 1) -> List[str]:
+        """連続した count 個の番号を予約して返す"""
+        if count < 1:
+            raise ValueError("count must be >= 1")
+        with self._locked():
+            start = self._next_free(self._read_next())
+            # 範囲内に既存ファイルがあれば、その後ろから取り直す
+            taken = next((n for n in range(start + 1, start + count) if self._is_taken(n)), None)
+            while taken is not None:
+                start = self._next_free(taken + 1)
+                taken = next((n for n in range(start + 1, start + count) if self._is_taken(n)), None)
+            atomic_write_text(self.counter_path, json.dumps({"next": start + count}))
+        return [f"{n:05d}" for n in range(start, start + count)]
+
+    def allocate(self) -> str:
+        """番号を1つ予約して返す"""
+        return self.reserve(1)[0]
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def get_allocator(img_dir: Path, anno_dir: Path) -> ImageIdAllocator:
+    key = str(Path(anno_dir))
+    with _allocators_lock:
+        allocator = _allocators.get(key)
+        if allocator is None:
+            allocator = ImageIdAllocator(img_dir, anno_dir)
+            _allocators[key] = allocator
+        return allocator
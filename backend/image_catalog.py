@@ -0,0 +1,297 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from PIL import Image
+
+from utils import state_path, atomic_write_text
+
+# 同じ番号の画像が複数の拡張子で存在する場合の優先順（従来の探索順と同じ）
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# バックグラウンドでディレクトリを再スキャンする間隔（秒）
+IMAGE_CATALOG_RESCAN_INTERVAL = float(os.environ.get("IMAGE_CATALOG_RESCAN_INTERVAL", "60"))
+# 永続化ファイルへの書き出し待ち時間（秒）
+IMAGE_CATALOG_SAVE_DELAY = float(os.environ.get("IMAGE_CATALOG_SAVE_DELAY", "5.0"))
+
+CATALOG_VERSION = 1
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path: Path) -> str:
+    """ファイル内容の SHA-256（16進）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_with_sha256(src, dst) -> str:
+    """src から dst へストリームでコピーしながら SHA-256 を計算する"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+        dst.write(chunk)
+    return digest.hexdigest()
+
+
+def read_image_entry(path: Path, sha256: Optional[str] = None) -> dict:
+    """ヘッダだけを読んでカタログのエントリを作る（画素はデコードしない）"""
+    st = path.stat()
+    with Image.open(path) as img:
+        width, height = img.size
+        fmt = img.format
+    return {
+        "filename": path.name,
+        "format": fmt,
+        "width": width,
+        "height": height,
+        "bytes": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": sha256,
+    }
+
+
+def _ext_priority(filename: str) -> int:
+    return IMAGE_EXTENSIONS.index(os.path.splitext(filename)[1].lower())
+
+
+class ImageCatalog:
+    """画像ディレクトリのメタデータ索引
+
+    image_id ごとに filename / format / width / height / bytes / mtime_ns / sha256 を保持し、
+    data/.state/{画像ディレクトリ名}.catalog.json に永続化します。
+    アップロード時に登録し、外部でのファイル追加・削除はバックグラウンドの再スキャンで取り込みます。
+    内容ハッシュは再スキャン時（アップロード時は書き込みと同時）に計算します。
+    """
+
+    def __init__(self, img_dir: Path):
+        self.img_dir = Path(img_dir)
+        self.path = state_path(self.img_dir, "catalog.json")
+        self._lock = threading.RLock()
+        self._entries: Dict[str, dict] = {}
+        self._dir_token = None
+        self._save_timer = None
+        self._load()
+
+    # --- 永続化 ---
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") != CATALOG_VERSION:
+                return
+            self._entries = data["images"]
+            self._dir_token = data.get("dir_token")
+        except Exception as e:
+            print(f"Image catalog load failed, rebuilding: {e}")
+            self._entries = {}
+
+    def _schedule_save(self):
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(IMAGE_CATALOG_SAVE_DELAY, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def save(self):
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            text = json.dumps({
+                "version": CATALOG_VERSION,
+                "dir_token": self._dir_token,
+                "images": self._entries,
+            }, ensure_ascii=False)
+        try:
+            atomic_write_text(self.path, text)
+        except Exception as e:
+            print(f"Image catalog save failed: {e}")
+
+    # --- 参照 ---
+
+    def get(self, image_id: str, rescan: bool = True) -> Optional[dict]:
+        """画像のメタデータ。未登録ならディレクトリが変わっているときだけ取り込み直す
+
+        rescan=False なら登録済みのものだけを返し、ディレクトリは走査しない（イベントループから呼ぶとき）。
+        """
+        with self._lock:
+            entry = self._entries.get(image_id)
+            if entry is not None:
+                return dict(entry)
+        if rescan and self._dir_changed():
+            self.rescan()
+            with self._lock:
+                entry = self._entries.get(image_id)
+                if entry is not None:
+                    return dict(entry)
+        return None
+
+    def image_path(self, image_id: str) -> Optional[Path]:
+        entry = self.get(image_id)
+        if entry is None:
+            return None
+        return self.img_dir / entry["filename"]
+
+    def content_hash(self, image_id: str) -> Optional[str]:
+        """内容の SHA-256。まだ計算していなければここで計算する"""
+        entry = self.get(image_id)
+        if entry is None:
+            return None
+        if entry["sha256"] is None:
+            return self._hash_entry(image_id, entry)
+        return entry["sha256"]
+
+    # --- 更新 ---
+
+    def add(self, image_id: str, image_path: Path, sha256: Optional[str] = None) -> dict:
+        """アップロードされた画像を登録（sha256 を渡さなければ後で計算）"""
+        return self.register(image_id, read_image_entry(Path(image_path), sha256))
+
+    def register(self, image_id: str, entry: dict) -> dict:
+        """read_image_entry で作成済みのエントリを登録"""
+        with self._lock:
+            in_sync = self._dir_token is not None
+            self._entries[image_id] = entry
+            if in_sync:
+                self._dir_token = self._current_dir_token()
+            self._schedule_save()
+        return dict(entry)
+
+    def discard(self, image_id: str):
+        """ファイルが見つからなかった画像を索引から外す"""
+        with self._lock:
+            if self._entries.pop(image_id, None) is not None:
+                self._schedule_save()
+
+    def _current_dir_token(self):
+        try:
+            return self.img_dir.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def _dir_changed(self) -> bool:
+        with self._lock:
+            return self._current_dir_token() != self._dir_token
+
+    def rescan(self, compute_hashes: bool = False):
+        """ディレクトリを走査し、追加・変更・削除されたファイルだけを反映する"""
+        token = self._current_dir_token()
+        found: Dict[str, os.DirEntry] = {}
+        if self.img_dir.exists():
+            with os.scandir(self.img_dir) as it:
+                for entry in it:
+                    stem, ext = os.path.splitext(entry.name)
+                    if ext.lower() not in IMAGE_EXTENSIONS or entry.name.startswith("."):
+                        continue
+                    other = found.get(stem)
+                    if other is None or _ext_priority(entry.name) < _ext_priority(other.name):
+                        found[stem] = entry
+
+        with self._lock:
+            current = dict(self._entries)
+
+        entries = {}
+        changed = set(current) != set(found)
+        for image_id, dir_entry in found.items():
+            old = current.get(image_id)
+            try:
+                st = dir_entry.stat()
+                if (old is not None and old["filename"] == dir_entry.name
+                        and old["bytes"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns):
+                    entries[image_id] = old
+                    continue
+                entries[image_id] = read_image_entry(Path(dir_entry.path))
+                changed = True
+            except Exception as e:
+                print(f"Image catalog: skipping {dir_entry.name}: {e}")
+
+        with self._lock:
+            # 走査中にアップロードされた画像は残す
+            for image_id, entry in self._entries.items():
+                if image_id not in current and image_id not in entries:
+                    entries[image_id] = entry
+            self._entries = entries
+            self._dir_token = token
+            if changed:
+                self._schedule_save()
+
+        if compute_hashes:
+            for image_id, entry in list(entries.items()):
+                if entry["sha256"] is None:
+                    self._hash_entry(image_id, entry)
+
+    def _hash_entry(self, image_id: str, entry: dict) -> Optional[str]:
+        path = self.img_dir / entry["filename"]
+        try:
+            sha256 = file_sha256(path)
+            st = path.stat()
+        except OSError:
+            return None
+        with self._lock:
+            current = self._entries.get(image_id)
+            # 計算中に書き換えられていなければ記録する
+            if (current is not None and current["filename"] == entry["filename"]
+                    and current["mtime_ns"] == st.st_mtime_ns and current["bytes"] == st.st_size):
+                current["sha256"] = sha256
+                self._schedule_save()
+        return sha256
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+_rescan_stop = threading.Event()
+_rescan_thread = None
+
+
+def get_catalog(img_dir: Path) -> ImageCatalog:
+    """画像ディレクトリごとのカタログを返す"""
+    key = str(Path(img_dir))
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = ImageCatalog(img_dir)
+            _catalogs[key] = catalog
+        return catalog
+
+
+def _rescan_loop():
+    while True:
+        with _catalogs_lock:
+            catalogs = list(_catalogs.values())
+        for catalog in catalogs:
+            try:
+                catalog.rescan(compute_hashes=True)
+            except Exception as e:
+                print(f"Image catalog rescan failed: {e}")
+        if _rescan_stop.wait(IMAGE_CATALOG_RESCAN_INTERVAL):
+            return
+
+
+def start_background_rescan():
+    """すべてのカタログを定期的に再スキャンするスレッドを開始（起動時）"""
+    global _rescan_thread
+    if _rescan_thread is not None:
+        return
+    _rescan_stop.clear()
+    _rescan_thread = threading.Thread(target=_rescan_loop, name="image-catalog-rescan", daemon=True)
+    _rescan_thread.start()
+
+
+def stop_background_rescan():
+    """再スキャンを止めてカタログを書き出す（シャットダウン時）"""
+    global _rescan_thread
+    _rescan_stop.set()
+    _rescan_thread = None
+    with _catalogs_lock:
+        catalogs = list(_catalogs.values())
+    for catalog in catalogs:
+        catalog.save()
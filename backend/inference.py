@@ -0,0 +1,451 @@
+import asyncio
+import csv
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from PIL import Image
+
+from tagger_registry import tagger_registry
+from tag_filter import TagTable, get_tag_table
+
+# 推論を実行するエグゼキュータ: "thread"（既定）または "process"（ワーカーごとにモデルを事前ロード）
+INFERENCE_EXECUTOR = os.environ.get("INFERENCE_EXECUTOR", "thread")
+# 同時に実行する推論の数（torch は1回の推論で複数コアを使うので既定は1）
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))
+# 1回の推論のタイムアウト（秒）
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", "120"))
+# クライアントの切断を確認する間隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.5
+# タグ付けをまとめて推論するバッチの最大サイズ
+TAGGER_MAX_BATCH = int(os.environ.get("TAGGER_MAX_BATCH", "8"))
+# バッチが揃うのを待つ最大時間（ミリ秒）
+TAGGER_BATCH_WAIT_MS = float(os.environ.get("TAGGER_BATCH_WAIT_MS", "5"))
+# OCR をまとめて推論するバッチの最大サイズ（ページ単位の OCR もこの件数ずつ forward する）
+OCR_MAX_BATCH = int(os.environ.get("OCR_MAX_BATCH", "8"))
+OCR_BATCH_WAIT_MS = float(os.environ.get("OCR_BATCH_WAIT_MS", "5"))
+# 1 にすると起動後にバックグラウンドで OCR・タグ付けモデルを読み込み、1回推論しておく
+INFERENCE_WARMUP = os.environ.get("INFERENCE_WARMUP", "0") == "1"
+
+
+class InferenceTimeout(Exception):
+    """推論がタイムアウトした"""
+
+
+class ClientDisconnected(Exception):
+    """推論の完了前にクライアントが切断した"""
+
+
+# --- モデル ---
+
+# manga-ocr の遅延初期化用
+_mocr = None
+_mocr_lock = threading.Lock()
+
+
+def get_mocr():
+    global _mocr
+    with _mocr_lock:
+        if _mocr is None:
+            print("Initializing Manga-OCR...")
+            # torch・transformers を読み込むので、サーバ起動時ではなく最初に使うときに import する
+            from manga_ocr import MangaOcr
+            _mocr = MangaOcr()
+            print("Manga-OCR initialized.")
+        return _mocr
+
+
+def get_tagger(model_id: str):
+    """PyTorch 版の WD Tagger (model, transform)。読み込み済みのモデルは tagger_registry で管理する"""
+    return tagger_registry.get((model_id, ("torch",)), lambda: _load_torch_tagger(model_id))
+
+
+def _load_torch_tagger(model_id: str):
+    print(f"Initializing WD Tagger with model: {model_id}...")
+    import timm
+    from timm.data import resolve_data_config, create_transform
+    import torch
+
+    model = timm.create_model(f"hf_hub:{model_id}", pretrained=True)
+    model.eval()
+
+    # GPU利用可能ならGPUへ
+    if torch.cuda.is_available():
+        model = model.cuda()
+        print("WD Tagger: Using CUDA")
+    else:
+        print("WD Tagger: Using CPU")
+
+    # 前処理用transform
+    config = resolve_data_config(model.pretrained_cfg)
+    transform = create_transform(**config)
+
+    nbytes = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    print(f"WD Tagger initialized ({nbytes / 1e6:.0f}MB).")
+    return (model, transform), nbytes
+
+
+_label_cache = {}
+
+
+def load_tagger_labels(model_id: str):
+    """タグラベル (labels, categories, orig_labels) を読み込む（モデル本体は読み込まない）"""
+    cached = _label_cache.get(model_id)
+    if cached is not None:
+        return cached
+
+    # ラベルファイル取得 (ローカルの日本語版があれば優先)
+    local_label_path = Path(__file__).parent / "selected_tags_ja.csv"
+
+    orig_labels = None
+
+    if local_label_path.exists():
+        print(f"Loading local Japanese tag labels from {local_label_path}")
+        with open(local_label_path, "r", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            rows = list(reader)
+            labels = [row["name"] for row in rows]
+            categories = [int(row.get("category", 0)) for row in rows]
+            # 日本語版には original_en カラムがある前提
+            if "original_en" in rows[0]:
+                orig_labels = [row["original_en"] for row in rows]
+    else:
+        from huggingface_hub import hf_hub_download
+
+        label_path = hf_hub_download(repo_id=model_id, filename="selected_tags.csv")
+        with open(label_path, "r", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            rows = list(reader)
+            labels = [row["name"] for row in rows]
+            categories = [int(row.get("category", 0)) for row in rows]
+
+    _label_cache[model_id] = (labels, categories, orig_labels)
+    return _label_cache[model_id]
+
+
+def load_tag_table(model_id: str, excluded_tags=()) -> TagTable:
+    """モデルのラベルと除外タグ設定からコンパイルしたタグ選別表（キャッシュ済みならそれを返す）"""
+    labels, categories, orig_labels = load_tagger_labels(model_id)
+    return get_tag_table(model_id, labels, categories, orig_labels, excluded_tags)
+
+
+# 前処理・後処理を変えたら上げる（結果キャッシュのキーに含まれる）
+# 2: 切り抜きを縮小デコード・エンジンの入力解像度への縮小に変更
+OCR_PREPROCESS_VERSION = 2
+TAGGER_PREPROCESS_VERSION = 2
+
+# 各エンジンが実際に使う入力解像度（切り抜きはこの短辺まで縮小してから渡す）
+# Manga-OCR のエンコーダは 224x224、WD Tagger v3 は 448x448
+OCR_INPUT_SIZE = 224
+TAGGER_INPUT_SIZE = 448
+
+
+# --- 推論タスク（プロセスプールでも実行できるようモジュール直下の関数にする） ---
+
+def ocr_batch_task(crop_imgs: list) -> List[str]:
+    """複数の切り抜き画像を OCR_MAX_BATCH 件ずつまとめて Manga-OCR のエンコーダ・デコーダにかける
+
+    MangaOcr.__call__ と同じ前処理・後処理をバッチで行います。
+    内部構造が想定と違う版の manga-ocr では1枚ずつ処理します。
+    """
+    mocr = get_mocr()
+    processor = getattr(mocr, "processor", None) or getattr(mocr, "feature_extractor", None)
+    if processor is None or not hasattr(mocr, "model") or not hasattr(mocr, "tokenizer"):
+        return [mocr(img) for img in crop_imgs]
+
+    import torch
+    from manga_ocr.ocr import post_process
+
+    texts = []
+    for i in range(0, len(crop_imgs), max(1, OCR_MAX_BATCH)):
+        chunk = [img.convert("L").convert("RGB") for img in crop_imgs[i:i + OCR_MAX_BATCH]]
+        pixel_values = processor(chunk, return_tensors="pt").pixel_values
+        with torch.no_grad():
+            outputs = mocr.model.generate(pixel_values.to(mocr.model.device), max_length=300).cpu()
+        for ids in outputs:
+            texts.append(post_process(mocr.tokenizer.decode(ids, skip_special_tokens=True)))
+    return texts
+
+
+def tagger_backend_spec(settings: dict) -> tuple:
+    """TAGGER_SETTINGS から推論バックエンドの指定を作る（バッチのキーになるので tuple）
+
+    ("torch",) または ("onnxruntime", 量子化モデルを使うか, intra_op スレッド数, inter_op スレッド数)
+    """
+    if settings.get("tagger_backend", "torch") == "onnxruntime":
+        return (
+            "onnxruntime",
+            bool(settings.get("onnx_quantized", False)),
+            int(settings.get("onnx_intra_op_threads", 0)),
+            int(settings.get("onnx_inter_op_threads", 0)),
+        )
+    return ("torch",)
+
+
+def get_onnx_tagger(model_id: str, backend: tuple):
+    """ONNX Runtime 版の WD Tagger（torch は import しない）"""
+    return tagger_registry.get((model_id, tuple(backend)), lambda: _load_onnx_tagger(model_id, backend))
+
+
+def _load_onnx_tagger(model_id: str, backend: tuple):
+    from onnx_tagger import OnnxTagger
+
+    _, quantized, intra, inter = backend
+    print(f"Initializing WD Tagger (onnxruntime{', int8' if quantized else ''}) with model: {model_id}...")
+    tagger = OnnxTagger(model_id, quantized=quantized, intra_op_threads=intra, inter_op_threads=inter)
+    # セッションの重みはモデルファイルとほぼ同じ大きさ
+    nbytes = tagger.path.stat().st_size
+    print(f"WD Tagger (onnxruntime) initialized ({nbytes / 1e6:.0f}MB).")
+    return tagger, nbytes
+
+
+def tagger_batch_task(model_id: str, backend: tuple, crop_imgs: list):
+    """複数の切り抜き画像を1回の forward で WD Tagger にかけ、確率（numpy 配列 [N, ラベル数]）を返す"""
+    if backend[0] == "onnxruntime":
+        return get_onnx_tagger(model_id, backend)(crop_imgs)
+
+    import torch
+
+    model, transform = get_tagger(model_id)
+
+    # 前処理（transform は固定サイズにリサイズするのでそのまま stack できる）
+    input_tensor = torch.stack([transform(img) for img in crop_imgs])
+    if torch.cuda.is_available():
+        input_tensor = input_tensor.cuda()
+
+    # 推論
+    with torch.no_grad():
+        outputs = model(input_tensor)
+        return torch.sigmoid(outputs).cpu().numpy()
+
+
+def tagger_models_task() -> dict:
+    """このプロセスで読み込み済みの WD Tagger モデルとメモリ使用量"""
+    return tagger_registry.stats()
+
+
+def unload_tagger_task(model_id: Optional[str] = None) -> int:
+    """読み込み済みの WD Tagger モデルを捨てて解放する"""
+    return tagger_registry.unload(model_id)
+
+
+def _init_worker(preload_ocr: bool, tagger_model_id: Optional[str], tagger_backend: tuple = ("torch",)):
+    """プロセスプールのワーカー起動時にモデルを読み込んでおく
+
+    失敗してもワーカーは止めない（最初の推論時に改めて読み込む）。
+    """
+    try:
+        if preload_ocr:
+            get_mocr()
+        if tagger_model_id and tagger_backend[0] == "onnxruntime":
+            get_onnx_tagger(tagger_model_id, tagger_backend)
+        elif tagger_model_id:
+            get_tagger(tagger_model_id)
+    except Exception as e:
+        print(f"Inference worker: model preload failed: {e}")
+
+
+# --- エグゼキュータ ---
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def configure_executor(tagger_model_id: Optional[str] = None, tagger_backend: tuple = ("torch",)):
+    """推論用エグゼキュータを作成（起動時）。process の場合は各ワーカーでモデルを事前ロード"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            return _executor
+        if INFERENCE_EXECUTOR == "process":
+            # torch は fork 後に不安定になることがあるので spawn を使う
+            _executor = ProcessPoolExecutor(
+                max_workers=INFERENCE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(True, tagger_model_id, tagger_backend),
+            )
+            print(f"Inference: process pool with {INFERENCE_WORKERS} worker(s)")
+        else:
+            _executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+        return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+async def wait_for_result(waiter, request=None, timeout: Optional[float] = INFERENCE_TIMEOUT):
+    """asyncio の Future を待つ。timeout で InferenceTimeout、クライアント切断で ClientDisconnected"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout else None
+    while True:
+        wait_for = DISCONNECT_POLL_INTERVAL if request is not None else None
+        if deadline is not None:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise InferenceTimeout()
+            wait_for = remaining if wait_for is None else min(wait_for, remaining)
+        done, _ = await asyncio.wait({waiter}, timeout=wait_for)
+        if done:
+            return waiter.result()
+        if request is not None and await request.is_disconnected():
+            raise ClientDisconnected()
+
+
+async def run_inference(fn, *args, request=None, timeout: Optional[float] = INFERENCE_TIMEOUT):
+    """推論をイベントループの外（推論用エグゼキュータ）で実行して結果を待つ
+
+    timeout を過ぎると InferenceTimeout、request のクライアントが切断すると ClientDisconnected。
+    どちらの場合も未着手のタスクは取り消します（実行中の推論は完了を待たずに結果を捨てます）。
+    """
+    future = configure_executor().submit(fn, *args)
+    try:
+        result = await wait_for_result(asyncio.wrap_future(future), request, timeout)
+    except BaseException:
+        # タイムアウト・切断・リクエスト自体のキャンセル時は未着手なら取り消す
+        future.cancel()
+        raise
+    _record_ready(fn, args)
+    return result
+
+
+# --- 準備状況 ---
+
+# エンジンごとの状態: cold（未読み込み）/ loading（ウォームアップ中）/ ready / failed
+_ocr_state = {"status": "cold", "error": None}
+_tagger_states = {}  # (model_id, バックエンド指定) -> 状態
+_warmup_task = None
+
+
+def _record_ready(fn, args):
+    """推論が1回成功したエンジンを ready にする（ウォームアップ以外の推論でも温まる）"""
+    if fn is ocr_batch_task:
+        _ocr_state.update(status="ready", error=None)
+    elif fn is tagger_batch_task:
+        _tagger_states[(args[0], tuple(args[1]))] = {"status": "ready", "error": None}
+
+
+def engine_status(tagger_model_id: str, tagger_backend: tuple) -> dict:
+    """OCR と（指定のモデルの）タグ付けの準備状況"""
+    tagger = _tagger_states.get((tagger_model_id, tuple(tagger_backend)), {"status": "cold", "error": None})
+    return {
+        "ocr": dict(_ocr_state),
+        "tagger": {"model_id": tagger_model_id, "backend": list(tagger_backend), **tagger},
+    }
+
+
+async def warm_up(tagger_model_id: Optional[str], tagger_backend: tuple = ("torch",), ocr: bool = True):
+    """モデルを読み込み、白紙の画像で1回推論して初回リクエストの遅さをなくす"""
+    blank = Image.new("RGB", (64, 64), (255, 255, 255))
+    if ocr and _ocr_state["status"] != "ready":
+        _ocr_state.update(status="loading", error=None)
+        try:
+            await run_inference(ocr_batch_task, [blank], timeout=None)
+            print("Warm-up: Manga-OCR ready")
+        except Exception as e:
+            print(f"Warm-up: Manga-OCR failed: {e}")
+            _ocr_state.update(status="failed", error=str(e))
+    if tagger_model_id:
+        key = (tagger_model_id, tuple(tagger_backend))
+        if _tagger_states.get(key, {}).get("status") == "ready":
+            return
+        _tagger_states[key] = {"status": "loading", "error": None}
+        try:
+            await run_inference(tagger_batch_task, tagger_model_id, tagger_backend, [blank], timeout=None)
+            print(f"Warm-up: WD Tagger {tagger_model_id} ready")
+        except Exception as e:
+            print(f"Warm-up: WD Tagger {tagger_model_id} failed: {e}")
+            _tagger_states[key] = {"status": "failed", "error": str(e)}
+
+
+def start_warmup(tagger_model_id: Optional[str], tagger_backend: tuple = ("torch",), ocr: bool = True):
+    """warm_up をバックグラウンドで開始する（イベントループ内で呼ぶ）"""
+    global _warmup_task
+    _warmup_task = asyncio.ensure_future(warm_up(tagger_model_id, tagger_backend, ocr))
+    return _warmup_task
+
+
+class MicroBatcher:
+    """推論リクエストを短時間ためて1回の forward にまとめるスケジューラ
+
+    最初のリクエストから wait_ms 待つか max_batch 件たまった時点で、キー（モデルIDなど）ごとに
+    task(*key, [入力, ...]) をエグゼキュータへ投げ、各呼び出し元に自分の分の結果を返します。
+    閾値やタイプによるフィルタは呼び出し元ごとに行うので、ここでは生の出力だけを扱います。
+    """
+
+    def __init__(self, task, max_batch: int, wait_ms: float):
+        self.task = task
+        self.max_batch = max(1, max_batch)
+        self.wait = wait_ms / 1000.0
+        self._pending = []  # (key, 入力, asyncio.Future)
+        self._handle = None
+        self.batches = 0
+        self.items = 0
+
+    async def infer(self, value, *key, request=None, timeout: Optional[float] = INFERENCE_TIMEOUT):
+        """1件分の結果を返す（key は task の先頭引数。同じ key のものだけがまとめられる）"""
+        loop = asyncio.get_running_loop()
+        item = (key, value, loop.create_future())
+        self._pending.append(item)
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._handle is None:
+            self._handle = loop.call_later(self.wait, self._flush)
+        try:
+            return await wait_for_result(item[2], request, timeout)
+        except BaseException:
+            # まだバッチに入っていなければ取り除き、入っていれば結果を捨てる
+            if item in self._pending:
+                self._pending.remove(item)
+            item[2].cancel()
+            raise
+
+    def _flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        pending, self._pending = self._pending, []
+        groups = {}
+        for item in pending:
+            groups.setdefault(item[0], []).append(item)
+        for key, items in groups.items():
+            for i in range(0, len(items), self.max_batch):
+                asyncio.ensure_future(self._run(key, items[i:i + self.max_batch]))
+
+    async def _run(self, key: tuple, items: list):
+        items = [item for item in items if not item[2].done()]
+        if not items:
+            return
+        self.batches += 1
+        self.items += len(items)
+        try:
+            results = await run_inference(self.task, *key, [item[1] for item in items])
+        except Exception as e:
+            for item in items:
+                if not item[2].done():
+                    item[2].set_exception(e)
+            return
+        for item, row in zip(items, results):
+            if not item[2].done():
+                item[2].set_result(row)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "wait_ms": self.wait * 1000.0,
+        }
+
+
+tagger_batcher = MicroBatcher(tagger_batch_task, TAGGER_MAX_BATCH, TAGGER_BATCH_WAIT_MS)
+ocr_batcher = MicroBatcher(ocr_batch_task, OCR_MAX_BATCH, OCR_BATCH_WAIT_MS)
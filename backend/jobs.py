@@ -0,0 +1,348 @@
+import asyncio
+import json
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from models import TEXT_ANNOTATION_TYPES
+from utils import state_path, atomic_write_text
+from storage import get_storage
+from manifest import id_sort_key
+from inference import (
+    run_inference, ocr_batch_task, tagger_batch_task, load_tag_table, OCR_INPUT_SIZE, TAGGER_INPUT_SIZE
+)
+
+JOB_KINDS = ("tagger", "ocr")
+
+# kind ごとの既定の対象タイプ
+DEFAULT_JOB_TYPES = {
+    "tagger": ["person", "face"],
+    "ocr": TEXT_ANNOTATION_TYPES,
+}
+
+DEFAULT_BATCH_SIZE = 16
+
+JOB_FILE_PATTERN = re.compile(r"\.job-([0-9a-f]{32})\.json$")
+
+
+class Job:
+    """1件のバックグラウンドジョブ（data/.state/{アノテーションディレクトリ名}.job-{id}.json に保存）
+
+    state の image_ids と page_index がチェックポイントで、ページを1つ処理し終えるごとに保存します。
+    再起動後は page_index のページからやり直します。
+    """
+
+    def __init__(self, state: dict):
+        self.state = state
+        self.cancel_requested = False
+        self._run_started = None     # 今回の実行を開始した時刻（スループット計算用）
+        self._run_processed = 0      # 今回の実行開始時点の processed
+
+    @property
+    def id(self) -> str:
+        return self.state["id"]
+
+    @property
+    def anno_dir(self) -> Path:
+        return Path(self.state["anno_dir"])
+
+    @property
+    def img_dir(self) -> Path:
+        return Path(self.state["img_dir"])
+
+    @property
+    def path(self) -> Path:
+        return state_path(self.anno_dir, f"job-{self.id}.json")
+
+    def save(self):
+        self.state["updated_at"] = time.time()
+        atomic_write_text(self.path, json.dumps(self.state, ensure_ascii=False))
+
+    def to_dict(self) -> dict:
+        """API 用の状態（進捗・スループット・ETA を含む）"""
+        s = self.state
+        throughput = None
+        eta = None
+        if s["status"] == "running" and self._run_started is not None:
+            elapsed = time.time() - self._run_started
+            done = s["processed"] - self._run_processed
+            if elapsed > 0 and done > 0:
+                throughput = done / elapsed
+                if s["total"] is not None:
+                    eta = max(0, s["total"] - s["processed"]) / throughput
+        progress = None
+        if s["total"]:
+            progress = min(1.0, s["processed"] / s["total"])
+        elif s["total"] == 0:
+            progress = 1.0
+        return {
+            "id": s["id"],
+            "kind": s["kind"],
+            "status": s["status"],
+            "params": s["params"],
+            "total": s["total"],
+            "processed": s["processed"],
+            "written": s["written"],
+            "errors": s["errors"],
+            "last_error": s["last_error"],
+            "pages_done": s["page_index"],
+            "pages_total": len(s["image_ids"]) if s["image_ids"] is not None else None,
+            "progress": progress,
+            "boxes_per_sec": throughput,
+            "eta_sec": eta,
+            "created_at": s["created_at"],
+            "started_at": s["started_at"],
+            "finished_at": s["finished_at"],
+        }
+
+
+class JobManager:
+    """自動タグ付け・自動OCRのジョブキュー
+
+    ジョブは1件ずつ順番に実行します。推論は対話用の /ocr・/tagger と同じエグゼキュータを使い、
+    ページ単位でデコード1回・バッチ推論を行って結果をアノテーションの text に書き込みます。
+    """
+
+    def __init__(self, store, crop_regions: Callable):
+        self.store = store
+        self.crop_regions = crop_regions  # (img_dir, image_id, [bbox_abs], 短辺の解像度) -> [PIL.Image]
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    # --- 起動・停止 ---
+
+    def load(self, anno_dirs: List[Path]):
+        """保存済みのジョブを読み込む"""
+        for anno_dir in anno_dirs:
+            state_dir = Path(anno_dir).parent / ".state"
+            for path in state_dir.glob(f"{Path(anno_dir).name}.job-*.json"):
+                if not JOB_FILE_PATTERN.search(path.name):
+                    continue
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        job = Job(json.load(f))
+                except Exception as e:
+                    print(f"Failed to load job {path.name}: {e}")
+                    continue
+                self._jobs[job.id] = job
+
+    def start(self):
+        """ワーカーを起動し、中断されていたジョブを再開する（イベントループ内で呼ぶ）"""
+        self._queue = asyncio.Queue()
+        pending = sorted(
+            (job for job in self._jobs.values() if job.state["status"] in ("queued", "running")),
+            key=lambda job: job.state["created_at"]
+        )
+        for job in pending:
+            job.state["status"] = "queued"
+            self._queue.put_nowait(job.id)
+        self._worker = asyncio.ensure_future(self._work())
+
+    def stop(self):
+        """ワーカーを止める。実行中のジョブは running のまま残り、次回起動時に再開される"""
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    # --- 操作 ---
+
+    def submit(self, img_dir: Path, anno_dir: Path, kind: str, params: dict) -> dict:
+        if kind not in JOB_KINDS:
+            raise ValueError(f"unknown job kind: {kind}")
+        now = time.time()
+        job = Job({
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "params": params,
+            "img_dir": str(img_dir),
+            "anno_dir": str(anno_dir),
+            "status": "queued",
+            "image_ids": None,
+            "page_index": 0,
+            "total": None,
+            "processed": 0,
+            "written": 0,
+            "errors": 0,
+            "last_error": None,
+            "created_at": now,
+            "updated_at": now,
+            "started_at": None,
+            "finished_at": None,
+        })
+        job.save()
+        with self._lock:
+            self._jobs[job.id] = job
+        self._queue.put_nowait(job.id)
+        return job.to_dict()
+
+    def get(self, job_id: str, anno_dir: Path) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is None or job.anno_dir != Path(anno_dir):
+            return None
+        return job
+
+    def list(self, anno_dir: Path) -> List[dict]:
+        jobs = [job for job in self._jobs.values() if job.anno_dir == Path(anno_dir)]
+        jobs.sort(key=lambda job: job.state["created_at"], reverse=True)
+        return [job.to_dict() for job in jobs]
+
+    def cancel(self, job: Job) -> dict:
+        if job.state["status"] == "queued":
+            job.state["status"] = "cancelled"
+            job.save()
+        elif job.state["status"] == "running":
+            # ページの区切りで止まる
+            job.cancel_requested = True
+        return job.to_dict()
+
+    def resume(self, job: Job) -> dict:
+        """中止・失敗したジョブをチェックポイントから再開する"""
+        if job.state["status"] in ("cancelled", "failed"):
+            job.state["status"] = "queued"
+            job.state["finished_at"] = None
+            job.cancel_requested = False
+            job.save()
+            self._queue.put_nowait(job.id)
+        return job.to_dict()
+
+    # --- 実行 ---
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            job = self._jobs.get(job_id)
+            if job is None or job.state["status"] != "queued":
+                continue
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                # シャットダウン。running のまま保存して次回起動時に再開
+                job.save()
+                raise
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                job.state["status"] = "failed"
+                job.state["last_error"] = str(e)
+                job.state["finished_at"] = time.time()
+                job.save()
+
+    async def _run(self, job: Job):
+        s = job.state
+        s["status"] = "running"
+        if s["started_at"] is None:
+            s["started_at"] = time.time()
+        job.cancel_requested = False
+        job._run_started = time.time()
+        job._run_processed = s["processed"]
+
+        if s["image_ids"] is None:
+            s["image_ids"], s["total"] = await run_in_threadpool(self._plan, job)
+        job.save()
+
+        while s["page_index"] < len(s["image_ids"]):
+            if job.cancel_requested:
+                s["status"] = "cancelled"
+                job.save()
+                return
+            if await self._process_page(job, image_id=s["image_ids"][s["page_index"]]):
+                # 書き込んだ結果をディスクに書き出してから進捗を保存する（途中で停止しても結果を失わない）
+                await run_in_threadpool(self.store.flush)
+            s["page_index"] += 1
+            job.save()
+
+        s["status"] = "completed"
+        s["finished_at"] = time.time()
+        job.save()
+
+    def _targets(self, job: Job, page) -> list:
+        params = job.state["params"]
+        types = set(params.get("types") or DEFAULT_JOB_TYPES[job.state["kind"]])
+        only_empty = params.get("only_empty", True)
+        return [
+            anno for anno in page.annotations
+            if anno.type in types and not (only_empty and anno.text)
+        ]
+
+    def _plan(self, job: Job):
+        """対象ページの一覧と対象ボックス数を求める"""
+        params = job.state["params"]
+        # メモリ上だけにある新しいページも対象にするため、先に書き出しておく
+        self.store.flush()
+        image_ids = params.get("image_ids") or get_storage(job.anno_dir).page_ids()
+        image_ids = sorted(set(image_ids), key=id_sort_key)
+        total = 0
+        for image_id in image_ids:
+            page = self.store.get(job.anno_dir, image_id)
+            if page is not None:
+                total += len(self._targets(job, page))
+        return image_ids, total
+
+    async def _process_page(self, job: Job, image_id: str) -> bool:
+        """1ページ分を処理する（結果をページに書き込んだら True）"""
+        s = job.state
+        params = s["params"]
+        page = await run_in_threadpool(self.store.get, job.anno_dir, image_id)
+        if page is None:
+            return False
+        targets = self._targets(job, page)
+        if not targets:
+            return False
+
+        try:
+            texts = await self._infer(job, image_id, targets)
+        except Exception as e:
+            # このページは失敗として数えて次のページへ進む
+            print(f"Job {job.id}: page {image_id} failed: {e}")
+            s["errors"] += len(targets)
+            s["processed"] += len(targets)
+            s["last_error"] = f"{image_id}: {e}"
+            return False
+
+        # 推論中に編集されている可能性があるので、現在のページに書き込む
+        page = await run_in_threadpool(self.store.get, job.anno_dir, image_id)
+        written = []
+        if page is not None:
+            by_id = {anno.id: anno for anno in page.annotations}
+            only_empty = params.get("only_empty", True)
+            for anno, text in zip(targets, texts):
+                current = by_id.get(anno.id)
+                if current is None or (only_empty and current.text):
+                    continue
+                current.text = text
+                written.append(current.id)
+            if written:
+                self.store.mark_dirty(job.anno_dir, image_id, changed=written)
+        s["processed"] += len(targets)
+        s["written"] += len(written)
+        return bool(written)
+
+    async def _infer(self, job: Job, image_id: str, targets: list) -> List[str]:
+        """ページを1回デコードして対象ボックスを切り抜き、batch_size 件ずつ推論する"""
+        s = job.state
+        params = s["params"]
+        min_side = OCR_INPUT_SIZE if s["kind"] == "ocr" else TAGGER_INPUT_SIZE
+        crops = await run_in_threadpool(self.crop_regions, job.img_dir, image_id, [a.bbox_abs for a in targets], min_side)
+
+        batch_size = max(1, int(params.get("batch_size") or DEFAULT_BATCH_SIZE))
+        texts = []
+        for i in range(0, len(crops), batch_size):
+            chunk = crops[i:i + batch_size]
+            if s["kind"] == "ocr":
+                texts.extend(await run_inference(ocr_batch_task, chunk, timeout=None))
+            else:
+                model_id = params["tagger_model"]
+                backend = tuple(params.get("tagger_backend") or ("torch",))
+                probs = await run_inference(tagger_batch_task, model_id, backend, chunk, timeout=None)
+                tag_table = await run_in_threadpool(load_tag_table, model_id, params.get("excluded_tags", []))
+                for anno, row in zip(targets[i:i + batch_size], probs):
+                    tag_text, _ = tag_table.select(row, params["threshold"], annotation_type=anno.type)
+                    texts.append(tag_text)
+        return texts
@@ -1,48 +1,51 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Depends, status
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Depends, Query, Header, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.exceptions import RequestValidationError
 from fastapi.security import APIKeyHeader
+from starlette.concurrency import run_in_threadpool
 from pathlib import Path
 from PIL import Image
-import shutil
+import asyncio
 import uuid
 import json
 import secrets
-import time
-import os
+from typing import List, Optional, Literal, Tuple
+from pydantic import BaseModel, ValidationError
+import zipfile
 from models import (
     ImageAnnotation, Annotation, AnnotationCreate,
-    ImageSize, BoundingBoxAbs, BoundingBoxRel, OCRRequest, TaggerRequest,
-    AnnotationUpdate, TextUpdate, ReorderRequest, SummaryUpdate,
-    StatusUpdate, TaggerSettings
+    ImageSize, BoundingBoxAbs, OCRRequest, TaggerRequest,
+    TaggerBatchRequest, PageOCRRequest, TEXT_ANNOTATION_TYPES, JobCreate,
+    ReorderRequest, SummaryUpdate,
+    StatusUpdate, TaggerSettings, AnnotationBatchRequest
 )
-from manga_ocr import MangaOcr
-from utils import (
-    absolute_to_relative, get_next_image_number,
-    save_annotation_json, load_annotation_json
+from utils import absolute_to_relative, get_next_image_number
+from annotation_store import AnnotationStore
+from id_allocator import get_allocator
+from storage import get_storage
+from manifest import get_manifest, on_page_changed, on_page_flushed, save_all as save_manifests
+from bulk_upload import run_bulk_upload
+from image_catalog import get_catalog, copy_with_sha256, start_background_rescan, stop_background_rescan
+from page_cache import page_cache, decode_reduction
+from jobs import JobManager
+from inference import (
+    run_inference, ocr_batch_task, ocr_batcher, tagger_batcher, load_tag_table, tagger_backend_spec,
+    tagger_models_task, unload_tagger_task, configure_executor, shutdown_executor,
+    INFERENCE_WARMUP, INFERENCE_TIMEOUT, start_warmup, engine_status, OCR_PREPROCESS_VERSION, TAGGER_PREPROCESS_VERSION,
+    OCR_INPUT_SIZE, TAGGER_INPUT_SIZE,
+    InferenceTimeout, ClientDisconnected
 )
-
-# manga-ocr の遅延初期化用
-_mocr = None
-
-def get_mocr():
-    global _mocr
-    if _mocr is None:
-        print("Initializing Manga-OCR...")
-        _mocr = MangaOcr()
-        print("Manga-OCR initialized.")
-    return _mocr
-
-# WD Tagger の遅延初期化用
-_tagger_model = None
-_tagger_transform = None
-_tagger_labels = None
-_tagger_categories = None
-_current_tagger_model_id = None
-
-_current_tagger_model_id = None
+from result_cache import result_cache, result_key
+from region_tagger import region_tagger_task, region_page_side, RegionTaggerUnsupported, REGION_TAGGER_ENABLED
+from http_cache import (
+    cached_file_response, etag_matches, not_modified, not_modified_response,
+    IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
+)
+from renditions import rendition_store, rendition_list, tile_levels, RENDITION_SIZES, RENDITION_TILE_SIZE
+from page_sync import page_changes
+from events import event_hub, format_event, EVENT_HEARTBEAT, EVENT_MAX_PAGES
 
 SETTINGS_FILE = Path(__file__).parent / "settings.json"
 
@@ -62,65 +65,6 @@ def save_settings(settings):
 
 TAGGER_SETTINGS = load_settings()
 
-def get_tagger():
-    global _tagger_model, _tagger_transform, _tagger_labels, _tagger_categories, _current_tagger_model_id
-    
-    model_id = TAGGER_SETTINGS["tagger_model"]
-    
-    if _tagger_model is None or _current_tagger_model_id != model_id:
-        print(f"Initializing WD Tagger with model: {model_id}...")
-        import timm
-        from timm.data import resolve_data_config, create_transform
-        import torch
-        from huggingface_hub import hf_hub_download
-        import csv
-        
-        # モデルロード (既存モデルがあればメモリ解放を検討すべきだが、一旦上書き)
-        _tagger_model = timm.create_model(f"hf_hub:{model_id}", pretrained=True)
-        _tagger_model.eval()
-        _current_tagger_model_id = model_id
-        
-        # GPU利用可能ならGPUへ
-        if torch.cuda.is_available():
-            _tagger_model = _tagger_model.cuda()
-            print("WD Tagger: Using CUDA")
-        else:
-            print("WD Tagger: Using CPU")
-        
-        # 前処理用transform
-        config = resolve_data_config(_tagger_model.pretrained_cfg)
-        _tagger_transform = create_transform(**config)
-        
-        # ラベルファイル取得 (ローカルの日本語版があれば優先)
-        local_label_path = Path(__file__).parent / "selected_tags_ja.csv"
-        
-        global _tagger_orig_labels
-        _tagger_orig_labels = None
-        
-        if local_label_path.exists():
-            print(f"Loading local Japanese tag labels from {local_label_path}")
-            with open(local_label_path, "r", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                rows = list(reader)
-                _tagger_labels = [row["name"] for row in rows]
-                _tagger_categories = [int(row.get("category", 0)) for row in rows]
-                # 日本語版には original_en カラムがある前提
-                if "original_en" in rows[0]:
-                    _tagger_orig_labels = [row["original_en"] for row in rows]
-        else:
-            label_path = hf_hub_download(repo_id=model_id, filename="selected_tags.csv")
-            with open(label_path, "r", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                rows = list(reader)
-                _tagger_labels = [row["name"] for row in rows]
-                _tagger_categories = [int(row.get("category", 0)) for row in rows]
-        
-        print(f"WD Tagger initialized. {len(_tagger_labels)} labels loaded.")
-    
-    return _tagger_model, _tagger_transform, _tagger_labels, _tagger_categories, globals().get("_tagger_orig_labels")
-
-    return _tagger_model, _tagger_transform, _tagger_labels, _tagger_categories, globals().get("_tagger_orig_labels")
-
 app = FastAPI(
     title="Manga Annotation Tool",
     docs_url=None,    # Disable Swagger UI
@@ -179,6 +123,17 @@ async def get_gpu_status():
             "cuda_available": False
         }
 
+# 準備状況（ロードバランサのヘルスチェック用、認証なし）
+@app.get("/ready")
+async def get_readiness():
+    """OCR・タグ付けモデルの準備状況。ウォームアップ有効時は両方 ready になるまで 503"""
+    engines = engine_status(TAGGER_SETTINGS["tagger_model"], tagger_backend_spec(TAGGER_SETTINGS))
+    ready = not INFERENCE_WARMUP or all(engine["status"] == "ready" for engine in engines.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "warmup": INFERENCE_WARMUP, "engines": engines}
+    )
+
 # バリデーションエラーハンドラー
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -253,6 +208,392 @@ def get_dirs(user):
     else:
         return DATA_DIR / "images", DATA_DIR / "annotations"
 
+# --- アノテーションストア ---
+
+# ページ単位の検証済みデータをメモリに保持し、変更はまとめて書き出す
+annotation_store = AnnotationStore()
+
+# 画像一覧のマニフェストはストアの編集・書き出しに追従して差分更新する
+annotation_store.add_change_listener(on_page_changed)
+annotation_store.add_flush_listener(on_page_flushed)
+# 開かれているページの版ごとの変更を記録する（差分同期用）
+annotation_store.add_change_listener(page_changes.on_page_changed)
+# 変更を GET /events の接続に通知する（一覧の項目と、購読されたページの版ごとの変更）
+annotation_store.add_change_listener(event_hub.on_page_changed)
+page_changes.add_listener(event_hub.on_page_change)
+for _img_dir, _anno_dir in (get_dirs({"role": "admin"}), get_dirs({"role": "guest"})):
+    get_manifest(_img_dir, _anno_dir)
+    get_catalog(_img_dir)
+
+@app.on_event("startup")
+def start_image_catalog():
+    """画像カタログの定期再スキャン（外部で追加された画像の取り込み・内容ハッシュの計算）を開始"""
+    start_background_rescan()
+
+def compact_annotation_journals():
+    """編集ジャーナルをページのJSONに反映する（前回の停止時に残ったものも含む）"""
+    for role in ("admin", "guest"):
+        anno_dir = get_dirs({"role": role})[1]
+        count = get_storage(anno_dir).compact_journals()
+        if count:
+            print(f"Compacted {count} annotation journals in {anno_dir}")
+
+@app.on_event("startup")
+def recover_annotation_journals():
+    """前回の停止時に残ったジャーナルを再生してページのJSONに反映"""
+    compact_annotation_journals()
+
+@app.on_event("startup")
+async def start_event_hub():
+    """変更通知の振り分けに使うイベントループを記録"""
+    event_hub.start()
+
+@app.on_event("startup")
+def start_inference_executor():
+    """推論用エグゼキュータを作成（process の場合はここでワーカーがモデルを読み込む）"""
+    configure_executor(TAGGER_SETTINGS["tagger_model"], tagger_backend_spec(TAGGER_SETTINGS))
+
+@app.on_event("startup")
+async def start_model_warmup():
+    """INFERENCE_WARMUP=1 ならバックグラウンドで OCR・タグ付けモデルを読み込んでおく（起動は待たない）"""
+    if INFERENCE_WARMUP:
+        start_warmup(TAGGER_SETTINGS["tagger_model"], tagger_backend_spec(TAGGER_SETTINGS))
+
+@app.on_event("shutdown")
+def flush_annotation_store():
+    """未書き出しのアノテーションとマニフェストをディスクへ書き出す"""
+    job_manager.stop()
+    annotation_store.close()
+    compact_annotation_journals()
+    save_manifests()
+    stop_background_rescan()
+    shutdown_executor()
+
+def new_page_for_image(img_dir: Path, image_id: str, rescan: bool = True):
+    """画像カタログから初期アノテーションデータを作成（画像がなければ None）
+
+    rescan=True だとカタログにない画像を探してディレクトリを走査することがある（ブロッキング処理）
+    """
+    entry = get_catalog(img_dir).get(image_id, rescan=rescan)
+    if entry is None:
+        return None
+    return ImageAnnotation(
+        image_id=image_id,
+        image_filename=entry["filename"],
+        image_size=ImageSize(width=entry["width"], height=entry["height"]),
+        page_summary="",
+        annotations=[]
+    )
+
+def find_image_path(img_dir: Path, image_id: str) -> Path:
+    """画像カタログから画像ファイルのパスを解決（なければ 404）"""
+    image_path = get_catalog(img_dir).image_path(image_id)
+    if image_path is None:
+        raise HTTPException(status_code=404, detail="画像が見つかりません")
+    return image_path
+
+def load_page_image(img_dir: Path, image_id: str, reduce: int = 1) -> Image.Image:
+    """デコード済みのページ画像（RGB）をキャッシュから取得。読み取り専用として扱うこと
+
+    reduce > 1 なら縮小デコードした画像が返ることがある（元の大きさは info["source_size"]）。
+    カタログにあってもファイルが消えていれば索引から外して 404
+    """
+    image_path = find_image_path(img_dir, image_id)
+    try:
+        mtime_ns = image_path.stat().st_mtime_ns
+        return page_cache.get(img_dir, image_id, image_path, mtime_ns, reduce)
+    except FileNotFoundError:
+        get_catalog(img_dir).discard(image_id)
+        raise HTTPException(status_code=404, detail="画像が見つかりません")
+
+def page_etag(page: ImageAnnotation) -> str:
+    """ページの ETag（版番号）"""
+    return f'"{page.version}"'
+
+def check_page_version(version: int, if_match: Optional[str]):
+    """If-Match の版番号が現在の版と違えば 409（If-Match がなければ確認しない）
+
+    値は GET /annotations の ETag（"12"）か版番号そのもの（12）を受け付けます。
+    """
+    if if_match is None or if_match.strip() == "*":
+        return
+    if if_match.strip().isdigit():
+        if_match = f'"{if_match.strip()}"'
+    if not etag_matches(if_match, f'"{version}"'):
+        raise HTTPException(
+            status_code=409,
+            detail="ページが他の編集で更新されています。最新の状態を読み込んでからやり直してください",
+            headers={"ETag": f'"{version}"'}
+        )
+
+async def refresh_catalog(img_dir: Path, image_id: str):
+    """カタログにない画像をスレッドプールで取り込む（get_page(create=True) の前に呼ぶ）"""
+    await run_in_threadpool(get_catalog(img_dir).get, image_id)
+
+def get_page(img_dir: Path, anno_dir: Path, image_id: str, create: bool = False, if_match: Optional[str] = None):
+    """ストアからページを取得。create=True なら画像から初期データを作成して登録
+
+    if_match を渡すと、作成・編集の前に版番号を確認します（まだないページは版 0）。
+    画像ディレクトリは走査しないので、create=True なら先に refresh_catalog を呼んでおきます。
+    """
+    page = annotation_store.get(anno_dir, image_id)
+    check_page_version(page.version if page is not None else 0, if_match)
+    if page is None and create:
+        page = new_page_for_image(img_dir, image_id, rescan=False)
+        if page is None:
+            raise HTTPException(status_code=404, detail="画像が見つかりません")
+        annotation_store.put(anno_dir, image_id, page)
+    return page
+
+# 重複order許可のルール
+def can_share_order(anno1: Annotation, anno2: Annotation) -> bool:
+    """2つのアノテーションが同じorder番号を共有できるかどうかを判定"""
+    # sound_effectは両方がsound_effectの場合のみ重複を許可
+    if anno1.type == 'sound_effect' and anno2.type == 'sound_effect':
+        return True
+    
+    # face, person, body_part, object は両方が該当タイプで、同一character_idなら許可
+    groupable_types = {'face', 'person', 'body_part', 'object'}
+    if anno1.type in groupable_types and anno2.type in groupable_types:
+        if anno1.character_id and anno2.character_id and anno1.character_id == anno2.character_id:
+            return True
+    
+    # それ以外は重複不可
+    return False
+
+def insert_annotation(image_annotation: ImageAnnotation, annotation: AnnotationCreate) -> Tuple[Annotation, bool]:
+    """ページに新しいアノテーションを追加。戻り値は (追加したアノテーション, 他の order をずらしたか)"""
+    # 相対座標を計算
+    bbox_rel = absolute_to_relative(
+        annotation.bbox_abs,
+        image_annotation.image_size.width,
+        image_annotation.image_size.height
+    )
+    
+    # 新しいアノテーションを作成
+    new_annotation = Annotation(
+        id=f"anno_{uuid.uuid4().hex[:8]}",
+        type=annotation.type,
+        order=annotation.order if annotation.order is not None else len(image_annotation.annotations) + 1,
+        bbox_abs=annotation.bbox_abs,
+        bbox_rel=bbox_rel,
+        text=annotation.text,
+        character_id=annotation.character_id,
+        subtype=annotation.subtype
+    )
+    
+    # アノテーションリストに追加
+    target_order = annotation.order
+    if target_order is None:
+        # orderが指定されていない場合は末尾に追加
+        image_annotation.annotations.append(new_annotation)
+        return new_annotation, False
+    
+    # 同じorderを持つアノテーションがあるか確認
+    existing_with_same_order = [
+        anno for anno in image_annotation.annotations 
+        if anno.order == target_order
+    ]
+    
+    # 全ての既存アノテーションが新しいアノテーションと重複を許可できるか確認
+    if all(can_share_order(new_annotation, existing) for existing in existing_with_same_order):
+        # 重複許可、または同じorderが存在しない - そのまま追加
+        image_annotation.annotations.append(new_annotation)
+        return new_annotation, False
+    
+    # 重複不可 - 既存のorderをずらす
+    sorted_annos = sorted(image_annotation.annotations, key=lambda x: x.order)
+    for anno in sorted_annos:
+        if anno.order >= target_order:
+            anno.order += 1
+    sorted_annos.append(new_annotation)
+    image_annotation.annotations = sorted(sorted_annos, key=lambda x: x.order)
+    return new_annotation, True
+
+# 更新で None を指定しても変更しない項目（None にできない項目）
+REQUIRED_ANNOTATION_FIELDS = {"type", "order", "bbox_abs", "text"}
+
+def set_annotation_fields(image_annotation: ImageAnnotation, target: Annotation, data: BaseModel, fields):
+    """data の fields の項目をアノテーションに反映（bbox_abs を変えたら相対座標も計算し直す）"""
+    for name in fields:
+        value = getattr(data, name)
+        if value is None and name in REQUIRED_ANNOTATION_FIELDS:
+            continue
+        setattr(target, name, value)
+    if "bbox_abs" in fields and data.bbox_abs is not None:
+        target.bbox_rel = absolute_to_relative(
+            target.bbox_abs,
+            image_annotation.image_size.width,
+            image_annotation.image_size.height
+        )
+
+def reorder_page(image_annotation: ImageAnnotation, annotation_ids: List[str]) -> int:
+    """annotation_ids の順に order を1から振り直す（含まれないものは末尾）。件数を返す"""
+    anno_dict = {anno.id: anno for anno in image_annotation.annotations}
+    new_annotations = []
+    for anno_id in annotation_ids:
+        if anno_id in anno_dict:
+            anno = anno_dict.pop(anno_id)
+            anno.order = len(new_annotations) + 1
+            new_annotations.append(anno)
+    
+    for anno in image_annotation.annotations:
+        if anno.id in anno_dict:
+            anno.order = len(new_annotations) + 1
+            new_annotations.append(anno)
+    
+    image_annotation.annotations = new_annotations
+    return len(new_annotations)
+
+def apply_annotation_operations(image_annotation: ImageAnnotation, operations):
+    """一括編集をページのコピーに適用する
+
+    戻り値は (編集後のページ, {ref: 作成したID}, 変更したID, 削除したID, ページ全体を書き出すか)。
+    途中の操作が失敗したら HTTPException を送出し、元のページは変更しない。
+    """
+    working = image_annotation.model_copy(deep=True)
+    refs = {}
+    changed, removed = set(), set()
+    whole_page = False
+    for i, operation in enumerate(operations):
+        def fail(status_code: int, message: str):
+            raise HTTPException(status_code=status_code, detail=f"operations[{i}] ({operation.op}): {message}")
+        
+        annotation_id = refs.get(operation.annotation_id, operation.annotation_id)
+        if operation.op == "create":
+            if operation.data is None:
+                fail(400, "data が必要です")
+            try:
+                create = AnnotationCreate(image_id=working.image_id, **operation.data.model_dump(exclude_unset=True))
+            except ValidationError as e:
+                fail(400, str(e))
+            new_annotation, reordered = insert_annotation(working, create)
+            if operation.ref:
+                refs[operation.ref] = new_annotation.id
+            changed.add(new_annotation.id)
+            whole_page = whole_page or reordered
+        elif operation.op == "update":
+            if operation.data is None:
+                fail(400, "data が必要です")
+            target = next((anno for anno in working.annotations if anno.id == annotation_id), None)
+            if target is None:
+                fail(404, f"アノテーションが見つかりません: {operation.annotation_id}")
+            set_annotation_fields(working, target, operation.data, operation.data.model_fields_set)
+            changed.add(target.id)
+        elif operation.op == "delete":
+            working.annotations = [anno for anno in working.annotations if anno.id != annotation_id]
+            changed.discard(annotation_id)
+            removed.add(annotation_id)
+        else:
+            if operation.annotation_ids is None:
+                fail(400, "annotation_ids が必要です")
+            reorder_page(working, [refs.get(anno_id, anno_id) for anno_id in operation.annotation_ids])
+            whole_page = True
+    return working, refs, changed, removed, whole_page
+
+def crop_page_regions(img_dir: Path, image_id: str, boxes: List[BoundingBoxAbs],
+                      min_side: Optional[int] = None) -> List[Image.Image]:
+    """ページ画像を1回だけ取得して複数の範囲を切り抜く（ブロッキング処理）
+
+    min_side を指定すると、推論エンジンが実際に使う解像度（短辺 min_side）で足りる範囲で
+    ページを縮小デコードし、切り抜いた画像も短辺 min_side まで縮小して返します。
+    """
+    reduce = 1
+    if min_side and boxes:
+        reduce = decode_reduction(min(min(b.width, b.height) for b in boxes), min_side)
+    img = load_page_image(img_dir, image_id, reduce)
+    source_width, source_height = img.info.get("source_size", img.size)
+    scale_x = img.width / source_width
+    scale_y = img.height / source_height
+    crops = []
+    for bbox_abs in boxes:
+        left = bbox_abs.x * scale_x
+        top = bbox_abs.y * scale_y
+        right = (bbox_abs.x + bbox_abs.width) * scale_x
+        bottom = (bbox_abs.y + bbox_abs.height) * scale_y
+        crop = img.crop((left, top, right, bottom))
+        if min_side and min(crop.size) > min_side:
+            shrink = min(crop.size) / min_side
+            size = (max(1, round(crop.width / shrink)), max(1, round(crop.height / shrink)))
+            crop = crop.resize(size, Image.BICUBIC, reducing_gap=2.0)
+        crops.append(crop)
+    return crops
+
+def load_region_page(img_dir: Path, image_id: str, boxes: List[BoundingBoxAbs]):
+    """ROI モード用に、ページを ROI の入力解像度に足りる大きさで取得し、ボックスをその座標に変換する（ブロッキング処理）
+
+    JPEG は縮小デコードし、それでも大きければ長辺 region_page_side() まで縮小してから推論エンジンに渡します。
+    """
+    side = region_page_side()
+    entry = get_catalog(img_dir).get(image_id) or {}
+    reduce = 1
+    if entry.get("width") and entry.get("height"):
+        reduce = decode_reduction(max(entry["width"], entry["height"]), side)
+    img = load_page_image(img_dir, image_id, reduce)
+    source_width, source_height = img.info.get("source_size", img.size)
+    if max(img.size) > side:
+        shrink = max(img.size) / side
+        size = (max(1, round(img.width / shrink)), max(1, round(img.height / shrink)))
+        img = img.resize(size, Image.BICUBIC, reducing_gap=2.0)
+    scale_x = img.width / source_width
+    scale_y = img.height / source_height
+    regions = [(b.x * scale_x, b.y * scale_y, b.width * scale_x, b.height * scale_y) for b in boxes]
+    return img, regions
+
+def crop_page_image(img_dir: Path, image_id: str, bbox_abs: BoundingBoxAbs,
+                    min_side: Optional[int] = None) -> Image.Image:
+    """ページ画像から bbox_abs の範囲を切り抜く（ブロッキング処理）"""
+    return crop_page_regions(img_dir, image_id, [bbox_abs], min_side)[0]
+
+def page_content_hash(img_dir: Path, image_id: str) -> Optional[str]:
+    """推論結果キャッシュのキーに使うページ画像の内容ハッシュ（ブロッキング処理）
+
+    画像がカタログの登録後に差し替えられていれば None（キャッシュを使わない）
+    """
+    catalog = get_catalog(img_dir)
+    entry = catalog.get(image_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="画像が見つかりません")
+    try:
+        if (img_dir / entry["filename"]).stat().st_mtime_ns != entry["mtime_ns"]:
+            return None
+    except FileNotFoundError:
+        catalog.discard(image_id)
+        raise HTTPException(status_code=404, detail="画像が見つかりません")
+    return catalog.content_hash(image_id)
+
+def image_source(img_dir: Path, image_id: str):
+    """配信する画像の (カタログのエントリ, 画像のパス, 内容ハッシュ)（ブロッキング処理）
+
+    画像がカタログの登録後に差し替えられていれば登録し直してからハッシュを計算する
+    """
+    catalog = get_catalog(img_dir)
+    image_path = find_image_path(img_dir, image_id)
+    entry = catalog.get(image_id)
+    try:
+        if entry is None or image_path.stat().st_mtime_ns != entry["mtime_ns"]:
+            entry = catalog.add(image_id, image_path)
+    except FileNotFoundError:
+        catalog.discard(image_id)
+        raise HTTPException(status_code=404, detail="画像が見つかりません")
+    sha256 = catalog.content_hash(image_id)
+    if sha256 is None:
+        raise HTTPException(status_code=404, detail="画像が見つかりません")
+    return entry, image_path, sha256
+
+def image_cache_control(version: Optional[str], sha256: str) -> str:
+    """URL の版（?v=）が現在の内容ハッシュと一致すれば長期キャッシュ、そうでなければ毎回 ETag で確認"""
+    return IMMUTABLE_CACHE_CONTROL if version == sha256 else REVALIDATE_CACHE_CONTROL
+
+# 自動タグ付け・自動OCRのジョブキュー
+job_manager = JobManager(annotation_store, crop_page_regions)
+job_manager.load([get_dirs({"role": "admin"})[1], get_dirs({"role": "guest"})[1]])
+
+@app.on_event("startup")
+async def start_job_worker():
+    """ジョブのワーカーを起動（中断されていたジョブはチェックポイントから再開）"""
+    job_manager.start()
+
 # --- 設定関連 ---
 
 @app.get("/settings")
@@ -262,10 +603,46 @@ async def get_settings(user: dict = Depends(get_current_user)):
 @app.post("/settings")
 async def update_settings(settings: TaggerSettings, user: dict = Depends(get_current_user)):
     global TAGGER_SETTINGS
-    TAGGER_SETTINGS = settings.model_dump()
+    # 送られてこなかった項目（バックエンドのスレッド数など）は現在の値を残す
+    TAGGER_SETTINGS = {**TAGGER_SETTINGS, **settings.model_dump(exclude_unset=True)}
     save_settings(TAGGER_SETTINGS)
+    if INFERENCE_WARMUP:
+        # 新しいモデルも先に読み込んでおく
+        start_warmup(TAGGER_SETTINGS["tagger_model"], tagger_backend_spec(TAGGER_SETTINGS), ocr=False)
     return TAGGER_SETTINGS
 
+@app.get("/inference/stats")
+async def get_inference_stats(user: dict = Depends(get_current_user)):
+    """OCR・タグ付けのバッチ処理の実績（バッチ数・平均バッチサイズ）と結果キャッシュのヒット率"""
+    return {
+        "ocr_batching": ocr_batcher.stats(),
+        "tagger_batching": tagger_batcher.stats(),
+        "result_cache": result_cache.stats(),
+    }
+
+@app.get("/tagger/models")
+async def get_tagger_models(user: dict = Depends(get_current_user)):
+    """読み込み済みの WD Tagger モデルとメモリ使用量（process エグゼキュータでは応答したワーカーの分）"""
+    return await run_inference(tagger_models_task)
+
+@app.delete("/tagger/models")
+async def unload_tagger_models(model_id: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """読み込み済みの WD Tagger モデル（model_id 省略時はすべて）をメモリから解放"""
+    if user["role"] == "guest":
+        raise HTTPException(status_code=403, detail="ゲストはモデルを解放できません")
+    unloaded = await run_inference(unload_tagger_task, model_id)
+    return {"unloaded": unloaded}
+
+@app.get("/page-cache/stats")
+async def get_page_cache_stats(user: dict = Depends(get_current_user)):
+    """OCR・タグ付け用のデコード済みページキャッシュのヒット率と使用量（縮小版の生成数も含む）"""
+    return {**page_cache.stats(), "renditions": rendition_store.stats()}
+
+@app.get("/events/stats")
+async def get_event_stats(user: dict = Depends(get_current_user)):
+    """変更通知の接続数・取りこぼし（reset）の回数と、差分を記録しているページ数"""
+    return {**event_hub.stats(), "page_sync": page_changes.stats()}
+
 # --- エンドポイント ---
 
 # 静的ファイルの配信 (認証不要だが、HTML側でAPI制限に対応する)
@@ -315,46 +692,47 @@ async def guest_login(body: dict):
     raise HTTPException(status_code=401, detail="Invalid password")
 
 @app.get("/annotations-list")
-async def list_annotated_images(user: dict = Depends(get_current_user)):
-    """アノテーションが存在する画像の一覧を取得"""
+async def list_annotated_images(
+    is_completed: Optional[bool] = None,
+    has_annotation: Optional[bool] = None,
+    annotation_type: Optional[str] = Query(None, alias="type"),
+    character_id: Optional[str] = None,
+    id_from: Optional[str] = None,
+    id_to: Optional[str] = None,
+    sort: str = "id",
+    order: Literal["asc", "desc"] = "asc",
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    user: dict = Depends(get_current_user)
+):
+    """アノテーションが存在する画像の一覧を取得
+
+    limit を指定するとカーソル方式でページングします（次ページは next_cursor を cursor に渡す）。
+    指定しない場合は従来どおり全件を返します。
+    """
     img_dir, anno_dir = get_dirs(user)
     
     # ゲストの場合：guest_imagesにある全画像を表示候補とする
-    # 未アノテーションのものも含めるため、画像フォルダをスキャン
-    
-    files_list = []
-    
-    # 画像ファイルのスキャン
-    if img_dir.exists():
-        for file in img_dir.iterdir():
-            if file.suffix.lower() in ['.jpg', '.jpeg', '.png', '.webp']:
-                image_id = file.stem
-                
-                # 対応するアノテーションがあるか確認
-                json_path = anno_dir / f"{image_id}.json"
-                
-                is_completed = False
-                has_annotation = False
-                
-                if json_path.exists():
-                    try:
-                        with open(json_path, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
-                            has_annotation = True
-                            is_completed = data.get("is_completed", False)
-                    except:
-                        pass
-                
-                files_list.append({
-                    "id": image_id,
-                    "has_annotation": has_annotation,
-                    "is_completed": is_completed
-                })
-    
-    # ID順にソート
-    files_list.sort(key=lambda x: x["id"], reverse=False)
+    # 未アノテーションのものも含めるため、画像フォルダ基準のマニフェストから返す
+    # (ディレクトリに変更があった場合のみ差分を読み直す。走査とファイルの読み込みはスレッドプールで行う)
+    try:
+        images, next_cursor, total = await run_in_threadpool(
+            get_manifest(img_dir, anno_dir).query,
+            is_completed=is_completed,
+            has_annotation=has_annotation,
+            annotation_type=annotation_type,
+            character_id=character_id,
+            id_from=id_from,
+            id_to=id_to,
+            sort=sort,
+            descending=(order == "desc"),
+            cursor=cursor,
+            limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    return {"images": files_list}
+    return {"images": images, "next_cursor": next_cursor, "total": total}
 
 
 @app.get("/next-image-number")
@@ -384,24 +762,26 @@ async def upload_image(file: UploadFile = File(...), user: dict = Depends(get_cu
          raise HTTPException(status_code=403, detail="ゲストは画像をアップロードできません")
 
     try:
-        # 次の画像番号を取得
-        image_id = get_next_image_number(img_dir, anno_dir)
-        
         # ファイル拡張子を取得
         file_ext = Path(file.filename).suffix.lower()
         if file_ext not in ['.jpg', '.jpeg', '.png', '.webp']:
             raise HTTPException(status_code=400, detail="サポートされていないファイル形式です")
         
+        # 次の画像番号を予約（同時アップロードでも重複しない）
+        image_id = get_allocator(img_dir, anno_dir).allocate()
+        
         # 画像を保存
         image_filename = f"{image_id}{file_ext}"
         image_path = img_dir / image_filename
         
         with open(image_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+            sha256 = copy_with_sha256(file.file, buffer)
+        
+        # 画像サイズを取得（ヘッダのみ）してカタログに登録
+        entry = get_catalog(img_dir).add(image_id, image_path, sha256)
+        width, height = entry["width"], entry["height"]
         
-        # 画像サイズを取得
-        with Image.open(image_path) as img:
-            width, height = img.size
+        get_manifest(img_dir, anno_dir).image_added(image_id, image_path)
         
         # 初期アノテーションデータを作成
         annotation_data = ImageAnnotation(
@@ -412,11 +792,11 @@ async def upload_image(file: UploadFile = File(...), user: dict = Depends(get_cu
             annotations=[]
         )
         
-        # JSONファイルに保存 (ディレクトリ指定版が必要)
-        # utils.save_annotation_json は内部で DATA_DIR を使っている可能性があるため
-        # ここでは直接保存するか、utilsを修正する。安全のため直接保存を実装。
-        with open(anno_dir / f"{image_id}.json", 'w', encoding='utf-8') as f:
-            json.dump(annotation_data.model_dump(), f, ensure_ascii=False, indent=2)
+        # 初期アノテーションデータを保存
+        annotation_store.put(anno_dir, image_id, annotation_data)
+        
+        # 表示用の縮小版をバックグラウンドで作成
+        rendition_store.pregenerate(sha256, image_path, width, height)
         
         return {
             "image_id": image_id,
@@ -430,9 +810,58 @@ async def upload_image(file: UploadFile = File(...), user: dict = Depends(get_cu
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/upload/bulk")
+async def upload_images_bulk(
+    files: List[UploadFile] = File(...),
+    upload_id: Optional[str] = Form(None),
+    user: dict = Depends(get_current_user)
+):
+    """複数の画像・zip/cbz アーカイブをまとめてアップロード
+
+    番号は連続した範囲でまとめて予約します。中断した場合は、レスポンスの
+    upload_id を付けて同じファイル（残りのファイルだけでも可）を再送すると、完了済みの画像を飛ばして続きから登録します。
+    """
+    img_dir, anno_dir = get_dirs(user)
+
+    if user["role"] == "guest":
+        raise HTTPException(status_code=403, detail="ゲストは画像をアップロードできません")
+
+    for file in files:
+        file_ext = Path(file.filename or "").suffix.lower()
+        if file_ext not in ['.jpg', '.jpeg', '.png', '.webp', '.zip', '.cbz']:
+            raise HTTPException(status_code=400, detail=f"サポートされていないファイル形式です: {file.filename}")
+
+    try:
+        # ファイル書き込みと画像ヘッダの読み込みはブロッキングなのでスレッドで実行
+        result = await run_in_threadpool(
+            run_bulk_upload, img_dir, anno_dir, files,
+            annotation_store, get_manifest(img_dir, anno_dir), upload_id
+        )
+    except zipfile.BadZipFile as e:
+        raise HTTPException(status_code=400, detail=f"アーカイブを読み込めません: {e}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    # 表示用の縮小版をバックグラウンドで作成
+    catalog = get_catalog(img_dir)
+    for item in result["results"]:
+        entry = catalog.get(item["image_id"]) if item["status"] == "created" else None
+        if entry is not None:
+            rendition_store.pregenerate(entry["sha256"], img_dir / entry["filename"], entry["width"], entry["height"])
+    return result
+
+
 @app.get("/images/{filename}")
-async def get_image(filename: str, user: dict = Depends(get_current_user)):
-    """画像ファイルを取得"""
+async def get_image(filename: str, request: Request, v: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """画像ファイルを取得
+
+    ETag は内容ハッシュなので、変わっていなければ 304 を返します。?v=<sha256> 付きの URL は長期キャッシュ可。
+    Range リクエストにも対応しています。
+    """
     # ディレクトリ・トラバーサル対策: ファイル名のみを取得
     safe_filename = Path(filename).name
     img_dir, _ = get_dirs(user)
@@ -440,170 +869,213 @@ async def get_image(filename: str, user: dict = Depends(get_current_user)):
     
     if not image_path.exists() or not image_path.is_file():
         raise HTTPException(status_code=404, detail="画像が見つかりません")
-    return FileResponse(str(image_path))
+    
+    image_id = Path(safe_filename).stem
+    entry = await run_in_threadpool(get_catalog(img_dir).get, image_id)
+    if entry is None or entry["filename"] != safe_filename:
+        # カタログにない画像（同じ番号の別の拡張子など）は更新日時とサイズから ETag を作る
+        st = image_path.stat()
+        etag = f'W/"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        return cached_file_response(request, image_path, etag, REVALIDATE_CACHE_CONTROL)
+    _, image_path, sha256 = await run_in_threadpool(image_source, img_dir, image_id)
+    return cached_file_response(request, image_path, f'"{sha256}"', image_cache_control(v, sha256))
+
+
+@app.get("/images/{image_id}/renditions")
+async def get_image_renditions(image_id: str, user: dict = Depends(get_current_user)):
+    """表示用の縮小版とディープズーム用タイルの一覧
+
+    URL には内容ハッシュを ?v= として付けるので、画像が差し替えられると URL も変わります。
+    フロントエンドは表示サイズ（× devicePixelRatio）以上で最小の縮小版を選び、
+    足りなければ original（元画像）を使います。
+    """
+    img_dir, _ = get_dirs(user)
+    entry, _, sha256 = await run_in_threadpool(image_source, img_dir, image_id)
+    width, height = entry["width"], entry["height"]
+    renditions = [
+        {**r, "url": f"/images/{image_id}/rendition/{r['size']}?v={sha256}"}
+        for r in rendition_list(width, height)
+    ]
+    return {
+        "image_id": image_id,
+        "width": width,
+        "height": height,
+        "sha256": sha256,
+        "original": f"/images/{entry['filename']}?v={sha256}",
+        "renditions": renditions,
+        "tiles": {
+            "tile_size": RENDITION_TILE_SIZE,
+            "overlap": 0,
+            "format": "jpg",
+            "max_level": tile_levels(width, height),
+            "url": f"/images/{image_id}/tiles/{{level}}/{{col}}_{{row}}.jpg?v={sha256}",
+        },
+    }
+
+
+@app.get("/images/{image_id}/rendition/{size}")
+async def get_image_rendition(image_id: str, size: int, request: Request, v: Optional[str] = None,
+                              user: dict = Depends(get_current_user)):
+    """長辺 size の縮小版（JPEG）。初回は作成してから返す"""
+    if size not in RENDITION_SIZES:
+        raise HTTPException(status_code=404, detail="このサイズの縮小版はありません")
+    img_dir, _ = get_dirs(user)
+    entry, image_path, sha256 = await run_in_threadpool(image_source, img_dir, image_id)
+    path = await run_in_threadpool(
+        rendition_store.rendition, sha256, image_path, entry["width"], entry["height"], size
+    )
+    return cached_file_response(request, path, f'"{sha256}-{size}"', image_cache_control(v, sha256), "image/jpeg")
+
+
+@app.get("/images/{image_id}/tiles/{level}/{tile}.jpg")
+async def get_image_tile(image_id: str, level: int, tile: str, request: Request, v: Optional[str] = None,
+                         user: dict = Depends(get_current_user)):
+    """ディープズーム用のタイル（{col}_{row}.jpg）。初回はそのレベルのタイルをまとめて作成する"""
+    try:
+        col, row = (int(n) for n in tile.split("_"))
+    except ValueError:
+        raise HTTPException(status_code=404, detail="タイルが見つかりません")
+    img_dir, _ = get_dirs(user)
+    entry, image_path, sha256 = await run_in_threadpool(image_source, img_dir, image_id)
+    path = await run_in_threadpool(
+        rendition_store.tile, sha256, image_path, entry["width"], entry["height"], level, col, row
+    )
+    if path is None:
+        raise HTTPException(status_code=404, detail="タイルが見つかりません")
+    etag = f'"{sha256}-{level}-{col}_{row}"'
+    return cached_file_response(request, path, etag, image_cache_control(v, sha256), "image/jpeg")
 
 
 @app.get("/annotations/{image_id}")
-async def get_annotations(image_id: str, user: dict = Depends(get_current_user)):
-    """特定の画像のアノテーションを取得"""
+async def get_annotations(image_id: str, request: Request, user: dict = Depends(get_current_user)):
+    """特定の画像のアノテーションを取得
+
+    ETag はページの版番号で、If-None-Match が一致すれば 304 を返します。
+    以降の変更は GET /annotations/{image_id}/delta?since=版番号 で差分として受け取れます。
+    """
     img_dir, anno_dir = get_dirs(user)
-    json_path = anno_dir / f"{image_id}.json"
     
-    if json_path.exists():
-        try:
-             with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data
-        except Exception as e:
-            print(f"Error loading json: {e}")
-            pass # JSONがない、または壊れている場合は下へ
+    page = None
+    try:
+        page = annotation_store.get(anno_dir, image_id)
+    except Exception as e:
+        print(f"Error loading json: {e}")
+        pass # JSONがない、または壊れている場合は下へ
     
-    # JSONが存在しない場合、画像があるか確認して初期データを返す（ゲスト用）
-    # 画像拡張子を探索
-    image_path = None
-    image_filename = None
-    for ext in ['.jpg', '.jpeg', '.png', '.webp']:
-        p = img_dir / f"{image_id}{ext}"
-        if p.exists():
-            image_path = p
-            image_filename = f"{image_id}{ext}"
-            break
-            
-    if image_path:
-        # 画像はあるがアノテーションがない -> 初期データを返す
-        with Image.open(image_path) as img:
-            width, height = img.size
-            
-        return ImageAnnotation(
-            image_id=image_id,
-            image_filename=image_filename,
-            image_size=ImageSize(width=width, height=height),
-            page_summary="",
-            annotations=[]
-        ).model_dump()
+    if page is None:
+        # JSONが存在しない場合、画像があるか確認して初期データを返す（ゲスト用）
+        page = await run_in_threadpool(new_page_for_image, img_dir, image_id)
+    if page is None:
+        raise HTTPException(status_code=404, detail="画像が見つかりません")
+    
+    page_changes.track(anno_dir, image_id, page)
+    etag = page_etag(page)
+    if not_modified(request, etag):
+        response = not_modified_response(etag, REVALIDATE_CACHE_CONTROL)
+    else:
+        response = Response(
+            content=page.model_dump_json().encode("utf-8"), media_type="application/json",
+            headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+        )
+    # 版番号はアノテーションディレクトリ（管理者・ゲスト）ごとなので、認証ごとに別のキャッシュにする
+    response.headers["Vary"] = "Authorization"
+    return response
 
-    raise HTTPException(status_code=404, detail="画像が見つかりません")
 
+@app.get("/annotations/{image_id}/delta")
+async def get_annotation_delta(image_id: str, since: int = Query(..., ge=0), user: dict = Depends(get_current_user)):
+    """版番号 since 以降の変更だけを返す
 
-@app.post("/annotations")
-async def create_annotation(annotation: AnnotationCreate, user: dict = Depends(get_current_user)):
-    """新しいアノテーションを作成"""
+    changes は古い順で、各要素は version（その変更後の版）と set（追加・変更したアノテーション）、
+    del（削除したID）、ids（並びが変わったときの全IDの並び）、page（変更したページの項目）のうち変更のあったもの。
+    記録が残っていない版からは reset=true と page（ページ全体）を返します。
+    """
     img_dir, anno_dir = get_dirs(user)
-    try:
-        # 既存データを読み込み（なければ初期化）
-        json_path = anno_dir / f"{annotation.image_id}.json"
-        
-        annotation_data = None
-        if json_path.exists():
-             with open(json_path, 'r', encoding='utf-8') as f:
-                annotation_data = json.load(f)
-        else:
-            # 新規作成ロジック（画像情報の取得が必要）
-            # get_annotationsと同様のロジック
-            # (簡略化のため、get_annotations が勝手にやってくれるのを期待したいが内部呼び出しはしにくい)
-             # 画像拡張子を探索
-            image_path = None
-            filename = None
-            for ext in ['.jpg', '.jpeg', '.png', '.webp']:
-                p = img_dir / f"{annotation.image_id}{ext}"
-                if p.exists():
-                    image_path = p
-                    filename = f"{annotation.image_id}{ext}"
-                    break
-            
-            if not image_path:
-                raise HTTPException(status_code=404, detail="画像が見つかりません")
+    page = annotation_store.get(anno_dir, image_id)
+    if page is None:
+        page = await run_in_threadpool(new_page_for_image, img_dir, image_id)
+    if page is None:
+        raise HTTPException(status_code=404, detail="画像が見つかりません")
+    
+    changes = page_changes.changes_since(anno_dir, image_id, page, since)
+    if changes is None:
+        page_changes.track(anno_dir, image_id, page)
+        return {"version": page.version, "reset": True, "page": page.model_dump()}
+    return {"version": page.version, "reset": False, "changes": changes}
+
+
+@app.get("/events")
+async def stream_events(request: Request, pages: Optional[str] = None, list_updates: bool = Query(True, alias="list"),
+                        user: dict = Depends(get_current_user)):
+    """変更通知のストリーム（Server-Sent Events）
+
+    pages（カンマ区切りの画像ID）のページの版ごとの変更を page イベントで、
+    list=true（既定）なら画像一覧の項目の変化（アップロード・完了ステータスなど）を list イベントで送ります。
+    接続直後の ready イベントで購読したページの現在の版を返すので、手元の版と違えば差分 API で取り直してください。
+    """
+    img_dir, anno_dir = get_dirs(user)
+    page_ids = list(dict.fromkeys(image_id for image_id in (pages or "").split(",") if image_id))
+    if len(page_ids) > EVENT_MAX_PAGES:
+        raise HTTPException(status_code=400, detail=f"購読できるページは {EVENT_MAX_PAGES} までです")
+    for image_id in page_ids:
+        # パスパラメータと同じく、ディレクトリをまたぐIDは受け付けない
+        if Path(image_id).name != image_id or image_id in (".", "..") or "\\" in image_id:
+            raise HTTPException(status_code=400, detail=f"画像IDが不正です: {image_id}")
+    
+    def track_pages() -> dict:
+        versions = {}
+        for image_id in page_ids:
+            # 差分の記録があるページにしか page イベントは送れないので、記録を始めておく
+            page = annotation_store.get(anno_dir, image_id) or new_page_for_image(img_dir, image_id)
+            if page is not None:
+                page_changes.track(anno_dir, image_id, page)
+                versions[image_id] = page.version
+        return versions
+    
+    async def stream():
+        # 購読中のページの記録は、ほかのページが開かれても破棄されないようにする
+        subscription = event_hub.subscribe(anno_dir, page_ids, list_updates)
+        page_changes.pin(anno_dir, page_ids)
+        try:
+            versions = await run_in_threadpool(track_pages)
+            yield format_event("ready", {"versions": versions})
+            while True:
+                message = await subscription.next_message(EVENT_HEARTBEAT)
+                # 送るものがなければコメント行（プロキシのタイムアウト防止）
+                yield message if message is not None else ": ping\n\n"
+        finally:
+            event_hub.unsubscribe(subscription)
+            page_changes.unpin(anno_dir, page_ids)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # nginx のバッファリングを止める
+    })
 
-            with Image.open(image_path) as img:
-                width, height = img.size
-            
-            annotation_data = ImageAnnotation(
-                image_id=annotation.image_id,
-                image_filename=filename,
-                image_size=ImageSize(width=width, height=height),
-                annotations=[]
-            ).model_dump()
 
+@app.post("/annotations")
+async def create_annotation(annotation: AnnotationCreate, response: Response, if_match: Optional[str] = Header(None),
+                            user: dict = Depends(get_current_user)):
+    """新しいアノテーションを作成（If-Match の版番号が古ければ 409）"""
+    img_dir, anno_dir = get_dirs(user)
+    await refresh_catalog(img_dir, annotation.image_id)
+    try:
+        # 既存データを読み込み（なければ画像情報から初期化）
+        image_annotation = get_page(img_dir, anno_dir, annotation.image_id, create=True, if_match=if_match)
         
-        image_annotation = ImageAnnotation(**annotation_data)
-        
-        # 相対座標を計算
-        bbox_rel = absolute_to_relative(
-            annotation.bbox_abs,
-            image_annotation.image_size.width,
-            image_annotation.image_size.height
-        )
-        
-        # 新しいアノテーションを作成
-        new_annotation = Annotation(
-            id=f"anno_{uuid.uuid4().hex[:8]}",
-            type=annotation.type,
-            order=annotation.order,
-            bbox_abs=annotation.bbox_abs,
-            bbox_rel=bbox_rel,
-            text=annotation.text,
-            character_id=annotation.character_id,
-            subtype=annotation.subtype
-        )
+        new_annotation, reordered = insert_annotation(image_annotation, annotation)
         
-        # 重複order許可のルール
-        def can_share_order(anno1: Annotation, anno2: Annotation) -> bool:
-            """2つのアノテーションが同じorder番号を共有できるかどうかを判定"""
-            # sound_effectは両方がsound_effectの場合のみ重複を許可
-            if anno1.type == 'sound_effect' and anno2.type == 'sound_effect':
-                return True
-            
-            # face, person, body_part, object は両方が該当タイプで、同一character_idなら許可
-            groupable_types = {'face', 'person', 'body_part', 'object'}
-            if anno1.type in groupable_types and anno2.type in groupable_types:
-                if anno1.character_id and anno2.character_id and anno1.character_id == anno2.character_id:
-                    return True
-            
-            # それ以外は重複不可
-            return False
-        
-        # アノテーションリストに追加
-        target_order = annotation.order
-        if target_order is not None:
-            # 同じorderを持つアノテーションがあるか確認
-            existing_with_same_order = [
-                anno for anno in image_annotation.annotations 
-                if anno.order == target_order
-            ]
-            
-            # 重複許可チェック
-            if existing_with_same_order:
-                # 全ての既存アノテーションが新しいアノテーションと重複を許可できるか確認
-                can_duplicate = all(
-                    can_share_order(new_annotation, existing) 
-                    for existing in existing_with_same_order
-                )
-                
-                if can_duplicate:
-                    # 重複許可 - そのまま追加
-                    image_annotation.annotations.append(new_annotation)
-                else:
-                    # 重複不可 - 既存のorderをずらす
-                    sorted_annos = sorted(image_annotation.annotations, key=lambda x: x.order)
-                    for anno in sorted_annos:
-                        if anno.order >= target_order:
-                            anno.order += 1
-                    sorted_annos.append(new_annotation)
-                    image_annotation.annotations = sorted(sorted_annos, key=lambda x: x.order)
-            else:
-                # 同じorderが存在しない場合は単純に追加
-                image_annotation.annotations.append(new_annotation)
+        # 書き出し対象に登録（並び替えが起きた場合はページ全体）
+        if reordered:
+            annotation_store.mark_dirty(anno_dir, annotation.image_id)
         else:
-            # orderが指定されていない場合は末尾に追加
-            new_annotation.order = len(image_annotation.annotations) + 1
-            image_annotation.annotations.append(new_annotation)
-        
-        # JSONファイルに保存
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(image_annotation.model_dump(), f, ensure_ascii=False, indent=2)
+            annotation_store.mark_dirty(anno_dir, annotation.image_id, changed=[new_annotation.id])
+        response.headers["ETag"] = page_etag(image_annotation)
         
         return new_annotation
     
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -611,19 +1083,15 @@ async def create_annotation(annotation: AnnotationCreate, user: dict = Depends(g
 
 
 @app.delete("/annotations/{image_id}/{annotation_id}")
-async def delete_annotation(image_id: str, annotation_id: str, user: dict = Depends(get_current_user)):
-    """アノテーションを削除"""
+async def delete_annotation(image_id: str, annotation_id: str, response: Response, if_match: Optional[str] = Header(None),
+                            user: dict = Depends(get_current_user)):
+    """アノテーションを削除（If-Match の版番号が古ければ 409）"""
     img_dir, anno_dir = get_dirs(user)
-    json_path = anno_dir / f"{image_id}.json"
     
     try:
-        if not json_path.exists():
+        image_annotation = get_page(img_dir, anno_dir, image_id, if_match=if_match)
+        if image_annotation is None:
             raise HTTPException(status_code=404, detail="データが見つかりません")
-            
-        with open(json_path, 'r', encoding='utf-8') as f:
-            annotation_data = json.load(f)
-        
-        image_annotation = ImageAnnotation(**annotation_data)
         
         # アノテーションを削除
         image_annotation.annotations = [
@@ -631,70 +1099,51 @@ async def delete_annotation(image_id: str, annotation_id: str, user: dict = Depe
             if anno.id != annotation_id
         ]
         
-        # JSONファイルに保存
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(image_annotation.model_dump(), f, ensure_ascii=False, indent=2)
+        annotation_store.mark_dirty(anno_dir, image_id, removed=[annotation_id])
+        response.headers["ETag"] = page_etag(image_annotation)
         
         return {"message": "削除しました"}
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.put("/annotations/{image_id}/reorder")
-async def reorder_annotations(image_id: str, request: ReorderRequest, user: dict = Depends(get_current_user)):
-    """アノテーションの順番を一括更新"""
+async def reorder_annotations(image_id: str, request: ReorderRequest, response: Response,
+                              if_match: Optional[str] = Header(None), user: dict = Depends(get_current_user)):
+    """アノテーションの順番を一括更新（If-Match の版番号が古ければ 409）"""
     img_dir, anno_dir = get_dirs(user)
-    json_path = anno_dir / f"{image_id}.json"
     
     try:
-        if not json_path.exists():
+        image_annotation = get_page(img_dir, anno_dir, image_id, if_match=if_match)
+        if image_annotation is None:
             raise HTTPException(status_code=404, detail="データが見つかりません")
         
-        with open(json_path, 'r', encoding='utf-8') as f:
-            annotation_data = json.load(f)
-        
-        image_annotation = ImageAnnotation(**annotation_data)
-        
-        anno_dict = {anno.id: anno for anno in image_annotation.annotations}
-        new_annotations = []
-        for i, anno_id in enumerate(request.annotation_ids):
-            if anno_id in anno_dict:
-                anno = anno_dict[anno_id]
-                anno.order = i + 1
-                new_annotations.append(anno)
-        
-        request_ids_set = set(request.annotation_ids)
-        for anno in image_annotation.annotations:
-            if anno.id not in request_ids_set:
-                anno.order = len(new_annotations) + 1
-                new_annotations.append(anno)
-        
-        image_annotation.annotations = new_annotations
+        count = reorder_page(image_annotation, request.annotation_ids)
         
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(image_annotation.model_dump(), f, ensure_ascii=False, indent=2)
+        annotation_store.mark_dirty(anno_dir, image_id)
+        response.headers["ETag"] = page_etag(image_annotation)
         
-        return {"message": "順番を更新しました", "count": len(new_annotations)}
+        return {"message": "順番を更新しました", "count": count}
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.put("/annotations/{image_id}/{annotation_id}")
-async def update_annotation(image_id: str, annotation_id: str, updated_data: AnnotationCreate, user: dict = Depends(get_current_user)):
-    """アノテーションを更新"""
+async def update_annotation(image_id: str, annotation_id: str, updated_data: AnnotationCreate, response: Response,
+                            if_match: Optional[str] = Header(None), user: dict = Depends(get_current_user)):
+    """アノテーションを更新（If-Match の版番号が古ければ 409）"""
     img_dir, anno_dir = get_dirs(user)
-    json_path = anno_dir / f"{image_id}.json"
     
     try:
-        if not json_path.exists():
+        image_annotation = get_page(img_dir, anno_dir, image_id, if_match=if_match)
+        if image_annotation is None:
             raise HTTPException(status_code=404, detail="データが見つかりません")
-            
-        with open(json_path, 'r', encoding='utf-8') as f:
-            annotation_data = json.load(f)
-        
-        image_annotation = ImageAnnotation(**annotation_data)
         
         target_annotation = None
         for anno in image_annotation.annotations:
@@ -705,70 +1154,122 @@ async def update_annotation(image_id: str, annotation_id: str, updated_data: Ann
         if target_annotation is None:
             raise HTTPException(status_code=404, detail="アノテーションが見つかりません")
         
-        bbox_rel = absolute_to_relative(
-            updated_data.bbox_abs,
-            image_annotation.image_size.width,
-            image_annotation.image_size.height
+        set_annotation_fields(
+            image_annotation, target_annotation, updated_data,
+            ["type", "order", "bbox_abs", "text", "character_id", "subtype"]
         )
         
-        target_annotation.type = updated_data.type
-        target_annotation.order = updated_data.order
-        target_annotation.bbox_abs = updated_data.bbox_abs
-        target_annotation.bbox_rel = bbox_rel
-        target_annotation.text = updated_data.text
-        target_annotation.character_id = updated_data.character_id
-        target_annotation.subtype = updated_data.subtype
-        
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(image_annotation.model_dump(), f, ensure_ascii=False, indent=2)
+        annotation_store.mark_dirty(anno_dir, image_id, changed=[annotation_id])
+        response.headers["ETag"] = page_etag(image_annotation)
         
         return target_annotation
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.patch("/annotations/{image_id}/summary")
-async def update_page_summary(image_id: str, update: SummaryUpdate, user: dict = Depends(get_current_user)):
-    """ページ全体の状況説明を更新"""
+@app.post("/annotations/{image_id}/batch")
+async def batch_update_annotations(image_id: str, request: AnnotationBatchRequest, response: Response,
+                                   if_match: Optional[str] = Header(None), user: dict = Depends(get_current_user)):
+    """1ページへの作成・更新・削除・並び替えをまとめて適用
+
+    すべての操作が成功した場合だけ反映し（失敗したら何も変更しない）、書き出しは1回にまとまります。
+    create に ref を付けると、後の操作の annotation_id・annotation_ids でその仮IDを使えます。
+    If-Match の版番号が古ければ 409 で、何も変更しません。
+    """
     img_dir, anno_dir = get_dirs(user)
-    json_path = anno_dir / f"{image_id}.json"
     
     try:
-        annotation_data = None
-        if json_path.exists():
-            with open(json_path, 'r', encoding='utf-8') as f:
-                annotation_data = json.load(f)
+        creates = any(operation.op == "create" for operation in request.operations)
+        if creates:
+            await refresh_catalog(img_dir, image_id)
+        image_annotation = get_page(img_dir, anno_dir, image_id, create=creates, if_match=if_match)
+        if image_annotation is None:
+            raise HTTPException(status_code=404, detail="データが見つかりません")
+        
+        working, refs, changed, removed, whole_page = apply_annotation_operations(image_annotation, request.operations)
+        
+        # ストアのページに反映して書き出し対象に登録（並び替えが起きた場合はページ全体）
+        image_annotation.annotations = working.annotations
+        if whole_page:
+            annotation_store.mark_dirty(anno_dir, image_id)
         else:
-            # ファイルがない場合は初期データを作成
-            image_path = None
-            image_filename = None
-            for ext in ['.jpg', '.jpeg', '.png', '.webp']:
-                p = img_dir / f"{image_id}{ext}"
-                if p.exists():
-                    image_path = p
-                    image_filename = f"{image_id}{ext}"
-                    break
-            
-            if not image_path:
-                raise HTTPException(status_code=404, detail="画像が見つかりません")
-            
-            with Image.open(image_path) as img:
-                width, height = img.size
-                
-            annotation_data = ImageAnnotation(
-                image_id=image_id,
-                image_filename=image_filename,
-                image_size=ImageSize(width=width, height=height),
-                page_summary="",
-                annotations=[]
-            ).model_dump()
-
-        image_annotation = ImageAnnotation(**annotation_data)
+            annotation_store.mark_dirty(anno_dir, image_id, changed=changed, removed=removed)
+        response.headers["ETag"] = page_etag(image_annotation)
+        
+        return {
+            "applied": len(request.operations),
+            "created": refs,
+            "annotations": image_annotation.annotations,
+            "version": image_annotation.version
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/annotations/{image_id}/history")
+async def get_annotation_history(image_id: str, limit: int = Query(50, ge=1, le=1000), user: dict = Depends(get_current_user)):
+    """ページの編集履歴（新しい順）。保存の単位ごとに、変更・削除したアノテーションとページの項目を返す"""
+    _, anno_dir = get_dirs(user)
+    # 未書き出しの編集も履歴に含める
+    await run_in_threadpool(annotation_store.flush)
+    try:
+        records = await run_in_threadpool(get_storage(anno_dir).history, image_id, limit)
+    except NotImplementedError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "image_id": image_id,
+        "history": [{k: v for k, v in record.items() if k != "prev"} for record in records]
+    }
+
+
+@app.post("/annotations/{image_id}/undo")
+async def undo_annotation_edit(image_id: str, response: Response, if_match: Optional[str] = Header(None),
+                               user: dict = Depends(get_current_user)):
+    """まだ取り消していない最新の編集を取り消す（取り消しも履歴に残る。If-Match の版番号が古ければ 409）"""
+    _, anno_dir = get_dirs(user)
+    
+    # 未書き出しの編集を先に保存して、ストアとファイルの内容を揃える
+    # （途中で他の編集が入らないよう、ここから put までは await を挟まない）
+    current = annotation_store.get(anno_dir, image_id)
+    check_page_version(current.version if current is not None else 0, if_match)
+    annotation_store.flush()
+    try:
+        # 取り消しの記録には次の版番号を付ける（版番号は戻さない）
+        data = get_storage(anno_dir).undo(image_id, version=current.version + 1 if current is not None else None)
+    except NotImplementedError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if data is None:
+        raise HTTPException(status_code=409, detail="取り消せる編集がありません")
+    
+    page = ImageAnnotation(**data)
+    # 取り消しの記録はジャーナルに書き込み済みなので、書き出し対象にせずに反映する
+    annotation_store.put_saved(anno_dir, image_id, page)
+    response.headers["ETag"] = page_etag(page)
+    return page.model_dump()
+
+
+@app.patch("/annotations/{image_id}/summary")
+async def update_page_summary(image_id: str, update: SummaryUpdate, response: Response,
+                              if_match: Optional[str] = Header(None), user: dict = Depends(get_current_user)):
+    """ページ全体の状況説明を更新（If-Match の版番号が古ければ 409）"""
+    img_dir, anno_dir = get_dirs(user)
+    await refresh_catalog(img_dir, image_id)
+    
+    try:
+        # ファイルがない場合は初期データを作成
+        image_annotation = get_page(img_dir, anno_dir, image_id, create=True, if_match=if_match)
         image_annotation.page_summary = update.page_summary
         
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(image_annotation.model_dump(), f, ensure_ascii=False, indent=2)
+        annotation_store.mark_dirty(anno_dir, image_id, changed=[])
+        response.headers["ETag"] = page_etag(image_annotation)
         
         return {"page_summary": image_annotation.page_summary}
     
@@ -781,46 +1282,19 @@ async def update_page_summary(image_id: str, update: SummaryUpdate, user: dict =
 
 
 @app.patch("/annotations/{image_id}/status")
-async def update_completion_status(image_id: str, update: StatusUpdate, user: dict = Depends(get_current_user)):
-    """完了ステータスを更新"""
+async def update_completion_status(image_id: str, update: StatusUpdate, response: Response,
+                                   if_match: Optional[str] = Header(None), user: dict = Depends(get_current_user)):
+    """完了ステータスを更新（If-Match の版番号が古ければ 409）"""
     img_dir, anno_dir = get_dirs(user)
-    json_path = anno_dir / f"{image_id}.json"
+    await refresh_catalog(img_dir, image_id)
     
     try:
-        annotation_data = None
-        if json_path.exists():
-            with open(json_path, 'r', encoding='utf-8') as f:
-                annotation_data = json.load(f)
-        else:
-            # ファイルがない場合は初期データを作成
-            image_path = None
-            image_filename = None
-            for ext in ['.jpg', '.jpeg', '.png', '.webp']:
-                p = img_dir / f"{image_id}{ext}"
-                if p.exists():
-                    image_path = p
-                    image_filename = f"{image_id}{ext}"
-                    break
-            
-            if not image_path:
-                raise HTTPException(status_code=404, detail="画像が見つかりません")
-            
-            with Image.open(image_path) as img:
-                width, height = img.size
-                
-            annotation_data = ImageAnnotation(
-                image_id=image_id,
-                image_filename=image_filename,
-                image_size=ImageSize(width=width, height=height),
-                page_summary="",
-                annotations=[]
-            ).model_dump()
-
-        image_annotation = ImageAnnotation(**annotation_data)
+        # ファイルがない場合は初期データを作成
+        image_annotation = get_page(img_dir, anno_dir, image_id, create=True, if_match=if_match)
         image_annotation.is_completed = update.is_completed
         
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(image_annotation.model_dump(), f, ensure_ascii=False, indent=2)
+        annotation_store.mark_dirty(anno_dir, image_id, changed=[])
+        response.headers["ETag"] = page_etag(image_annotation)
         
         return {"is_completed": image_annotation.is_completed}
     
@@ -833,239 +1307,274 @@ async def update_completion_status(image_id: str, update: StatusUpdate, user: di
 
 
 @app.post("/ocr")
-async def perform_ocr(request: OCRRequest, user: dict = Depends(get_current_user)):
+async def perform_ocr(request: OCRRequest, http_request: Request, user: dict = Depends(get_current_user)):
     """指定された範囲の画像を切り抜いてOCRを実行"""
     img_dir, _ = get_dirs(user)
     try:
         image_id = request.image_id
         
-        image_path = None
-        for ext in ['.jpg', '.jpeg', '.png', '.webp']:
-            p = img_dir / f"{image_id}{ext}"
-            if p.exists():
-                image_path = p
-                break
+        async def recognize():
+            # デコード・切り抜きと推論はイベントループの外で行う
+            crop_img = await run_in_threadpool(crop_page_image, img_dir, image_id, request.bbox_abs, OCR_INPUT_SIZE)
+            # 同じ推論を待つ呼び出し元で共有するので、ここでは打ち切らない
+            # （待ち時間の上限は get_or_compute の timeout で呼び出し元ごとにかける）
+            return await ocr_batcher.infer(crop_img, timeout=None)
         
-        if not image_path:
-            raise HTTPException(status_code=404, detail="画像が見つかりません")
+        # 同じ画像の同じ範囲の結果があれば再利用（同時に来た同じリクエストは1回の推論を共有）
+        content_hash = await run_in_threadpool(page_content_hash, img_dir, image_id)
+        key = None
+        if content_hash is not None:
+            key = result_key(content_hash, request.bbox_abs, "ocr", ("manga-ocr",), OCR_PREPROCESS_VERSION)
+        text = await result_cache.get_or_compute(key, recognize, request=http_request, timeout=INFERENCE_TIMEOUT)
         
-        with Image.open(image_path) as img:
-            left = request.bbox_abs.x
-            top = request.bbox_abs.y
-            right = left + request.bbox_abs.width
-            bottom = top + request.bbox_abs.height
-            
-            crop_img = img.crop((left, top, right, bottom))
-            
-            ocr_engine = get_mocr()
-            text = ocr_engine(crop_img)
-            
-            return {"text": text}
-            
+        return {"text": text}
+        
+    except HTTPException:
+        raise
+    except InferenceTimeout:
+        raise HTTPException(status_code=504, detail="OCRがタイムアウトしました")
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client disconnected")
     except Exception as e:
         print(f"OCR Error: {e}")
         raise HTTPException(status_code=500, detail=f"OCR実行中にエラーが発生しました: {str(e)}")
 
 
+@app.post("/annotations/{image_id}/ocr")
+async def perform_page_ocr(image_id: str, request: PageOCRRequest, http_request: Request, user: dict = Depends(get_current_user)):
+    """ページ内のテキスト系アノテーションをまとめてOCR
+
+    ページのデコードは1回、推論は OCR_MAX_BATCH 件ずつのバッチで行います。
+    write_back=True なら認識結果を各アノテーションの text に書き戻します。
+    """
+    img_dir, anno_dir = get_dirs(user)
+    try:
+        image_annotation = get_page(img_dir, anno_dir, image_id)
+        if image_annotation is None:
+            raise HTTPException(status_code=404, detail="データが見つかりません")
+        
+        types = set(request.types or TEXT_ANNOTATION_TYPES)
+        wanted = set(request.annotation_ids) if request.annotation_ids is not None else None
+        targets = [
+            anno for anno in image_annotation.annotations
+            if anno.type in types and (wanted is None or anno.id in wanted)
+        ]
+        if not targets:
+            return {"image_id": image_id, "results": [], "written": 0}
+        
+        crops = await run_in_threadpool(crop_page_regions, img_dir, image_id, [anno.bbox_abs for anno in targets], OCR_INPUT_SIZE)
+        texts = await run_inference(ocr_batch_task, crops, request=http_request)
+        
+        results = [
+            {"annotation_id": anno.id, "type": anno.type, "text": text}
+            for anno, text in zip(targets, texts)
+        ]
+        
+        written = []
+        if request.write_back:
+            # 推論中に編集・削除されている可能性があるので、現在のページから引き直す
+            image_annotation = get_page(img_dir, anno_dir, image_id)
+            by_id = {anno.id: anno for anno in image_annotation.annotations} if image_annotation else {}
+            for result in results:
+                anno = by_id.get(result["annotation_id"])
+                if anno is not None:
+                    anno.text = result["text"]
+                    written.append(anno.id)
+            if written:
+                annotation_store.mark_dirty(anno_dir, image_id, changed=written)
+        
+        return {"image_id": image_id, "results": results, "written": len(written)}
+    
+    except HTTPException:
+        raise
+    except InferenceTimeout:
+        raise HTTPException(status_code=504, detail="OCRがタイムアウトしました")
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"OCR実行中にエラーが発生しました: {str(e)}")
+
+
+# --- バックグラウンドジョブ ---
+
+@app.post("/jobs")
+async def submit_job(request: JobCreate, user: dict = Depends(get_current_user)):
+    """全ページ（または指定ページ）の対象アノテーションを自動タグ付け・自動OCRするジョブを登録"""
+    img_dir, anno_dir = get_dirs(user)
+    if user["role"] == "guest":
+        raise HTTPException(status_code=403, detail="ゲストはジョブを実行できません")
+    
+    params = {
+        "types": request.types,
+        "image_ids": request.image_ids,
+        "only_empty": request.only_empty,
+        "batch_size": request.batch_size,
+    }
+    if request.kind == "tagger":
+        # 実行中に設定が変わっても結果が揃うよう、登録時の設定を固定する
+        params["tagger_model"] = TAGGER_SETTINGS["tagger_model"]
+        params["tagger_backend"] = list(tagger_backend_spec(TAGGER_SETTINGS))
+        params["threshold"] = request.threshold if request.threshold is not None else TAGGER_SETTINGS["tagger_threshold"]
+        params["excluded_tags"] = TAGGER_SETTINGS.get("excluded_tags", [])
+    return job_manager.submit(img_dir, anno_dir, request.kind, params)
+
+
+@app.get("/jobs")
+async def list_jobs(user: dict = Depends(get_current_user)):
+    """ジョブ一覧（新しい順）"""
+    _, anno_dir = get_dirs(user)
+    return {"jobs": job_manager.list(anno_dir)}
+
+
+def find_job(job_id: str, user: dict):
+    _, anno_dir = get_dirs(user)
+    job = job_manager.get(job_id, anno_dir)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, user: dict = Depends(get_current_user)):
+    """ジョブの状態・進捗・スループット (boxes_per_sec)・ETA (eta_sec)"""
+    return find_job(job_id, user).to_dict()
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str, user: dict = Depends(get_current_user)):
+    """ジョブを中止（実行中ならページの区切りで止まる）"""
+    return job_manager.cancel(find_job(job_id, user))
+
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str, user: dict = Depends(get_current_user)):
+    """中止・失敗したジョブをチェックポイントから再開"""
+    return job_manager.resume(find_job(job_id, user))
+
+
+def tagger_result_key(content_hash: Optional[str], bbox_abs: BoundingBoxAbs, model_id: str, backend: tuple):
+    """切り抜きモードのタグ付け結果のキャッシュキー（内容ハッシュがなければ None）"""
+    if content_hash is None:
+        return None
+    # スレッド数は結果に影響しないのでキーに含めない
+    return result_key(content_hash, bbox_abs, "tagger", (model_id,) + backend[:2], TAGGER_PREPROCESS_VERSION)
+
+
 @app.post("/tagger")
-async def perform_tagger(request: TaggerRequest, user: dict = Depends(get_current_user)):
+async def perform_tagger(request: TaggerRequest, http_request: Request, user: dict = Depends(get_current_user)):
     """指定された範囲の画像を切り抜いてWD Taggerでタグ付け"""
     img_dir, _ = get_dirs(user)
     try:
-        import torch
-        
         image_id = request.image_id
+        # リクエストでモデルが指定されていなければ設定のモデルを使う
+        model_id = request.tagger_model or TAGGER_SETTINGS["tagger_model"]
         
-        image_path = None
-        for ext in ['.jpg', '.jpeg', '.png', '.webp']:
-            p = img_dir / f"{image_id}{ext}"
-            if p.exists():
-                image_path = p
-                break
-        
-        if not image_path:
-            raise HTTPException(status_code=404, detail="画像が見つかりません")
-        
-        with Image.open(image_path) as img:
-            # RGB以外のモードをRGBに変換（RGBA、グレースケールなど）
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            
-            left = request.bbox_abs.x
-            top = request.bbox_abs.y
-            right = left + request.bbox_abs.width
-            bottom = top + request.bbox_abs.height
-            
-            crop_img = img.crop((left, top, right, bottom))
+        def crop_and_save_debug():
+            # キャッシュのページ画像は RGB に変換済み
+            crop_img = crop_page_image(img_dir, image_id, request.bbox_abs, TAGGER_INPUT_SIZE)
             
             # デバッグ: 切り取った画像を保存（色合い確認用）
             debug_dir = Path(__file__).parent / "debug_crops"
             debug_dir.mkdir(exist_ok=True)
             crop_img.save(debug_dir / f"{image_id}_crop.png")
+            return crop_img
+        
+        backend = tagger_backend_spec(TAGGER_SETTINGS)
+        
+        async def tag():
+            # デコード・切り抜きと推論はイベントループの外で行う
+            crop_img = await run_in_threadpool(crop_and_save_debug)
+            # Tagger実行（同時に来たリクエストとまとめて推論される）
+            # 待ち時間の上限は get_or_compute の timeout で呼び出し元ごとにかける
+            return await tagger_batcher.infer(crop_img, model_id, backend, timeout=None)
+        
+        # 閾値・除外タグを適用する前の確率をキャッシュするので、設定を変えても再推論しない
+        content_hash = await run_in_threadpool(page_content_hash, img_dir, image_id)
+        key = tagger_result_key(content_hash, request.bbox_abs, model_id, backend)
+        probs = await result_cache.get_or_compute(key, tag, request=http_request, timeout=INFERENCE_TIMEOUT)
+        tag_table = await run_in_threadpool(load_tag_table, model_id, TAGGER_SETTINGS.get("excluded_tags", []))
+        
+        # リクエストの閾値でフィルタしてタグ取得（デフォルトは設定値）
+        threshold = request.threshold if request.threshold is not None else TAGGER_SETTINGS["tagger_threshold"]
+        tag_text, tags_response = tag_table.select(probs, threshold, annotation_type=request.annotation_type)
+        
+        return {
+            "text": tag_text,
+            "tags": tags_response
+        }
+        
+    except HTTPException:
+        raise
+    except InferenceTimeout:
+        raise HTTPException(status_code=504, detail="Taggerがタイムアウトしました")
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Tagger Error: {e}")
+        raise HTTPException(status_code=500, detail=f"Tagger実行中にエラーが発生しました: {str(e)}")
+
+
+@app.post("/tagger/batch")
+async def perform_tagger_batch(request: TaggerBatchRequest, http_request: Request, user: dict = Depends(get_current_user)):
+    """1ページ内の複数ボックスをまとめてタグ付け
+
+    mode="crop"（既定）は /tagger と同じ結果で、ボックスはまとめて推論され結果キャッシュも共有します。
+    mode="roi" はページを1回だけバックボーンに通す高速モードです（PyTorch バックエンドのみ。
+    切り抜きモードとの一致率を region_tagger.py compare で確認し、REGION_TAGGER_ENABLED=1 で有効にします）。
+    """
+    img_dir, _ = get_dirs(user)
+    image_id = request.image_id
+    model_id = request.tagger_model or TAGGER_SETTINGS["tagger_model"]
+    backend = tagger_backend_spec(TAGGER_SETTINGS)
+    try:
+        if request.mode == "roi":
+            if not REGION_TAGGER_ENABLED:
+                raise HTTPException(status_code=400, detail="ROIモードは無効です（REGION_TAGGER_ENABLED=1 で有効にします）")
+            if backend[0] != "torch":
+                raise HTTPException(status_code=400, detail="ROIモードはPyTorchバックエンドでのみ使用できます")
+            page_img, boxes = await run_in_threadpool(
+                load_region_page, img_dir, image_id, [b.bbox_abs for b in request.boxes]
+            )
+            probs = await run_inference(region_tagger_task, model_id, page_img, boxes, request=http_request)
+        else:
+            content_hash = await run_in_threadpool(page_content_hash, img_dir, image_id)
             
-            # Tagger実行
-            model, transform, labels, categories, orig_labels = get_tagger()
-            
-            # 前処理
-            input_tensor = transform(crop_img).unsqueeze(0)
-            if torch.cuda.is_available():
-                input_tensor = input_tensor.cuda()
-            
-            # 推論
-            with torch.no_grad():
-                outputs = model(input_tensor)
-                probs = torch.sigmoid(outputs).cpu().numpy()[0]
-            
-            # リクエストの閾値でフィルタしてタグ取得（デフォルトは設定値）
-            threshold = request.threshold if request.threshold is not None else TAGGER_SETTINGS["tagger_threshold"]
-            excluded_tags = [t.lower() for t in TAGGER_SETTINGS.get("excluded_tags", [])]
-            
-            # 表情関連タグのホワイトリストパターン (faceタイプ用)
-            # Danbooruの表情・顔パーツタグリストに基づく
-            expression_patterns = [
-                # 1. 感情・表情 (Emotions & Expressions)
-                # ポジティブ
-                'smile', 'grin', 'laughing', 'happy', 'smug', 'doyagao', 'gentle_smile', 'excited', 'triumphant',
-                # ネガティブ
-                'angry', 'annoyed', 'frown', 'sad', 'crying', 'sobbing', 'tears', 'streaming_tears',
-                'scared', 'terror', 'screaming', 'nervous', 'worried', 'depressed', 'gloom', 'despair',
-                'serious', 'glare', 'scorn', 'disgust', 'pain',
-                # ニュートラル・その他
-                'expressionless', 'blank_stare', 'bored', 'sleepy', 'confused', 'surprised', 'shy',
-                'embarrassed', 'flustered', 'drunk', 'crazy', 'insane', 'aroused', 'ahegao', 'torogao',
-                'yandere', 'tsundere', 'kuudere',
-                
-                # 2. 顔の状態・漫符 (Face States & Effects)
-                # 顔色・演出
-                'blush', 'heavy_blush', 'light_blush', 'blush_stickers', 'blue_face', 'turned_pale',
-                'shadowed_face', 'blood_on_face',
-                # 漫符・記号
-                'sweat', 'sweatdrop', 'flying_sweatdrops', 'anger_vein', 'popping_vein',
-                'gloom_(expression)', 'sparkles', 'breath_puff', 'nose_bubble',
-                # 分泌物・その他
-                'drooling', 'saliva', 'nosebleed', 'tear_drop', 'bags_under_eyes',
-                'cheek_press', 'makeup', 'facepaint',
-                
-                # 3. 目の状態 (Eye States)
-                # 開閉・形状
-                'closed_eyes', 'half-closed_eyes', 'squinting', 'narrowed_eyes', 'wide_eyed', 'wink',
-                'one_eye_closed', 'forced_shut_eyes', 'tsurime', 'tareme', 'jitome', 'sanpaku',
-                # 瞳孔・ハイライト
-                'empty_eyes', 'hollow_eyes', 'button_eyes', 'constricted_pupils', 'dilated_pupils',
-                'slit_pupils', 'heart-shaped_pupils', 'star-shaped_pupils', 'symbol-shaped_pupils',
-                'mismatched_pupils', 'heterochromia', 'rolling_eyes', 'cross-eyed', 'no_pupils',
-                # 視線
-                'looking_at_viewer', 'looking_away', 'looking_back', 'looking_down', 'looking_up',
-                'looking_to_the_side', 'eye_contact',
-                
-                # 4. 口の状態 (Mouth States)
-                # 開閉・基本
-                'open_mouth', 'closed_mouth', 'parted_lips', 'wide_mouth', 'pout', 'puffy_cheeks',
-                'grimace', 'lip_biting', 'holding_breath',
-                # 歯・舌
-                'clenched_teeth', 'showing_teeth', 'skin_fang', 'fang', 'sharp_teeth', 'shark_teeth',
-                'buck_teeth', 'tongue', 'tongue_out', 'licking_lips', 'forked_tongue',
-                # 形状・記号
-                'cat_mouth', ':3', 'triangle_mouth', 'wavy_mouth', 'dot_mouth', 'shark_mouth',
-                
-                # 5. 顔文字・アスキーアートタグ (Kaomoji)
-                '^_^', '>_<', '@_@', '+_+', '=_=', 'o_o', '3_3', ';)', ':d', ':p', ':o',
-
-                # 6. 性的な表情・状態 (NSFW / Sexual Expressions & States)
-                'ahegao', 'torogao', 'orgasm_face', 'ecstasy', 'aroused',
-                'cum_on_face', 'ejaculated_on_face', 'cum_in_mouth', 'cum_on_tongue', 'facial', 'bukkake',
-                'cum_strings', 'cum_drip', 'saliva_strings',
-                'fellatio', 'deep_throat', 'blowjob', 'oral',
-                'gag', 'gagged', 'bit_gag', 'ball_gag', 'cleave_gag', 'ring_gag', 'spider_gag', 'tape_gag', 'hair_gag',
-                'collar', 'leash', 'neck_bell', 'neck_bolt', 'blindfold', 'eye_mask', 'nose_hook', 'mouth_mask',
-                'nuzzle', 'kiss', 'kissing', 'hickey', 'neck_kiss', 'cum_in_eye', 'cum_on_hair',
-            ]
-            
-            def is_expression_tag(tag_name):
-                tag_lower = tag_name.lower()
-                return any(pattern in tag_lower for pattern in expression_patterns)
-            
-            raw_tags = []
-            for i, prob in enumerate(probs):
-                if prob >= threshold:
-                    tag_name = labels[i]
-                    # フィルタリング判定には元の英名を使用する（あれば）
-                    filtering_name = orig_labels[i] if orig_labels else tag_name
-                    category = categories[i] if categories else 0
-                    
-                    # 除外タグリストにあるかチェック
-                    if filtering_name.lower() in excluded_tags or tag_name.lower() in excluded_tags:
-                        continue
-
-                    # キャラクタータグ（カテゴリ4）を除外
-                    if category == 4:
-                        continue
-                    
-                    # faceタイプの場合：表情関連タグのみ許可（ホワイトリスト方式）
-                    if request.annotation_type == 'face':
-                        if not is_expression_tag(filtering_name):
-                            continue
-            
-                    raw_tags.append({
-                        "tag": tag_name, # 表示・保存用（日本語または元の名前）
-                        "confidence": float(prob),
-                        "category": category,
-                        "orig_tag": filtering_name # 内部参照用（英名）
-                    })
-            
-            # ソートロジック
-            # 1. カテゴリ9 (Rating: general/sensitive) を最優先
-            # 2. 1girl/solo/monochrome などの基本構造タグ (Generalカテゴリだが重要)
-            # 3. その他は信頼度順
-            
-            priority_tags = {'1girl', '1boy', 'solo', 'monochrome', 'greyscale'}
-            
-            def sort_key(x):
-                # Rating category (9) is usually highest priority for "Large tags"
-                is_rating = (x["category"] == 9)
-                # orig_tag（英名）で判定する
-                is_priority = (x.get("orig_tag", x["tag"]) in priority_tags)
-                
-                # キーのタプルを作成 (Rating優先, Priority優先, その後信頼度)
-                # Trueは1, Falseは0なので、降順(-1)にするには注意
-                # sortは昇順なので、優先したいものを小さくする
-                
-                k1 = 0 if is_rating else 1
-                k2 = 0 if is_priority else 1
-                k3 = -x["confidence"] # 信頼度が高い順
-                
-                return (k1, k2, k3)
-
-            raw_tags.sort(key=sort_key)
-            
-            # 重複タグの排除（同じ日本語名のタグは、信頼度が高い方のみ残す）
-            seen_tags = {}
-            deduplicated_tags = []
-            for t in raw_tags:
-                tag_name = t["tag"]
-                if tag_name not in seen_tags:
-                    seen_tags[tag_name] = t
-                    deduplicated_tags.append(t)
-                else:
-                    # 既に存在する場合、信頼度が高い方を保持
-                    if t["confidence"] > seen_tags[tag_name]["confidence"]:
-                        # 既存のものを削除して新しいものを追加
-                        deduplicated_tags.remove(seen_tags[tag_name])
-                        seen_tags[tag_name] = t
-                        deduplicated_tags.append(t)
-            
-            # タグ名をカンマ区切りで結合（text用）
-            tag_text = ", ".join([t["tag"] for t in deduplicated_tags])
-            
-            # レスポンス用には不要なフィールドを除く（必要なら）
-            # ここではそのまま返す
-            tags_response = [{"tag": t["tag"], "confidence": t["confidence"]} for t in deduplicated_tags]
-            
-            return {
-                "text": tag_text,
-                "tags": tags_response
-            }
+            async def tag(bbox_abs: BoundingBoxAbs):
+                crop_img = await run_in_threadpool(crop_page_image, img_dir, image_id, bbox_abs, TAGGER_INPUT_SIZE)
+                # 待ち時間の上限は get_or_compute の timeout で呼び出し元ごとにかける
+                return await tagger_batcher.infer(crop_img, model_id, backend, timeout=None)
             
+            # ボックスごとにキャッシュを引き、残りは同じバッチにまとめて推論される
+            probs = await asyncio.gather(*[
+                result_cache.get_or_compute(
+                    tagger_result_key(content_hash, box.bbox_abs, model_id, backend),
+                    lambda bbox_abs=box.bbox_abs: tag(bbox_abs),
+                    request=http_request,
+                    timeout=INFERENCE_TIMEOUT
+                )
+                for box in request.boxes
+            ])
+        
+        tag_table = await run_in_threadpool(load_tag_table, model_id, TAGGER_SETTINGS.get("excluded_tags", []))
+        threshold = request.threshold if request.threshold is not None else TAGGER_SETTINGS["tagger_threshold"]
+        results = []
+        for box, row in zip(request.boxes, probs):
+            tag_text, tags_response = tag_table.select(row, threshold, annotation_type=box.annotation_type)
+            results.append({"text": tag_text, "tags": tags_response})
+        return {"mode": request.mode, "results": results}
+        
+    except HTTPException:
+        raise
+    except RegionTaggerUnsupported as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except InferenceTimeout:
+        raise HTTPException(status_code=504, detail="Taggerがタイムアウトしました")
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client disconnected")
     except Exception as e:
         import traceback
         traceback.print_exc()
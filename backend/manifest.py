@@ -0,0 +1,350 @@
+import base64
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from storage import get_storage
+from utils import state_path, atomic_write_text
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# 永続化ファイルへの書き出し待ち時間（秒）
+MANIFEST_SAVE_DELAY = float(os.environ.get("MANIFEST_SAVE_DELAY", "5.0"))
+# ディレクトリの mtime だけでは拾えない変更に備えた全件チェックの間隔（秒）
+MANIFEST_FULL_CHECK_INTERVAL = float(os.environ.get("MANIFEST_FULL_CHECK_INTERVAL", "300"))
+
+MANIFEST_VERSION = 2
+
+SORT_KEYS = ("id", "last_modified", "annotation_count")
+
+
+def id_sort_key(image_id: str) -> tuple:
+    """数値IDは数値順、それ以外は文字列順（数値IDを先に並べる）"""
+    if image_id.isdigit():
+        return (0, int(image_id), image_id)
+    return (1, 0, image_id)
+
+
+def encode_cursor(value, image_id: str) -> str:
+    raw = json.dumps([value, image_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[object, str]:
+    """カーソルを (ソート値, image_id) に戻す。不正なら ValueError"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value, image_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(image_id, str):
+        raise ValueError("invalid cursor")
+    return value, image_id
+
+
+def _dir_mtime(path: Path):
+    try:
+        return Path(path).stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+class ImageManifest:
+    """/annotations-list 用の画像一覧インデックス
+
+    画像ごとに has_annotation / is_completed / annotation_count / last_modified を
+    メモリに保持し、data/.state/{アノテーションディレクトリ名}.manifest.json に永続化します。
+    アップロード・編集時には差分で更新し、外部での変更はディレクトリの mtime
+    （SQLite では更新時刻）の変化を見て、変わったページだけを読み直します。
+    """
+
+    def __init__(self, img_dir: Path, anno_dir: Path):
+        self.img_dir = Path(img_dir)
+        self.anno_dir = Path(anno_dir)
+        self.storage = get_storage(self.anno_dir)
+        self.path = state_path(self.anno_dir, "manifest.json")
+        self._lock = threading.RLock()
+        self._images: Dict[str, int] = {}   # image_id -> 画像ファイルの mtime_ns
+        self._pages: Dict[str, dict] = {}   # image_id -> storage.page_summary() + stamp
+        self._pending = set()               # メモリ上で編集済み・未書き出しのページ
+        self._sorted_ids = None
+        self._img_token = None
+        self._anno_token = None
+        self._last_full_check = 0.0
+        self._save_timer = None
+        self._load()
+
+    # --- 永続化 ---
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") != MANIFEST_VERSION:
+                return
+            self._images = data["images"]
+            self._pages = data["pages"]
+            self._img_token = data.get("img_token")
+            self._anno_token = data.get("anno_token")
+            self._last_full_check = time.monotonic()
+        except Exception as e:
+            print(f"Manifest load failed, rebuilding: {e}")
+            self._images, self._pages = {}, {}
+
+    def _schedule_save(self):
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(MANIFEST_SAVE_DELAY, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def save(self):
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            text = json.dumps({
+                "version": MANIFEST_VERSION,
+                "img_token": self._img_token,
+                "anno_token": self._anno_token,
+                "images": self._images,
+                "pages": self._pages,
+            }, ensure_ascii=False)
+        try:
+            atomic_write_text(self.path, text)
+        except Exception as e:
+            print(f"Manifest save failed: {e}")
+
+    # --- 再検証 ---
+
+    def revalidate(self, force: bool = False):
+        """ディレクトリの変更を検出して、変わった部分だけを取り込む"""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_full_check > MANIFEST_FULL_CHECK_INTERVAL:
+                force = True
+            changed = False
+
+            img_token = _dir_mtime(self.img_dir)
+            if force or img_token != self._img_token:
+                self._rescan_images()
+                self._img_token = img_token
+                changed = True
+
+            anno_token = self.storage.change_token()
+            if force or anno_token != self._anno_token:
+                self._rescan_pages()
+                self._anno_token = anno_token
+                changed = True
+
+            if force:
+                self._last_full_check = now
+            if changed:
+                self._schedule_save()
+
+    def _rescan_images(self):
+        images = {}
+        if self.img_dir.exists():
+            with os.scandir(self.img_dir) as it:
+                for entry in it:
+                    stem, ext = os.path.splitext(entry.name)
+                    if ext.lower() in IMAGE_EXTENSIONS:
+                        try:
+                            images[stem] = entry.stat().st_mtime_ns
+                        except OSError:
+                            continue
+        if images.keys() != self._images.keys():
+            self._sorted_ids = None
+        self._images = images
+
+    def _rescan_pages(self):
+        stats = self.storage.page_stats()
+        stale = [
+            image_id for image_id, stamp in stats.items()
+            if image_id not in self._pending
+            and (image_id not in self._pages or self._pages[image_id].get("stamp") != stamp)
+        ]
+        for image_id in list(self._pages):
+            if image_id not in stats and image_id not in self._pending:
+                del self._pages[image_id]
+        if stale:
+            self._pages.update(self.storage.page_summaries(stale))
+
+    # --- 差分更新 ---
+
+    def page_changed(self, image_id: str, page):
+        """ストアで編集されたページを反映（書き出し前でも一覧に出す）"""
+        with self._lock:
+            entry = self._pages.setdefault(image_id, {})
+            entry["is_completed"] = page.is_completed
+            entry["annotation_count"] = len(page.annotations)
+            entry["types"] = sorted({a.type for a in page.annotations})
+            entry["character_ids"] = sorted({a.character_id for a in page.annotations if a.character_id})
+            entry["modified_ns"] = time.time_ns()
+            self._pending.add(image_id)
+            self._schedule_save()
+
+    def page_flushed(self, image_id: str, stamp):
+        """自分で書き出したページの stamp を記録し、ディレクトリの変化を再スキャンしない"""
+        with self._lock:
+            in_sync = self._anno_token is not None
+            entry = self._pages.get(image_id)
+            if entry is not None and image_id in self._pending:
+                entry["stamp"] = stamp
+                entry.pop("modified_ns", None)
+            self._pending.discard(image_id)
+            if in_sync:
+                self._anno_token = self.storage.change_token()
+            self._schedule_save()
+
+    def image_added(self, image_id: str, image_path: Path):
+        """アップロードされた画像を反映"""
+        with self._lock:
+            in_sync = self._img_token is not None
+            try:
+                self._images[image_id] = image_path.stat().st_mtime_ns
+            except OSError:
+                return
+            self._sorted_ids = None
+            if in_sync:
+                self._img_token = _dir_mtime(self.img_dir)
+            self._schedule_save()
+
+    # --- 参照 ---
+
+    def entry(self, image_id: str) -> Optional[dict]:
+        with self._lock:
+            if image_id not in self._images:
+                return None
+            return self._entry(image_id)
+
+    def _entry(self, image_id: str) -> dict:
+        page = self._pages.get(image_id)
+        if page is None:
+            return {
+                "id": image_id,
+                "has_annotation": False,
+                "is_completed": False,
+                "annotation_count": 0,
+                "last_modified": self._images[image_id] / 1e9,
+            }
+        modified_ns = page.get("modified_ns") or page.get("stamp") or self._images[image_id]
+        return {
+            "id": image_id,
+            "has_annotation": True,
+            "is_completed": page.get("is_completed", False),
+            "annotation_count": page.get("annotation_count", 0),
+            "last_modified": modified_ns / 1e9,
+        }
+
+    def entries(self) -> list:
+        """ID順の一覧"""
+        self.revalidate()
+        with self._lock:
+            if self._sorted_ids is None:
+                self._sorted_ids = sorted(self._images, key=id_sort_key)
+            return [self._entry(image_id) for image_id in self._sorted_ids]
+
+    def query(self, is_completed: Optional[bool] = None, has_annotation: Optional[bool] = None,
+              annotation_type: Optional[str] = None, character_id: Optional[str] = None,
+              id_from: Optional[str] = None, id_to: Optional[str] = None,
+              sort: str = "id", descending: bool = False,
+              cursor: Optional[str] = None, limit: Optional[int] = None) -> Tuple[List[dict], Optional[str], int]:
+        """絞り込み・並び替え・カーソルページングした一覧を返す
+
+        戻り値は (ページ内の一覧, 次ページのカーソル, 絞り込み後の総件数)。
+        カーソルは直前ページ末尾の (ソート値, id) で、途中で画像が増減してもずれません。
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"unknown sort key: {sort}")
+        after = decode_cursor(cursor) if cursor else None
+        lower = id_sort_key(id_from) if id_from else None
+        upper = id_sort_key(id_to) if id_to else None
+
+        entries = self.entries()
+        with self._lock:
+            selected = []
+            for entry in entries:
+                image_id = entry["id"]
+                if lower is not None and id_sort_key(image_id) < lower:
+                    continue
+                if upper is not None and id_sort_key(image_id) > upper:
+                    continue
+                if is_completed is not None and entry["is_completed"] != is_completed:
+                    continue
+                if has_annotation is not None and entry["has_annotation"] != has_annotation:
+                    continue
+                if annotation_type or character_id:
+                    page = self._pages.get(image_id) or {}
+                    if annotation_type and annotation_type not in page.get("types", ()):
+                        continue
+                    if character_id and character_id not in page.get("character_ids", ()):
+                        continue
+                selected.append(entry)
+
+        if sort == "id":
+            key = lambda e: id_sort_key(e["id"])
+        else:
+            key = lambda e: (e[sort], id_sort_key(e["id"]))
+        if sort != "id" or descending:
+            selected.sort(key=key, reverse=descending)
+
+        start = 0
+        if after is not None:
+            value, after_id = after
+            after_key = id_sort_key(after_id) if sort == "id" else (value, id_sort_key(after_id))
+            for start, entry in enumerate(selected):
+                k = key(entry)
+                if (k < after_key) if descending else (k > after_key):
+                    break
+            else:
+                start = len(selected)
+
+        end = len(selected) if limit is None else start + limit
+        page = selected[start:end]
+        next_cursor = None
+        if end < len(selected) and page:
+            last = page[-1]
+            next_cursor = encode_cursor(last["id"] if sort == "id" else last[sort], last["id"])
+        return page, next_cursor, len(selected)
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(img_dir: Path, anno_dir: Path) -> ImageManifest:
+    """アノテーションディレクトリごとのマニフェストを返す"""
+    key = str(Path(anno_dir))
+    with _manifests_lock:
+        manifest = _manifests.get(key)
+        if manifest is None:
+            manifest = ImageManifest(img_dir, anno_dir)
+            _manifests[key] = manifest
+        return manifest
+
+
+def on_page_changed(anno_dir: Path, image_id: str, page):
+    """AnnotationStore の変更リスナー"""
+    manifest = _manifests.get(str(Path(anno_dir)))
+    if manifest is not None:
+        manifest.page_changed(image_id, page)
+
+
+def on_page_flushed(anno_dir: Path, image_id: str, stamp):
+    """AnnotationStore の書き出しリスナー"""
+    manifest = _manifests.get(str(Path(anno_dir)))
+    if manifest is not None:
+        manifest.page_flushed(image_id, stamp)
+
+
+def save_all():
+    """すべてのマニフェストを書き出す（シャットダウン時）"""
+    with _manifests_lock:
+        manifests = list(_manifests.values())
+    for manifest in manifests:
+        manifest.save()
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional, List, Literal
 
 
@@ -44,6 +44,7 @@ class ImageAnnotation(BaseModel):
     page_summary: Optional[str] = None
     is_completed: bool = False  # 作業完了フラグ
     annotations: List[Annotation] = []
+    version: int = 0  # 編集のたびに増える版番号（差分同期と If-Match に使う）
 
 
 class AnnotationCreate(BaseModel):
@@ -83,12 +84,53 @@ class OCRRequest(BaseModel):
     bbox_abs: BoundingBoxAbs
 
 
+# OCR の対象になるテキスト系のアノテーションタイプ
+TEXT_ANNOTATION_TYPES = ["dialogue", "monologue", "whisper", "narration", "ruby", "sound_effect", "title", "footnote"]
+
+
+class PageOCRRequest(BaseModel):
+    """ページ内のテキスト系アノテーションを一括OCRするためのリクエストモデル"""
+    types: Optional[List[str]] = None  # 省略時は TEXT_ANNOTATION_TYPES
+    annotation_ids: Optional[List[str]] = None  # 指定時はこのIDのみ
+    write_back: bool = False  # True なら認識結果を text に書き戻す
+
+
+class JobCreate(BaseModel):
+    """自動タグ付け・自動OCRジョブ作成用のリクエストモデル"""
+    kind: Literal["tagger", "ocr"]
+    types: Optional[List[str]] = None  # 省略時は tagger: person/face、ocr: テキスト系
+    image_ids: Optional[List[str]] = None  # 省略時は全ページ
+    only_empty: bool = True  # text が空のアノテーションだけを対象にする
+    threshold: Optional[float] = None  # tagger のみ。省略時は設定値
+    batch_size: int = Field(16, ge=1, le=256)
+
+
 class TaggerRequest(BaseModel):
     """Tagger実行用のリクエストモデル"""
     image_id: str
     bbox_abs: BoundingBoxAbs
     threshold: Optional[float] = 0.6  # デフォルト0.6
     annotation_type: Optional[str] = None  # アノテーションタイプ (face, person, etc.)
+    tagger_model: Optional[str] = None  # 使うモデル（省略時は設定のモデル）
+
+
+class TaggerBox(BaseModel):
+    """ページ単位のタグ付けの対象ボックス"""
+    bbox_abs: BoundingBoxAbs
+    annotation_type: Optional[str] = None
+
+
+class TaggerBatchRequest(BaseModel):
+    """1ページ内の複数ボックスをまとめてタグ付けするリクエストモデル
+
+    mode="crop" は /tagger と同じくボックスごとに切り抜いて推論、
+    mode="roi" はページを1回だけバックボーンに通して各ボックスを特徴マップ上でプーリング（PyTorch のみ）
+    """
+    image_id: str
+    boxes: List[TaggerBox] = Field(..., min_length=1, max_length=256)
+    threshold: Optional[float] = None  # 省略時は設定値
+    tagger_model: Optional[str] = None  # 省略時は設定のモデル
+    mode: Literal["crop", "roi"] = "crop"
 
 
 class ReorderRequest(BaseModel):
@@ -96,6 +138,26 @@ class ReorderRequest(BaseModel):
     annotation_ids: List[str]
 
 
+class AnnotationOperation(BaseModel):
+    """一括編集の1操作
+
+    create: data（type, bbox_abs, text は必須）から作成。ref を付けると後の操作の annotation_id に使える
+    update: annotation_id のアノテーションの data に含まれる項目だけを更新
+    delete: annotation_id のアノテーションを削除
+    reorder: annotation_ids の順に order を1から振り直す（含まれないものは末尾）
+    """
+    op: Literal["create", "update", "delete", "reorder"]
+    annotation_id: Optional[str] = None
+    ref: Optional[str] = None  # create のみ。クライアント側の仮ID
+    data: Optional[AnnotationUpdate] = None
+    annotation_ids: Optional[List[str]] = None  # reorder のみ
+
+
+class AnnotationBatchRequest(BaseModel):
+    """1ページへの複数の編集をまとめて適用するリクエストモデル（すべて成功するか、何も変更しない）"""
+    operations: List[AnnotationOperation] = Field(..., min_length=1, max_length=1000)
+
+
 class SummaryUpdate(BaseModel):
     """ページサマリー更新用のリクエストモデル"""
     page_summary: str
@@ -106,3 +168,7 @@ class TaggerSettings(BaseModel):
     tagger_model: str
     tagger_threshold: float
     excluded_tags: List[str]
+    tagger_backend: Literal["torch", "onnxruntime"] = "torch"
+    onnx_quantized: bool = False  # onnx_tagger.py quantize で作成した int8 モデルを使う
+    onnx_intra_op_threads: int = Field(0, ge=0)  # 0 は ONNX Runtime の既定値
+    onnx_inter_op_threads: int = Field(0, ge=0)
@@ -0,0 +1,176 @@
+"""WD Tagger の ONNX Runtime バックエンド
+
+SmilingWolf の WD Tagger v3 は Hugging Face に model.onnx を公開しているので、
+それを ONNX Runtime (CPU) で実行します。このモジュールは torch を import しません。
+
+オフラインでの int8 動的量子化と、torch 版との出力比較はコマンドラインから行います:
+
+    python onnx_tagger.py quantize --model SmilingWolf/wd-vit-large-tagger-v3
+    python onnx_tagger.py parity --model SmilingWolf/wd-vit-large-tagger-v3 --quantized img1.png img2.png
+"""
+import argparse
+import sys
+from pathlib import Path
+from typing import List, Optional
+
+from PIL import Image
+
+from utils import BASE_DIR
+
+# 量子化済みモデルの保存先
+ONNX_CACHE_DIR = BASE_DIR / "data" / ".cache" / "onnx"
+
+
+def quantized_model_path(model_id: str) -> Path:
+    return ONNX_CACHE_DIR / f"{model_id.replace('/', '__')}.int8.onnx"
+
+
+def onnx_model_path(model_id: str, quantized: bool = False) -> Path:
+    """model.onnx（quantized=True なら量子化済みモデル）のパス"""
+    if quantized:
+        path = quantized_model_path(model_id)
+        if not path.exists():
+            raise FileNotFoundError(
+                f"量子化済みモデルがありません。先に `python onnx_tagger.py quantize --model {model_id}` を実行してください"
+            )
+        return path
+    from huggingface_hub import hf_hub_download
+
+    return Path(hf_hub_download(repo_id=model_id, filename="model.onnx"))
+
+
+class OnnxTagger:
+    """ONNX Runtime で WD Tagger を実行する
+
+    入力は SmilingWolf の配布形式に合わせ、白で正方形にパディングしてからリサイズした
+    BGR の float32 (0-255, NHWC) です。出力はタグごとの確率（sigmoid 済み）。
+    """
+
+    def __init__(self, model_id: str, quantized: bool = False, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        import onnxruntime as ort
+
+        self.model_id = model_id
+        self.quantized = quantized
+        self.path = onnx_model_path(model_id, quantized)
+
+        options = ort.SessionOptions()
+        # 0 は ONNX Runtime の既定値（物理コア数）
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(self.path), sess_options=options, providers=["CPUExecutionProvider"])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.output_name = self.session.get_outputs()[0].name
+        # 入力形状は [batch, height, width, 3]。batch が固定 (1) のモデルは1枚ずつ実行する
+        self.size = model_input.shape[1]
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+
+    def preprocess(self, img: Image.Image):
+        import numpy as np
+
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        # 白で正方形にパディング
+        side = max(img.size)
+        canvas = Image.new("RGB", (side, side), (255, 255, 255))
+        canvas.paste(img, ((side - img.width) // 2, (side - img.height) // 2))
+        if side != self.size:
+            canvas = canvas.resize((self.size, self.size), Image.BICUBIC)
+        array = np.asarray(canvas, dtype=np.float32)
+        # RGB -> BGR
+        return array[:, :, ::-1]
+
+    def __call__(self, imgs: List[Image.Image]):
+        """複数画像の確率を [N, ラベル数] の配列で返す"""
+        import numpy as np
+
+        batch = np.ascontiguousarray(np.stack([self.preprocess(img) for img in imgs]))
+        if self.dynamic_batch:
+            return self.session.run([self.output_name], {self.input_name: batch})[0]
+        return np.concatenate([
+            self.session.run([self.output_name], {self.input_name: batch[i:i + 1]})[0]
+            for i in range(len(imgs))
+        ])
+
+
+def quantize(model_id: str) -> Path:
+    """model.onnx を int8 に動的量子化して ONNX_CACHE_DIR に保存"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    src = onnx_model_path(model_id)
+    dst = quantized_model_path(model_id)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    print(f"Quantizing {src} -> {dst}")
+    quantize_dynamic(str(src), str(dst), weight_type=QuantType.QInt8)
+    print(f"Done: {src.stat().st_size / 1e6:.1f}MB -> {dst.stat().st_size / 1e6:.1f}MB")
+    return dst
+
+
+def parity(model_id: str, image_paths: List[Path], quantized: bool = False, top_k: int = 10,
+           threshold: Optional[float] = None) -> dict:
+    """同じ画像で torch 版と ONNX 版を実行し、上位 top_k タグの一致率と確率の最大差を求める"""
+    import numpy as np
+    from inference import tagger_batch_task, load_tagger_labels
+
+    labels, _, _ = load_tagger_labels(model_id)
+    imgs = []
+    for path in image_paths:
+        with Image.open(path) as src:
+            imgs.append(src.convert("RGB"))
+
+    torch_probs = np.asarray(tagger_batch_task(model_id, ("torch",), imgs))
+    onnx_probs = OnnxTagger(model_id, quantized=quantized)(imgs)
+
+    overlaps = []
+    for path, t_row, o_row in zip(image_paths, torch_probs, onnx_probs):
+        t_top = [int(i) for i in np.argsort(-t_row)[:top_k]]
+        o_top = [int(i) for i in np.argsort(-o_row)[:top_k]]
+        overlap = len(set(t_top) & set(o_top)) / top_k
+        overlaps.append(overlap)
+        print(f"{Path(path).name}: top-{top_k} agreement {overlap:.0%}, max |diff| {np.abs(t_row - o_row).max():.4f}")
+        missing = [labels[i] for i in t_top if i not in o_top]
+        if missing:
+            print(f"  torch only: {', '.join(missing)}")
+    result = {
+        "top_k": top_k,
+        "mean_top_k_agreement": float(np.mean(overlaps)) if overlaps else None,
+        "max_abs_diff": float(np.abs(torch_probs - onnx_probs).max()) if len(imgs) else None,
+    }
+    if threshold is not None:
+        # 閾値で切ったタグ集合の一致（Jaccard）
+        jaccards = []
+        for t_row, o_row in zip(torch_probs, onnx_probs):
+            t_set, o_set = set(np.flatnonzero(t_row >= threshold)), set(np.flatnonzero(o_row >= threshold))
+            union = t_set | o_set
+            jaccards.append(len(t_set & o_set) / len(union) if union else 1.0)
+        result["mean_threshold_jaccard"] = float(np.mean(jaccards))
+    print(result)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="WD Tagger の ONNX モデルの量子化・torch 版との比較")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    q = sub.add_parser("quantize", help="model.onnx を int8 に動的量子化")
+    q.add_argument("--model", required=True)
+
+    p = sub.add_parser("parity", help="torch 版と ONNX 版の上位タグの一致率を表示")
+    p.add_argument("--model", required=True)
+    p.add_argument("--quantized", action="store_true", help="量子化済みモデルと比較")
+    p.add_argument("--top-k", type=int, default=10)
+    p.add_argument("--threshold", type=float, default=None)
+    p.add_argument("images", nargs="+", type=Path)
+
+    args = parser.parse_args(argv)
+    if args.command == "quantize":
+        quantize(args.model)
+    else:
+        parity(args.model, args.images, quantized=args.quantized, top_k=args.top_k, threshold=args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from PIL import Image
+
+# デコード済みページを保持するメモリの上限（バイト、既定 512MB）
+PAGE_CACHE_BYTES = int(os.environ.get("PAGE_CACHE_BYTES", str(512 * 1024 * 1024)))
+
+# JPEG の DCT スケーリングで縮小デコードできる倍率
+DECODE_REDUCTIONS = (8, 4, 2)
+
+
+def decode_reduction(min_box_side: float, min_side: int) -> int:
+    """最も小さいボックスの短辺が min_side 以上を保てる最大の縮小率（1, 2, 4, 8）"""
+    for factor in DECODE_REDUCTIONS:
+        if min_box_side / factor >= min_side:
+            return factor
+    return 1
+
+
+def image_nbytes(img: Image.Image) -> int:
+    """デコード済み画像のおおよそのメモリ使用量"""
+    width, height = img.size
+    return width * height * len(img.getbands())
+
+
+class DecodedPageCache:
+    """デコード済みページ画像（RGB）の LRU キャッシュ
+
+    OCR とタグ付けは同じページから何度も切り抜くので、JPEG などのデコードと
+    RGB 変換をページごとに1回で済ませます。キーは (画像ディレクトリ, image_id, mtime_ns, 縮小率) なので、
+    画像が差し替えられれば別エントリになり、古いものは LRU で追い出されます。
+    縮小率を指定すると JPEG は draft() で 1/2・1/4・1/8 のままデコードします（他の形式は等倍）。
+    指定以下の縮小率（より高解像度）のものがキャッシュにあればそれを返すので、
+    呼び出し側は返された画像の実際の大きさから座標を換算してください。
+    キャッシュした画像は共有されるので、呼び出し側は crop などの読み取りだけを行ってください。
+    """
+
+    def __init__(self, max_bytes: int = PAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._images: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._loading = {}  # key -> threading.Event（同じページの同時デコードをまとめる）
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, img_dir: Path, image_id: str, image_path: Path, mtime_ns: int, reduce: int = 1) -> Image.Image:
+        key = (str(img_dir), image_id, mtime_ns, reduce)
+        while True:
+            with self._lock:
+                cached = self._find(key)
+                if cached is not None:
+                    self._images.move_to_end(cached)
+                    self.hits += 1
+                    return self._images[cached]
+                event = self._loading.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = threading.Event()
+                    self._loading[key] = event
+                    break
+            # 他のリクエストがデコード中なら待ってから取り直す
+            event.wait()
+
+        try:
+            img, factor = self._decode(image_path, reduce)
+            with self._lock:
+                self._put(key[:3] + (factor,), img)
+            return img
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            event.set()
+
+    def _find(self, key):
+        """key の縮小率以下で最も粗い、キャッシュ済みのエントリのキー（_lock 内で呼ぶ）"""
+        best = None
+        for factor in (1,) + DECODE_REDUCTIONS[::-1]:
+            if factor > key[3]:
+                break
+            candidate = key[:3] + (factor,)
+            if candidate in self._images:
+                best = candidate
+        return best
+
+    @staticmethod
+    def _decode(image_path: Path, reduce: int = 1):
+        """(RGB 画像, 実際の縮小率) を返す"""
+        with Image.open(image_path) as src:
+            source_size = src.size
+            if reduce > 1:
+                # JPEG は DCT の段階で縮小してデコードする（他の形式では何もしない）
+                src.draft(src.mode, (src.width // reduce, src.height // reduce))
+            # RGB以外のモードをRGBに変換（RGBA、グレースケールなど）
+            img = src.convert("RGB") if src.mode != "RGB" else src.copy()
+        img.load()
+        # 座標の換算用に元の大きさを残しておく
+        img.info["source_size"] = source_size
+        return img, max(1, round(source_size[0] / img.width))
+
+    def _put(self, key, img: Image.Image):
+        size = image_nbytes(img)
+        if size > self.max_bytes or key in self._images:
+            # 上限より大きいページはキャッシュしない
+            return
+        # 同じページの古い mtime のエントリは不要なので先に捨てる
+        for old in [k for k in self._images if k[:2] == key[:2] and k[2] != key[2]]:
+            self._remove(old)
+        self._images[key] = img
+        self._sizes[key] = size
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._images)))
+
+    def _remove(self, key):
+        self._images.pop(key)
+        self._bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._images),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+page_cache = DecodedPageCache()
@@ -0,0 +1,145 @@
+"""開いているページの差分同期（版番号ごとの変更の記録）
+
+ページは編集のたびに version が1つ増えます（AnnotationStore が付けます）。
+GET /annotations/{image_id} で開かれたページについて、版ごとの変更を
+storage.diff_pages と同じ形式（set: 追加・変更したアノテーション、del: 削除したID、
+ids: 並びが変わったときの全IDの並び、page: 変更したページの項目）でメモリに記録し、
+クライアントは GET /annotations/{image_id}/delta?since=版番号 で手元の版以降の変更だけを受け取ります。
+記録が残っていない古い版（再起動・記録の上限・長く開いていなかったページ）からはページ全体を返します。
+"""
+import os
+import threading
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Deque, Dict, Iterable, List, Optional
+
+from models import ImageAnnotation
+from storage import diff_pages
+
+# 1ページあたりに残す変更の数（これより古い版からはページ全体を取り直す）
+PAGE_DELTA_LOG_SIZE = int(os.environ.get("PAGE_DELTA_LOG_SIZE", "200"))
+# 変更を記録するページ数の上限（最後に開かれた・編集された順に残す）
+PAGE_DELTA_PAGES = int(os.environ.get("PAGE_DELTA_PAGES", "256"))
+
+
+class _PageLog:
+    """1ページ分の記録。base 以降の版からなら changes を順に当てれば最新になる"""
+
+    def __init__(self, page: dict):
+        self.snapshot = page
+        self.version = page["version"]
+        self.base = page["version"]
+        self.changes: Deque[dict] = deque()
+
+
+def _change_record(previous: dict, current: dict) -> dict:
+    """2つの版の差分（取り消し用の prev は含めない）"""
+    record = diff_pages(previous, current) or {}
+    record.pop("prev", None)
+    record["version"] = current["version"]
+    return record
+
+
+class PageChangeLog:
+    """開かれたページの版ごとの変更の記録
+
+    AnnotationStore の変更リスナー（ストアのロック中に呼ばれる）として登録します。
+    記録するのは track() 済みのページだけで、それ以外のページの編集では何もしません。
+    """
+
+    def __init__(self, log_size: int = PAGE_DELTA_LOG_SIZE, max_pages: int = PAGE_DELTA_PAGES):
+        self.log_size = log_size
+        self.max_pages = max_pages
+        self._logs: "OrderedDict[tuple, _PageLog]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._pinned: Dict[tuple, int] = {}  # key -> 購読している接続の数（上限を超えても破棄しない）
+
+    def add_listener(self, listener):
+        """変更を記録したときに listener(anno_dir, image_id, change) を呼ぶ（ストアのロック中なので軽い処理のみ）"""
+        self._listeners.append(listener)
+
+    @staticmethod
+    def _key(anno_dir: Path, image_id: str) -> tuple:
+        return (str(anno_dir), image_id)
+
+    def pin(self, anno_dir: Path, image_ids: Iterable[str]):
+        """変更通知で購読中のページの記録を、ページ数の上限を超えても残す"""
+        with self._lock:
+            for image_id in image_ids:
+                key = self._key(anno_dir, image_id)
+                self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def unpin(self, anno_dir: Path, image_ids: Iterable[str]):
+        with self._lock:
+            for image_id in image_ids:
+                key = self._key(anno_dir, image_id)
+                count = self._pinned.get(key, 0) - 1
+                if count > 0:
+                    self._pinned[key] = count
+                else:
+                    self._pinned.pop(key, None)
+            self._evict()
+
+    def _evict(self):
+        # 古い順に破棄（購読中のページは残す）
+        for key in list(self._logs):
+            if len(self._logs) <= self.max_pages:
+                break
+            if key not in self._pinned:
+                del self._logs[key]
+
+    def track(self, anno_dir: Path, image_id: str, page: ImageAnnotation):
+        """ページの変更の記録を始める（記録中で版が同じなら何もしない）"""
+        key = self._key(anno_dir, image_id)
+        with self._lock:
+            log = self._logs.get(key)
+            if log is not None and log.version == page.version:
+                self._logs.move_to_end(key)
+                return
+        snapshot = page.model_dump()
+        with self._lock:
+            self._logs[key] = _PageLog(snapshot)
+            self._logs.move_to_end(key)
+            self._evict()
+
+    def on_page_changed(self, anno_dir: Path, image_id: str, page: ImageAnnotation):
+        """AnnotationStore の変更リスナー"""
+        key = self._key(anno_dir, image_id)
+        with self._lock:
+            log = self._logs.get(key)
+            if log is None:
+                return
+            current = page.model_dump()
+            change = _change_record(log.snapshot, current)
+            log.changes.append(change)
+            log.snapshot = current
+            log.version = current["version"]
+            while len(log.changes) > self.log_size:
+                log.base = log.changes.popleft()["version"]
+            self._logs.move_to_end(key)
+        for listener in self._listeners:
+            try:
+                listener(anno_dir, image_id, change)
+            except Exception as e:
+                print(f"Page change listener failed: {e}")
+
+    def changes_since(self, anno_dir: Path, image_id: str, page: ImageAnnotation, since: int) -> Optional[List[dict]]:
+        """since の版から page の版までの変更（古い順）。記録がなければ None（ページ全体を返す）"""
+        if since == page.version:
+            return []
+        with self._lock:
+            log = self._logs.get(self._key(anno_dir, image_id))
+            if log is None or log.version != page.version or not log.base <= since < page.version:
+                return None
+            return [change for change in log.changes if change["version"] > since]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pages": len(self._logs),
+                "changes": sum(len(log.changes) for log in self._logs.values()),
+            }
+
+
+page_changes = PageChangeLog()
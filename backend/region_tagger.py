@@ -0,0 +1,205 @@
+"""ページ単位のタグ付け（ROI モード）
+
+ページ全体を1回だけ WD Tagger のバックボーンに通し、特徴マップ上で各ボックスの範囲を
+プーリングしてからヘッド（分類層）にかけます。切り抜きモード（/tagger）はボックスごとに
+切り抜き・リサイズして全体を推論するので、ボックスの多いページほど ROI モードの方が速くなります。
+その代わり、特徴にはボックスの外側の文脈が混ざり、小さなボックスは特徴マップの解像度で粗くなります。
+PyTorch バックエンドのみ対応です。
+
+切り抜きモードとの一致率と速度は、既存のアノテーションを使ってコマンドラインから測定します:
+
+    python region_tagger.py compare --model SmilingWolf/wd-convnext-tagger-v3 --threshold 0.35 --pages 20
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from pathlib import Path
+from typing import List, Sequence, Tuple
+
+from PIL import Image
+
+from inference import get_tagger, tagger_batch_task, load_tag_table, TAGGER_INPUT_SIZE
+
+# ROI モードを有効にする（切り抜きモードとの一致率と速度を compare で測ってから 1 にする）
+REGION_TAGGER_ENABLED = os.environ.get("REGION_TAGGER_ENABLED", "0") in ("1", "true", "yes")
+# ページを入力する解像度（正方形の一辺）。0 ならモデルの入力サイズの2倍
+# 位置埋め込みが固定の ViT 系モデルは常にモデルの入力サイズで実行する
+REGION_TAGGER_PAGE_SIZE = int(os.environ.get("REGION_TAGGER_PAGE_SIZE", "0"))
+
+Box = Tuple[float, float, float, float]  # (x, y, width, height) ページのピクセル座標
+
+# ボックスの範囲を特徴に反映できるプーリング（パッチトークンを集計するもの）
+SUPPORTED_GLOBAL_POOLS = ("avg", "avgmax", "max")
+
+
+class RegionTaggerUnsupported(ValueError):
+    """ROI モードに対応していないモデル（クラストークンだけで分類するものなど）"""
+
+
+def region_page_side() -> int:
+    """ページを渡すときに必要な長辺の長さ（これより大きいページは呼び出し側で縮小してよい）
+
+    モデルの入力サイズが TAGGER_INPUT_SIZE（WD Tagger v3）であることを前提にした上限です。
+    """
+    return REGION_TAGGER_PAGE_SIZE or TAGGER_INPUT_SIZE * 2
+
+
+def _page_tensor(page_img: Image.Image, size: int, mean, std):
+    """ページを白で正方形にパディングして size に縮小し、正規化したテンソル [1, 3, size, size] にする"""
+    import numpy as np
+    import torch
+
+    side = max(page_img.size)
+    offset = ((side - page_img.width) // 2, (side - page_img.height) // 2)
+    canvas = Image.new("RGB", (side, side), (255, 255, 255))
+    canvas.paste(page_img, offset)
+    if side != size:
+        canvas = canvas.resize((size, size), Image.BICUBIC)
+    array = np.asarray(canvas, dtype=np.float32) / 255.0
+    array = (array - np.asarray(mean, dtype=np.float32)) / np.asarray(std, dtype=np.float32)
+    return torch.from_numpy(array.transpose(2, 0, 1).copy()).unsqueeze(0), side, offset
+
+
+def _cell_range(start: float, end: float, side: int, cells: int) -> Tuple[int, int]:
+    """パディング後の座標の範囲を特徴マップのセルの範囲に変換（最低1セル）"""
+    lo = min(max(int(math.floor(start / side * cells)), 0), cells - 1)
+    hi = max(min(int(math.ceil(end / side * cells)), cells), lo + 1)
+    return lo, hi
+
+
+def region_tagger_task(model_id: str, page_img: Image.Image, boxes: Sequence[Box]):
+    """ページを1回 forward して各ボックスの確率（numpy 配列 [ボックス数, ラベル数]）を返す（boxes は1件以上）"""
+    import torch
+    from timm.data import resolve_data_config
+
+    model, _ = get_tagger(model_id)
+    # 'token' プーリングの ViT はクラストークンだけを見るので、どのボックスも同じ結果になる
+    global_pool = getattr(model, "global_pool", None)
+    if isinstance(global_pool, str) and global_pool not in SUPPORTED_GLOBAL_POOLS:
+        raise RegionTaggerUnsupported(
+            f"このモデル（global_pool={global_pool!r}）はROIモードに対応していません。切り抜きモードを使ってください"
+        )
+    config = resolve_data_config(model.pretrained_cfg)
+    native_size = config["input_size"][-1]
+    patch_embed = getattr(model, "patch_embed", None)
+    if patch_embed is not None and not getattr(patch_embed, "dynamic_img_size", False):
+        size = native_size
+    else:
+        size = REGION_TAGGER_PAGE_SIZE or native_size * 2
+
+    x, side, (ox, oy) = _page_tensor(page_img, size, config["mean"], config["std"])
+    device = next(model.parameters()).device
+    logits = []
+    with torch.no_grad():
+        features = model.forward_features(x.to(device))
+        if features.ndim == 4:
+            # CNN 系: [1, C, H, W] の範囲を切り出して forward_head（global pool -> norm -> fc）
+            height, width = features.shape[-2:]
+            for bx, by, bw, bh in boxes:
+                y0, y1 = _cell_range(by + oy, by + bh + oy, side, height)
+                x0, x1 = _cell_range(bx + ox, bx + bw + ox, side, width)
+                logits.append(model.forward_head(features[:, :, y0:y1, x0:x1]))
+        else:
+            # ViT 系: [1, prefix + H*W, C] から範囲内のパッチトークンを選んで forward_head（平均 -> fc）
+            prefix = getattr(model, "num_prefix_tokens", 0)
+            cells = int(round(math.sqrt(features.shape[1] - prefix)))
+            for bx, by, bw, bh in boxes:
+                y0, y1 = _cell_range(by + oy, by + bh + oy, side, cells)
+                x0, x1 = _cell_range(bx + ox, bx + bw + ox, side, cells)
+                index = [prefix + row * cells + col for row in range(y0, y1) for col in range(x0, x1)]
+                tokens = torch.cat([features[:, :prefix], features[:, index]], dim=1)
+                logits.append(model.forward_head(tokens))
+    return torch.sigmoid(torch.cat(logits)).cpu().numpy()
+
+
+# --- 切り抜きモードとの比較 ---
+
+def compare(model_id: str, img_dir, anno_dir, types: List[str], threshold: float, top_k: int = 10,
+            pages: int = 20) -> dict:
+    """既存のアノテーションのボックスを両方のモードでタグ付けし、一致率と所要時間を比べる"""
+    import numpy as np
+    from image_catalog import get_catalog
+    from storage import get_storage
+    from manifest import id_sort_key
+
+    storage = get_storage(anno_dir)
+    catalog = get_catalog(img_dir)
+    tag_table = load_tag_table(model_id)
+
+    top_k_agreement = []
+    jaccards = []
+    crop_time = roi_time = 0.0
+    page_count = 0
+    for image_id in sorted(storage.page_ids(), key=id_sort_key):
+        if page_count >= pages:
+            break
+        data = storage.load(image_id)
+        path = catalog.image_path(image_id)
+        if data is None or path is None:
+            continue
+        boxes = [
+            (a["bbox_abs"]["x"], a["bbox_abs"]["y"], a["bbox_abs"]["width"], a["bbox_abs"]["height"])
+            for a in data.get("annotations", []) if a.get("type") in types
+        ]
+        if not boxes:
+            continue
+        with Image.open(path) as src:
+            page = src.convert("RGB")
+        page_count += 1
+
+        started = time.perf_counter()
+        crops = [page.crop((x, y, x + w, y + h)) for x, y, w, h in boxes]
+        crop_probs = np.asarray(tagger_batch_task(model_id, ("torch",), crops))
+        crop_time += time.perf_counter() - started
+
+        started = time.perf_counter()
+        roi_probs = region_tagger_task(model_id, page, boxes)
+        roi_time += time.perf_counter() - started
+
+        for c_row, r_row in zip(crop_probs, roi_probs):
+            c_top, r_top = set(np.argsort(-c_row)[:top_k]), set(np.argsort(-r_row)[:top_k])
+            top_k_agreement.append(len(c_top & r_top) / top_k)
+            c_tags = {t["tag"] for t in tag_table.select(c_row, threshold)[1]}
+            r_tags = {t["tag"] for t in tag_table.select(r_row, threshold)[1]}
+            union = c_tags | r_tags
+            jaccards.append(len(c_tags & r_tags) / len(union) if union else 1.0)
+        print(f"{image_id}: {len(boxes)} boxes, top-{top_k} agreement {np.mean(top_k_agreement[-len(boxes):]):.0%}, "
+              f"tag Jaccard {np.mean(jaccards[-len(boxes):]):.2f}")
+
+    result = {
+        "pages": page_count,
+        "boxes": len(jaccards),
+        "top_k": top_k,
+        "mean_top_k_agreement": float(np.mean(top_k_agreement)) if top_k_agreement else None,
+        "threshold": threshold,
+        "mean_tag_jaccard": float(np.mean(jaccards)) if jaccards else None,
+        "crop_sec": crop_time,
+        "roi_sec": roi_time,
+    }
+    print(result)
+    return result
+
+
+def main(argv=None):
+    from utils import DEFAULT_IMAGES_DIR, DEFAULT_ANNO_DIR
+
+    parser = argparse.ArgumentParser(description="ROI モードと切り抜きモードのタグ付け結果の比較")
+    sub = parser.add_subparsers(dest="command", required=True)
+    c = sub.add_parser("compare", help="既存のアノテーションで一致率と所要時間を測定")
+    c.add_argument("--model", required=True)
+    c.add_argument("--threshold", type=float, default=0.35)
+    c.add_argument("--top-k", type=int, default=10)
+    c.add_argument("--pages", type=int, default=20, help="比較するページ数")
+    c.add_argument("--types", nargs="+", default=["person", "face", "object"])
+    c.add_argument("--img-dir", default=str(DEFAULT_IMAGES_DIR))
+    c.add_argument("--anno-dir", default=str(DEFAULT_ANNO_DIR))
+
+    args = parser.parse_args(argv)
+    compare(args.model, Path(args.img_dir), Path(args.anno_dir), args.types, args.threshold, top_k=args.top_k, pages=args.pages)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+"""ビューア用の縮小版（レンディション）とディープズーム用タイルの生成・キャッシュ
+
+元のスキャン画像は 5〜15MB になることが多いので、表示には長辺を RENDITION_SIZES に
+縮小した JPEG を使います。ファイルは画像の内容ハッシュ（SHA-256）ごとに
+data/.cache/renditions/{sha[:2]}/{sha}/ 以下へ保存するので、画像が差し替えられれば
+別のファイルになり、同じ画像を再アップロードした場合は再利用されます。
+アップロード直後に RENDITION_PREGENERATE のサイズをバックグラウンドで作成し、
+それ以外のサイズとタイルは最初に要求されたときに作成します。
+ディレクトリはいつ削除しても構いません（必要になった時点で作り直されます）。
+
+タイルは DeepZoom（OpenSeadragon などの .dzi）と同じ並びです。レベル L の画像は
+元画像を 1/2^(最大レベル - L) に縮小したもので、左上から TILE_SIZE 四方（重なりなし）に区切ります。
+"""
+import math
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from utils import BASE_DIR
+
+# 生成する縮小版の長辺（ピクセル）
+RENDITION_SIZES = tuple(sorted(
+    int(s) for s in os.environ.get("RENDITION_SIZES", "256,512,1024,1600,2400").split(",") if s.strip()
+))
+# アップロード直後に作成しておくサイズ（一覧のサムネイルと画面に合わせたプレビュー）
+RENDITION_PREGENERATE = tuple(
+    int(s) for s in os.environ.get("RENDITION_PREGENERATE", "256,1600").split(",") if s.strip()
+)
+RENDITION_QUALITY = int(os.environ.get("RENDITION_QUALITY", "85"))
+# ディープズーム用タイルの一辺
+RENDITION_TILE_SIZE = int(os.environ.get("RENDITION_TILE_SIZE", "512"))
+RENDITION_DIR = BASE_DIR / "data" / ".cache" / "renditions"
+
+
+def fit_size(width: int, height: int, long_side: int) -> Tuple[int, int]:
+    """長辺を long_side に縮小したときの大きさ（元より大きくはしない）"""
+    scale = min(1.0, long_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def tile_levels(width: int, height: int) -> int:
+    """DeepZoom の最大レベル（このレベルが元の解像度、レベル 0 は 1x1）"""
+    return max(0, math.ceil(math.log2(max(width, height, 1))))
+
+
+def level_size(width: int, height: int, level: int) -> Tuple[int, int]:
+    scale = 2 ** (tile_levels(width, height) - level)
+    return max(1, math.ceil(width / scale)), max(1, math.ceil(height / scale))
+
+
+def _render(image_path: Path, size: Tuple[int, int]) -> Image.Image:
+    """画像を size に縮小してデコードする（JPEG は DCT の段階で縮小、モノクロはモノクロのまま）"""
+    with Image.open(image_path) as src:
+        # draft は要求した大きさ以上を保てる範囲で 1/2・1/4・1/8 にデコードする（JPEG 以外は何もしない）
+        src.draft(src.mode, size)
+        mode = "L" if src.mode in ("1", "L", "LA", "I", "I;16") else "RGB"
+        img = src.convert(mode) if src.mode != mode else src.copy()
+    if img.size != size:
+        img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    return img
+
+
+def _save_jpeg(img: Image.Image, path: Path):
+    """一時ファイルに書いてから置き換える（書き込み途中のファイルを配信しない）"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+    try:
+        img.save(tmp, "JPEG", quality=RENDITION_QUALITY, optimize=True, progressive=True)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+class RenditionStore:
+    """縮小版とタイルのディスクキャッシュ
+
+    同じファイルの同時生成はパスごとのロックで1回にまとめます。
+    生成はブロッキング処理なので、リクエストからはスレッドプールで呼んでください。
+    """
+
+    def __init__(self, cache_dir: Path = RENDITION_DIR):
+        self.cache_dir = Path(cache_dir)
+        self._locks: Dict[Path, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self._queue: "queue.Queue[Tuple[str, Path, int, int]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self.hits = 0
+        self.generated = 0
+        self.tiles_generated = 0
+
+    def _dir(self, sha256: str) -> Path:
+        return self.cache_dir / sha256[:2] / sha256
+
+    def _lock_for(self, path: Path) -> threading.Lock:
+        with self._locks_lock:
+            lock = self._locks.get(path)
+            if lock is None:
+                lock = threading.Lock()
+                self._locks[path] = lock
+            return lock
+
+    def _release_lock(self, path: Path):
+        with self._locks_lock:
+            self._locks.pop(path, None)
+
+    # --- 縮小版 ---
+
+    def rendition(self, sha256: str, image_path: Path, width: int, height: int, long_side: int) -> Path:
+        """長辺 long_side の縮小版のパス（なければ作る）"""
+        path = self._dir(sha256) / f"{long_side}.jpg"
+        if path.exists():
+            self.hits += 1
+            return path
+        lock = self._lock_for(path)
+        with lock:
+            if not path.exists():
+                _save_jpeg(_render(image_path, fit_size(width, height, long_side)), path)
+                self.generated += 1
+        self._release_lock(path)
+        return path
+
+    # --- タイル ---
+
+    def tile(self, sha256: str, image_path: Path, width: int, height: int, level: int, col: int, row: int) -> Optional[Path]:
+        """タイルのパス（範囲外なら None）。そのレベルのタイルがまだなければレベル全体をまとめて作る"""
+        if not 0 <= level <= tile_levels(width, height):
+            return None
+        level_width, level_height = level_size(width, height, level)
+        tile_size = RENDITION_TILE_SIZE
+        if not (0 <= col < math.ceil(level_width / tile_size) and 0 <= row < math.ceil(level_height / tile_size)):
+            return None
+        level_dir = self._dir(sha256) / "tiles" / str(level)
+        path = level_dir / f"{col}_{row}.jpg"
+        if path.exists():
+            self.hits += 1
+            return path
+        lock = self._lock_for(level_dir)
+        with lock:
+            if not path.exists():
+                img = _render(image_path, (level_width, level_height))
+                for y in range(0, level_height, tile_size):
+                    for x in range(0, level_width, tile_size):
+                        box = (x, y, min(x + tile_size, level_width), min(y + tile_size, level_height))
+                        _save_jpeg(img.crop(box), level_dir / f"{x // tile_size}_{y // tile_size}.jpg")
+                        self.tiles_generated += 1
+        self._release_lock(level_dir)
+        return path
+
+    # --- アップロード直後の事前生成 ---
+
+    def pregenerate(self, sha256: Optional[str], image_path: Path, width: int, height: int):
+        """RENDITION_PREGENERATE のサイズをバックグラウンドで作成する（1スレッドで順番に処理）"""
+        if not sha256 or not RENDITION_PREGENERATE:
+            return
+        self._queue.put((sha256, Path(image_path), width, height))
+        with self._locks_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._pregenerate_loop, name="renditions", daemon=True)
+                self._worker.start()
+
+    def _pregenerate_loop(self):
+        while True:
+            try:
+                sha256, image_path, width, height = self._queue.get(timeout=5.0)
+            except queue.Empty:
+                with self._locks_lock:
+                    # 終了判定とキューへの追加が行き違わないようにロック内で確認する
+                    if self._queue.empty():
+                        self._worker = None
+                        return
+                continue
+            for long_side in RENDITION_PREGENERATE:
+                try:
+                    self.rendition(sha256, image_path, width, height, long_side)
+                except Exception as e:
+                    print(f"Rendition pregeneration failed for {image_path.name} ({long_side}): {e}")
+                    break
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "generated": self.generated,
+            "tiles_generated": self.tiles_generated,
+            "pending": self._queue.qsize(),
+        }
+
+
+def rendition_list(width: int, height: int) -> List[dict]:
+    """元画像より小さくなる縮小版の一覧（小さい順）"""
+    long_side = max(width, height)
+    renditions = []
+    for size in RENDITION_SIZES:
+        if size >= long_side:
+            break
+        rendition_width, rendition_height = fit_size(width, height, size)
+        renditions.append({"size": size, "width": rendition_width, "height": rendition_height})
+    return renditions
+
+
+rendition_store = RenditionStore()
@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+from utils import BASE_DIR
+from inference import wait_for_result, INFERENCE_TIMEOUT
+
+# メモリに置いておく推論結果の上限（バイト、既定 64MB）
+RESULT_CACHE_MEMORY_BYTES = int(os.environ.get("RESULT_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+# ディスクに置いておく推論結果の上限（バイト、既定 1GB。0 ならディスクには保存しない）
+RESULT_CACHE_DISK_BYTES = int(os.environ.get("RESULT_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+RESULT_CACHE_DIR = BASE_DIR / "data" / ".cache" / "results"
+
+
+def result_key(content_hash: str, bbox_abs, engine: str, model: tuple, version: int) -> tuple:
+    """推論結果のキー。bbox は切り抜きと同じく整数ピクセルに丸める"""
+    left = round(bbox_abs.x)
+    top = round(bbox_abs.y)
+    right = round(bbox_abs.x + bbox_abs.width)
+    bottom = round(bbox_abs.y + bbox_abs.height)
+    return (content_hash, (left, top, right, bottom), engine, tuple(model), version)
+
+
+def _value_nbytes(value) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return len(value.encode("utf-8"))
+
+
+class ResultCache:
+    """OCR・タグ付けの推論結果のキャッシュ（メモリとディスクの2段）
+
+    キーは (ページ画像の内容ハッシュ, 丸めた bbox, エンジン, モデル, 前処理のバージョン) なので、
+    同じ画像の同じ範囲であればページを開き直しても、画像を再アップロードしても再利用できます。
+    OCR はテキスト、タグ付けは閾値・除外タグを適用する前の確率ベクトルを保存します。
+    ディスクは data/.cache/results/ 以下に1件1ファイルで置き、上限を超えたら古いものから消します。
+    同じキーの推論が実行中なら、後から来たリクエストはその結果を待ちます。
+    """
+
+    def __init__(self, cache_dir: Path = RESULT_CACHE_DIR, memory_bytes: int = RESULT_CACHE_MEMORY_BYTES,
+                 disk_bytes: int = RESULT_CACHE_DISK_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory: "OrderedDict[tuple, object]" = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._disk_index: "Optional[OrderedDict[Path, int]]" = None  # ファイル -> サイズ（古い順）
+        self._disk_total = 0
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> [asyncio.Task, 待っているリクエスト数]（イベントループ内でのみ操作）
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    # --- 参照・登録 ---
+
+    async def get_or_compute(self, key: Optional[tuple], compute: Callable[[], Awaitable], request=None,
+                             timeout: Optional[float] = INFERENCE_TIMEOUT):
+        """キャッシュの結果を返す。なければ compute() で推論する（同じキーの実行中の推論があれば共有）
+
+        タイムアウト・切断は呼び出し元ごとに扱い、待っている呼び出し元がいなくなった推論は取り消します。
+        key が None（内容ハッシュが分からない）ならキャッシュせずに推論します。
+        """
+        if key is None:
+            task = asyncio.ensure_future(compute())
+            try:
+                return await wait_for_result(task, request, timeout)
+            finally:
+                if not task.done():
+                    task.cancel()
+        value = self._get_memory(key)
+        if value is not None:
+            return value
+        flight = self._inflight.get(key)
+        if flight is None:
+            value = await asyncio.get_running_loop().run_in_executor(None, self._get_disk, key)
+            if value is not None:
+                return value
+            flight = self._inflight.get(key)
+        if flight is None:
+            with self._lock:
+                self.misses += 1
+            task = asyncio.ensure_future(compute())
+            flight = [task, 0]
+            self._inflight[key] = flight
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            with self._lock:
+                self.coalesced += 1
+        flight[1] += 1
+        try:
+            return await wait_for_result(flight[0], request, timeout)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not flight[0].done():
+                flight[0].cancel()
+
+    def _finish(self, key: tuple, task: asyncio.Task):
+        if self._inflight.get(key, [None])[0] is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        value = task.result()
+        self._put_memory(key, value)
+        if self.disk_bytes > 0:
+            asyncio.get_running_loop().run_in_executor(None, self._put_disk, key, value)
+
+    # --- メモリ ---
+
+    def _get_memory(self, key: tuple):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+            return value
+
+    def _put_memory(self, key: tuple, value):
+        size = _value_nbytes(value)
+        with self._lock:
+            if size > self.memory_bytes or key in self._memory:
+                return
+            self._memory[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            while self._bytes > self.memory_bytes:
+                old, _ = self._memory.popitem(last=False)
+                self._bytes -= self._sizes.pop(old)
+
+    # --- ディスク ---
+
+    def _path(self, key: tuple) -> Path:
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        suffix = ".npy" if key[2] == "tagger" else ".txt"
+        return self.cache_dir / key[2] / digest[:2] / f"{digest}{suffix}"
+
+    def _get_disk(self, key: tuple):
+        if self.disk_bytes <= 0:
+            return None
+        path = self._path(key)
+        try:
+            if path.suffix == ".npy":
+                value = np.load(path, allow_pickle=False)
+            else:
+                value = path.read_text(encoding="utf-8")
+            # 最近使ったものとして扱う（削除は更新時刻の古い順）
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self.disk_hits += 1
+            if self._disk_index is not None and path in self._disk_index:
+                self._disk_index.move_to_end(path)
+        self._put_memory(key, value)
+        return value
+
+    def _put_disk(self, key: tuple, value):
+        path = self._path(key)
+        tmp = path.with_name(f".{path.name}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "wb") as f:
+                if isinstance(value, np.ndarray):
+                    np.save(f, value, allow_pickle=False)
+                else:
+                    f.write(value.encode("utf-8"))
+            os.replace(tmp, path)
+            size = path.stat().st_size
+        except OSError as e:
+            print(f"Result cache write failed: {e}")
+            return
+        with self._lock:
+            self._ensure_disk_index()
+            self._disk_total -= self._disk_index.pop(path, 0)
+            self._disk_index[path] = size
+            self._disk_total += size
+            evict = []
+            while self._disk_total > self.disk_bytes and len(self._disk_index) > 1:
+                old, old_size = self._disk_index.popitem(last=False)
+                self._disk_total -= old_size
+                evict.append(old)
+        for old in evict:
+            try:
+                old.unlink()
+            except OSError:
+                pass
+
+    def _ensure_disk_index(self):
+        """ディスク上のキャッシュの一覧を更新時刻の古い順に作る（最初の書き込み時に1回、_lock 内で呼ぶ）"""
+        if self._disk_index is not None:
+            return
+        files = []
+        if self.cache_dir.exists():
+            for path in self.cache_dir.glob("*/*/*"):
+                if path.name.startswith("."):
+                    continue
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime_ns, path, st.st_size))
+        files.sort()
+        self._disk_index = OrderedDict((path, size) for _, path, size in files)
+        self._disk_total = sum(size for _, _, size in files)
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._bytes,
+                "max_memory_bytes": self.memory_bytes,
+                "disk_bytes": self._disk_total if self._disk_index is not None else None,
+                "max_disk_bytes": self.disk_bytes,
+            }
+
+
+result_cache = ResultCache()
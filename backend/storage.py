@@ -0,0 +1,785 @@
+"""アノテーションの保存先（JSON / SQLite）
+
+utils.save_annotation_json / load_annotation_json はここで選択されたバックエンドに委譲します。
+バックエンドは環境変数 ANNOTATION_STORAGE (json | sqlite) で切り替えます。
+
+SQLite への移行とJSONへの書き戻し、ジャーナルのJSONへの反映:
+    python storage.py migrate [--anno-dir DIR]
+    python storage.py export --out DIR [--anno-dir DIR]
+    python storage.py compact [--anno-dir DIR]
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+ANNOTATION_STORAGE = os.environ.get("ANNOTATION_STORAGE", "json").lower()
+
+# JSONバックエンドで編集をページごとのジャーナルに追記する（0 なら毎回ページ全体を書き出す）
+ANNOTATION_JOURNAL = os.environ.get("ANNOTATION_JOURNAL", "1") not in ("0", "false", "no")
+# ジャーナルがこのサイズ（バイト）を超えたら、ページのJSONに反映して空にする
+ANNOTATION_JOURNAL_MAX_BYTES = int(os.environ.get("ANNOTATION_JOURNAL_MAX_BYTES", str(256 * 1024)))
+# 最初の追記からこの時間（秒）が経ったジャーナルは、バックグラウンドでページのJSONに反映する
+ANNOTATION_JOURNAL_MAX_AGE = float(os.environ.get("ANNOTATION_JOURNAL_MAX_AGE", "300"))
+# 反映済みの編集記録をページごとに残しておく件数（編集履歴・取り消し用）
+ANNOTATION_HISTORY_LIMIT = int(os.environ.get("ANNOTATION_HISTORY_LIMIT", "200"))
+# 差分の計算用に直前の保存内容を保持するページ数
+JOURNAL_STATE_PAGES = 256
+
+JOURNAL_DIR_NAME = ".journal"
+
+
+def dump_page_json(annotation_data: dict) -> str:
+    """ページデータをJSON文字列に変換（JSONバックエンドとエクスポートで共通の書式）
+
+    版番号（version）はサーバー側の管理用なのでファイルには含めません。
+    """
+    return json.dumps({k: v for k, v in annotation_data.items() if k != "version"}, ensure_ascii=False, indent=2)
+
+
+def page_summary(annotation_data: dict) -> dict:
+    """一覧・絞り込み用のページ概要"""
+    annotations = annotation_data.get("annotations", [])
+    return {
+        "is_completed": annotation_data.get("is_completed", False),
+        "annotation_count": len(annotations),
+        "types": sorted({a["type"] for a in annotations}),
+        "character_ids": sorted({a["character_id"] for a in annotations if a.get("character_id")}),
+    }
+
+
+def diff_pages(previous: dict, current: dict) -> Optional[dict]:
+    """2つのページデータの差分の記録（変更がなければ None）
+
+    set: 追加・変更したアノテーション、del: 削除したID、ids: 並びが変わったときの全IDの並び、
+    page: 変更したページの項目。prev には同じ形式で元に戻すための内容を入れます。
+    版番号（version）は内容の変更として扱わず、ほかの変更があるときだけ記録の version に入れます
+    （prev には入れないので、取り消しても版番号は戻りません）。
+    """
+    record, prev = {}, {}
+    previous_annos = {a["id"]: a for a in previous.get("annotations", [])}
+    current_annos = {a["id"]: a for a in current.get("annotations", [])}
+
+    changed = [a for a in current.get("annotations", []) if previous_annos.get(a["id"]) != a]
+    removed = [anno_id for anno_id in previous_annos if anno_id not in current_annos]
+    if changed:
+        record["set"] = changed
+        restored = [previous_annos[a["id"]] for a in changed if a["id"] in previous_annos]
+        added = [a["id"] for a in changed if a["id"] not in previous_annos]
+        if restored:
+            prev["set"] = restored
+        if added:
+            prev["del"] = added
+    if removed:
+        record["del"] = removed
+        prev["set"] = prev.get("set", []) + [previous_annos[anno_id] for anno_id in removed]
+
+    previous_ids = list(previous_annos)
+    current_ids = list(current_annos)
+    if previous_ids != current_ids:
+        record["ids"] = current_ids
+        prev["ids"] = previous_ids
+
+    page = {k: v for k, v in current.items() if k not in ("annotations", "version") and previous.get(k) != v}
+    if page:
+        record["page"] = page
+        prev["page"] = {k: previous.get(k) for k in page}
+
+    if not record:
+        return None
+    if "version" in current:
+        record["version"] = current["version"]
+    record["prev"] = prev
+    return record
+
+
+def _has_content(record: dict) -> bool:
+    """記録に版番号以外の変更があるか"""
+    page = {k for k in record.get("page", {}) if k != "version"}
+    return bool(page or record.get("set") or record.get("del") or "ids" in record)
+
+
+def apply_page_record(data: dict, record: dict) -> dict:
+    """diff_pages の記録（または prev）をページデータに適用する（同じ記録を何度適用しても同じ結果）"""
+    data.update(record.get("page", {}))
+    if "version" in record:
+        # 版番号は戻さない
+        data["version"] = max(data.get("version", 0), record["version"])
+    removed = set(record.get("del", ()))
+    annotations = OrderedDict((a["id"], a) for a in data.get("annotations", []) if a["id"] not in removed)
+    for anno in record.get("set", ()):
+        annotations[anno["id"]] = anno
+    ids = record.get("ids")
+    if ids is not None:
+        ordered = [annotations.pop(anno_id) for anno_id in ids if anno_id in annotations]
+        data["annotations"] = ordered + list(annotations.values())
+    else:
+        data["annotations"] = list(annotations.values())
+    return data
+
+
+class JsonStorage:
+    """1ページ = 1ファイルの従来形式 (data/annotations/{image_id}.json)
+
+    ジャーナルが有効なら、既存ページの保存は前回との差分を1行のJSONとして
+    data/annotations/.journal/{image_id}.jsonl に追記するだけにします。
+    ジャーナルはサイズ（ANNOTATION_JOURNAL_MAX_BYTES）か経過時間（ANNOTATION_JOURNAL_MAX_AGE）で
+    ページのJSONに反映され、反映済みの記録は {image_id}.history.jsonl に直近の分だけ残ります。
+    読み込みは常にページのJSONにジャーナルを適用した内容なので、途中で停止しても失われません。
+    ページの版番号はJSONに入れず、.journal/{image_id}.version に書き出します（keep_versions=False なら書きません）。
+    """
+
+    kind = "json"
+
+    def __init__(self, anno_dir: Path, journal: bool = ANNOTATION_JOURNAL, keep_versions: bool = True):
+        self.anno_dir = Path(anno_dir)
+        self.journal_dir = self.anno_dir / JOURNAL_DIR_NAME
+        self.journal = journal
+        self.keep_versions = keep_versions
+        self._lock = threading.RLock()
+        self._states: "OrderedDict[str, tuple]" = OrderedDict()  # image_id -> (stamp, 保存済みの内容)
+        self._journal_started: Dict[str, float] = {}  # image_id -> 最初に追記した時刻
+        self._compactor: Optional[threading.Thread] = None
+        self.appends = 0
+        self.compactions = 0
+
+    def path(self, image_id: str) -> Path:
+        return self.anno_dir / f"{image_id}.json"
+
+    def journal_path(self, image_id: str) -> Path:
+        return self.journal_dir / f"{image_id}.jsonl"
+
+    def history_path(self, image_id: str) -> Path:
+        return self.journal_dir / f"{image_id}.history.jsonl"
+
+    def version_path(self, image_id: str) -> Path:
+        return self.journal_dir / f"{image_id}.version"
+
+    def load(self, image_id: str) -> Optional[dict]:
+        with self._lock:
+            return self._load(image_id)
+
+    def _load(self, image_id: str) -> Optional[dict]:
+        json_path = self.path(image_id)
+        if not json_path.exists():
+            return None
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        try:
+            # 以前の形式ではJSONに version が入っているので、大きい方を使う
+            data["version"] = max(data.get("version", 0), int(self.version_path(image_id).read_text()))
+        except (OSError, ValueError):
+            pass
+        for record in self._read_records(self.journal_path(image_id)):
+            apply_page_record(data, record)
+        return data
+
+    @staticmethod
+    def _read_records(path: Path) -> List[dict]:
+        """ジャーナル・履歴の記録（書き込み途中で止まった末尾の行は無視する）"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records
+
+    def save(self, image_id: str, annotation_data: dict, changed_ids=None, removed_ids=None) -> str:
+        # ファイル形式では部分更新できないので、差分はジャーナルに追記する（changed_ids は使わない）
+        if not self.journal:
+            return self._write_snapshot(image_id, annotation_data)
+        with self._lock:
+            previous = self._current(image_id)
+            if previous is None:
+                # 新しいページは最初からJSONとして書き出す
+                return self._write_snapshot(image_id, annotation_data)
+            record = diff_pages(previous, annotation_data)
+            if record is not None:
+                self._append(image_id, record)
+            self._remember(image_id, annotation_data)
+            if self.journal_path(image_id).exists() and \
+                    self.journal_path(image_id).stat().st_size > ANNOTATION_JOURNAL_MAX_BYTES:
+                self._compact(image_id)
+            return str(self.journal_path(image_id))
+
+    def _write_snapshot(self, image_id: str, annotation_data: dict) -> str:
+        from utils import atomic_write_text
+
+        self.anno_dir.mkdir(parents=True, exist_ok=True)
+        json_path = self.path(image_id)
+        with self._lock:
+            self._write_version(image_id, annotation_data)
+            atomic_write_text(json_path, dump_page_json(annotation_data))
+            # ページ全体を書き出したので、残っているジャーナルは不要
+            journal_path = self.journal_path(image_id)
+            if journal_path.exists():
+                journal_path.unlink()
+                self._journal_started.pop(image_id, None)
+            if self.journal:
+                self._remember(image_id, annotation_data)
+        return str(json_path)
+
+    def _write_version(self, image_id: str, annotation_data: dict):
+        """ページのJSONとは別に版番号を書き出す（再起動後も同じ版番号から続けるため）
+
+        版番号が内容より進んでいても困らないので、ページのJSONより先に書きます。
+        """
+        from utils import atomic_write_text
+
+        if not self.keep_versions or "version" not in annotation_data:
+            return
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(self.version_path(image_id), str(int(annotation_data["version"])))
+
+    def _current(self, image_id: str) -> Optional[dict]:
+        """前回保存した内容（ファイルが外部で変更されていれば読み直す）"""
+        stamp = self.stamp(image_id)
+        cached = self._states.get(image_id)
+        if cached is not None and cached[0] == stamp:
+            self._states.move_to_end(image_id)
+            return cached[1]
+        data = self._load(image_id)
+        if data is not None:
+            self._remember(image_id, data)
+        return data
+
+    def _remember(self, image_id: str, annotation_data: dict):
+        self._states[image_id] = (self.stamp(image_id), annotation_data)
+        self._states.move_to_end(image_id)
+        while len(self._states) > JOURNAL_STATE_PAGES:
+            self._states.popitem(last=False)
+
+    def _append(self, image_id: str, record: dict):
+        """記録に時刻を付けてジャーナルに1行追記する（fsync まで行う）"""
+        record = {"ts": time.time_ns(), **record}
+        line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.journal_path(image_id), 'a+b') as f:
+            # 前回の書き込みが途中で止まっていたら、その行とつながらないよう改行してから書く
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    line = b"\n" + line
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.appends += 1
+        self._journal_started.setdefault(image_id, time.time())
+        self._start_compactor()
+        return record
+
+    # --- ジャーナルの反映 ---
+
+    def _compact(self, image_id: str) -> bool:
+        """ジャーナルをページのJSONに反映し、記録を履歴に移す（_lock 内で呼ぶ）"""
+        from utils import atomic_write_text
+
+        journal_path = self.journal_path(image_id)
+        if not journal_path.exists():
+            self._journal_started.pop(image_id, None)
+            return False
+        records = self._read_records(journal_path)
+        data = self._load(image_id)
+        if data is not None:
+            self._write_version(image_id, data)
+            atomic_write_text(self.path(image_id), dump_page_json(data))
+        # 同じ記録を2回適用しても結果は変わらないので、ここで止まっても次の読み込みで正しく復元される
+        history = self._read_records(self.history_path(image_id)) + records
+        if ANNOTATION_HISTORY_LIMIT > 0:
+            atomic_write_text(self.history_path(image_id), "".join(
+                json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n"
+                for r in history[-ANNOTATION_HISTORY_LIMIT:]
+            ))
+        journal_path.unlink()
+        self._journal_started.pop(image_id, None)
+        if data is not None:
+            self._remember(image_id, data)
+        self.compactions += 1
+        return True
+
+    def compact_journals(self, max_age: Optional[float] = None) -> int:
+        """ジャーナルをページのJSONに反映する（max_age 指定時はそれより古いものだけ）。反映した数を返す"""
+        if not self.journal_dir.exists():
+            return 0
+        now = time.time()
+        count = 0
+        for path in list(self.journal_dir.glob("*.jsonl")):
+            if path.name.endswith(".history.jsonl"):
+                continue
+            image_id = path.name[:-len(".jsonl")]
+            with self._lock:
+                started = self._journal_started.setdefault(image_id, now)
+                if max_age is not None and now - started < max_age:
+                    continue
+                try:
+                    if self._compact(image_id):
+                        count += 1
+                except Exception as e:
+                    print(f"Journal compaction failed for {image_id}: {e}")
+        return count
+
+    def _start_compactor(self):
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(target=self._compact_loop, name="journal-compactor", daemon=True)
+            self._compactor.start()
+
+    def _compact_loop(self):
+        interval = max(1.0, min(60.0, ANNOTATION_JOURNAL_MAX_AGE / 2))
+        while True:
+            time.sleep(interval)
+            self.compact_journals(max_age=ANNOTATION_JOURNAL_MAX_AGE)
+            with self._lock:
+                if not self._journal_started:
+                    self._compactor = None
+                    return
+
+    # --- 編集履歴と取り消し ---
+
+    def history(self, image_id: str, limit: int = 50) -> List[dict]:
+        """新しい順の編集記録（反映済みの履歴とジャーナル）"""
+        with self._lock:
+            records = self._read_records(self.history_path(image_id)) + self._read_records(self.journal_path(image_id))
+        # 版番号だけの記録（以前の形式）は編集として数えない
+        records = [r for r in records if "undo" in r or _has_content(r)]
+        return records[::-1][:limit]
+
+    def undo(self, image_id: str, version: Optional[int] = None) -> Optional[dict]:
+        """まだ取り消していない最新の編集を取り消し、取り消し後のページデータを返す（なければ None）
+
+        取り消しも1件の記録として追記されるので、履歴から辿れます。
+        version を渡すと取り消し後のページの版番号にします（取り消しでは版番号は戻りません）。
+        """
+        if not self.journal:
+            raise NotImplementedError("ジャーナルが無効です")
+        with self._lock:
+            records = self._read_records(self.history_path(image_id)) + self._read_records(self.journal_path(image_id))
+            undone = {r["undo"] for r in records if "undo" in r}
+            # 版番号だけの記録（以前の形式）は取り消しの対象にしない
+            target = next((r for r in reversed(records)
+                           if "undo" not in r and r["ts"] not in undone and _has_content(r)), None)
+            current = self._current(image_id)
+            if target is None or current is None:
+                return None
+            reverted = apply_page_record(json.loads(json.dumps(current)), target["prev"])
+            if version is not None:
+                reverted["version"] = max(current.get("version", 0), version)
+            record = diff_pages(current, reverted) or {"prev": {}}
+            if version is not None:
+                record["version"] = reverted["version"]
+            self._append(image_id, {**record, "undo": target["ts"]})
+            self._remember(image_id, reverted)
+            return reverted
+
+    def stamp(self, image_id: str) -> Optional[int]:
+        """外部からの変更検出用の値（ファイルとジャーナルの mtime_ns の大きい方）"""
+        try:
+            stamp = self.path(image_id).stat().st_mtime_ns
+        except OSError:
+            return None
+        try:
+            return max(stamp, self.journal_path(image_id).stat().st_mtime_ns)
+        except OSError:
+            return stamp
+
+    def page_ids(self) -> Iterable[str]:
+        if not self.anno_dir.exists():
+            return []
+        return [p.stem for p in self.anno_dir.iterdir() if p.suffix.lower() == '.json']
+
+    def change_token(self):
+        """ディレクトリ内のどこかが変わったら変化する値（ディレクトリとジャーナルのディレクトリの mtime_ns）"""
+        try:
+            token = self.anno_dir.stat().st_mtime_ns
+        except OSError:
+            return None
+        try:
+            return f"{token}:{self.journal_dir.stat().st_mtime_ns}"
+        except OSError:
+            return token
+
+    def page_stats(self) -> Dict[str, int]:
+        """image_id -> stamp（中身は読まずに stat のみ）"""
+        stats = {}
+        if not self.anno_dir.exists():
+            return stats
+        with os.scandir(self.anno_dir) as it:
+            for entry in it:
+                if entry.name.lower().endswith('.json') and not entry.name.startswith('.'):
+                    try:
+                        stats[entry.name[:-5]] = entry.stat().st_mtime_ns
+                    except OSError:
+                        continue
+        if self.journal_dir.exists():
+            with os.scandir(self.journal_dir) as it:
+                for entry in it:
+                    image_id = entry.name[:-len(".jsonl")]
+                    if not entry.name.endswith(".jsonl") or entry.name.endswith(".history.jsonl") \
+                            or image_id not in stats:
+                        continue
+                    try:
+                        stats[image_id] = max(stats[image_id], entry.stat().st_mtime_ns)
+                    except OSError:
+                        continue
+        return stats
+
+    def page_summaries(self, ids: Optional[Iterable[str]] = None) -> Dict[str, dict]:
+        """image_id -> {is_completed, annotation_count, types, character_ids, stamp}"""
+        summaries = {}
+        for image_id in (self.page_ids() if ids is None else ids):
+            stamp = self.stamp(image_id)
+            try:
+                data = self.load(image_id)
+            except Exception:
+                continue
+            if data is None:
+                continue
+            summaries[image_id] = page_summary(data)
+            summaries[image_id]["stamp"] = stamp
+        return summaries
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    image_id TEXT PRIMARY KEY,
+    image_filename TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    page_summary TEXT,
+    is_completed INTEGER NOT NULL DEFAULT 0,
+    updated_ns INTEGER NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    image_id TEXT NOT NULL REFERENCES pages(image_id) ON DELETE CASCADE,
+    id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    "order" INTEGER NOT NULL,
+    abs_x REAL NOT NULL,
+    abs_y REAL NOT NULL,
+    abs_width REAL NOT NULL,
+    abs_height REAL NOT NULL,
+    rel_x REAL NOT NULL,
+    rel_y REAL NOT NULL,
+    rel_width REAL NOT NULL,
+    rel_height REAL NOT NULL,
+    text TEXT NOT NULL,
+    character_id TEXT,
+    subtype TEXT,
+    PRIMARY KEY (image_id, id)
+);
+CREATE INDEX IF NOT EXISTS idx_pages_completed ON pages(is_completed);
+CREATE INDEX IF NOT EXISTS idx_pages_updated ON pages(updated_ns);
+CREATE INDEX IF NOT EXISTS idx_annotations_type ON annotations(type);
+CREATE INDEX IF NOT EXISTS idx_annotations_character ON annotations(character_id);
+CREATE INDEX IF NOT EXISTS idx_annotations_order ON annotations(image_id, "order");
+"""
+
+UPSERT_PAGE = """
+INSERT INTO pages (image_id, image_filename, width, height, page_summary, is_completed, updated_ns, version)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(image_id) DO UPDATE SET
+    image_filename = excluded.image_filename,
+    width = excluded.width,
+    height = excluded.height,
+    page_summary = excluded.page_summary,
+    is_completed = excluded.is_completed,
+    updated_ns = excluded.updated_ns,
+    version = excluded.version
+"""
+
+UPSERT_ANNOTATION = """
+INSERT INTO annotations (image_id, id, position, type, "order",
+    abs_x, abs_y, abs_width, abs_height, rel_x, rel_y, rel_width, rel_height,
+    text, character_id, subtype)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(image_id, id) DO UPDATE SET
+    position = excluded.position,
+    type = excluded.type,
+    "order" = excluded."order",
+    abs_x = excluded.abs_x,
+    abs_y = excluded.abs_y,
+    abs_width = excluded.abs_width,
+    abs_height = excluded.abs_height,
+    rel_x = excluded.rel_x,
+    rel_y = excluded.rel_y,
+    rel_width = excluded.rel_width,
+    rel_height = excluded.rel_height,
+    text = excluded.text,
+    character_id = excluded.character_id,
+    subtype = excluded.subtype
+"""
+
+
+def _annotation_row(image_id: str, position: int, anno: dict) -> tuple:
+    abs_box = anno["bbox_abs"]
+    rel_box = anno["bbox_rel"]
+    return (
+        image_id, anno["id"], position, anno["type"], anno["order"],
+        abs_box["x"], abs_box["y"], abs_box["width"], abs_box["height"],
+        rel_box["x"], rel_box["y"], rel_box["width"], rel_box["height"],
+        anno["text"], anno.get("character_id"), anno.get("subtype"),
+    )
+
+
+class SQLiteStorage:
+    """ページとアノテーションを SQLite (WALモード) に保存するバックエンド
+
+    データベースはアノテーションディレクトリの隣に置きます
+    (data/annotations -> data/annotations.sqlite3)。
+    """
+
+    kind = "sqlite"
+
+    def __init__(self, anno_dir: Path, db_path: Optional[Path] = None):
+        self.anno_dir = Path(anno_dir)
+        self.db_path = Path(db_path) if db_path else self.anno_dir.parent / f"{self.anno_dir.name}.sqlite3"
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SCHEMA)
+        # version 列がなかった頃のデータベースに追加する
+        columns = {r[1] for r in self._conn.execute("PRAGMA table_info(pages)")}
+        if "version" not in columns:
+            self._conn.execute("ALTER TABLE pages ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def load(self, image_id: str) -> Optional[dict]:
+        with self._lock:
+            page = self._conn.execute(
+                "SELECT image_filename, width, height, page_summary, is_completed, version FROM pages WHERE image_id = ?",
+                (image_id,)
+            ).fetchone()
+            if page is None:
+                return None
+            rows = self._conn.execute(
+                """SELECT id, type, "order", abs_x, abs_y, abs_width, abs_height,
+                          rel_x, rel_y, rel_width, rel_height, text, character_id, subtype
+                   FROM annotations WHERE image_id = ? ORDER BY position""",
+                (image_id,)
+            ).fetchall()
+
+        # キーの並びは ImageAnnotation.model_dump() と同じにする（JSONとバイト互換にするため）
+        return {
+            "image_id": image_id,
+            "image_filename": page[0],
+            "image_size": {"width": page[1], "height": page[2]},
+            "page_summary": page[3],
+            "is_completed": bool(page[4]),
+            "annotations": [
+                {
+                    "id": r[0],
+                    "type": r[1],
+                    "order": r[2],
+                    "bbox_abs": {"x": r[3], "y": r[4], "width": r[5], "height": r[6]},
+                    "bbox_rel": {"x": r[7], "y": r[8], "width": r[9], "height": r[10]},
+                    "text": r[11],
+                    "character_id": r[12],
+                    "subtype": r[13],
+                }
+                for r in rows
+            ],
+            "version": page[5],
+        }
+
+    def save(self, image_id: str, annotation_data: dict, changed_ids=None, removed_ids=None) -> str:
+        """ページを保存
+
+        changed_ids / removed_ids が与えられた場合は該当行だけを UPSERT / DELETE します。
+        None の場合はページ全体を同期します。
+        """
+        size = annotation_data["image_size"]
+        annotations = annotation_data.get("annotations", [])
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(UPSERT_PAGE, (
+                    image_id, annotation_data["image_filename"], size["width"], size["height"],
+                    annotation_data.get("page_summary"), int(bool(annotation_data.get("is_completed", False))),
+                    time.time_ns(), int(annotation_data.get("version", 0)),
+                ))
+                if changed_ids is None:
+                    rows = [_annotation_row(image_id, i, a) for i, a in enumerate(annotations)]
+                    current = {a["id"] for a in annotations}
+                    existing = {r[0] for r in self._conn.execute(
+                        "SELECT id FROM annotations WHERE image_id = ?", (image_id,))}
+                    stale = existing - current
+                else:
+                    changed = set(changed_ids)
+                    rows = [_annotation_row(image_id, i, a) for i, a in enumerate(annotations) if a["id"] in changed]
+                    stale = set(removed_ids or ())
+                if stale:
+                    self._conn.executemany(
+                        "DELETE FROM annotations WHERE image_id = ? AND id = ?",
+                        [(image_id, anno_id) for anno_id in stale]
+                    )
+                if rows:
+                    self._conn.executemany(UPSERT_ANNOTATION, rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return str(self.db_path)
+
+    def compact_journals(self, max_age: Optional[float] = None) -> int:
+        # 行単位で書き込むのでジャーナルはない
+        return 0
+
+    def history(self, image_id: str, limit: int = 50) -> List[dict]:
+        raise NotImplementedError("SQLite バックエンドは編集履歴に対応していません")
+
+    def undo(self, image_id: str, version: Optional[int] = None) -> Optional[dict]:
+        raise NotImplementedError("SQLite バックエンドは取り消しに対応していません")
+
+    def stamp(self, image_id: str) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute("SELECT updated_ns FROM pages WHERE image_id = ?", (image_id,)).fetchone()
+        return row[0] if row else None
+
+    def page_ids(self) -> Iterable[str]:
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT image_id FROM pages")]
+
+    def change_token(self):
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*), MAX(updated_ns) FROM pages").fetchone()
+        return f"{row[0]}:{row[1]}"
+
+    def page_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT image_id, updated_ns FROM pages"))
+
+    def page_summaries(self, ids: Optional[Iterable[str]] = None) -> Dict[str, dict]:
+        # 区切り文字には本文に現れない制御文字 (US) を使う
+        query = """SELECT p.image_id, p.is_completed, p.updated_ns,
+                   (SELECT COUNT(*) FROM annotations a WHERE a.image_id = p.image_id),
+                   (SELECT GROUP_CONCAT(t, char(31)) FROM
+                       (SELECT DISTINCT type AS t FROM annotations a WHERE a.image_id = p.image_id ORDER BY t)),
+                   (SELECT GROUP_CONCAT(c, char(31)) FROM
+                       (SELECT DISTINCT character_id AS c FROM annotations a
+                        WHERE a.image_id = p.image_id AND character_id IS NOT NULL AND character_id != ''
+                        ORDER BY c))
+                   FROM pages p"""
+        with self._lock:
+            if ids is None:
+                rows = self._conn.execute(query).fetchall()
+            else:
+                ids = list(ids)
+                rows = []
+                # SQLite のパラメータ数上限に収まるよう分割
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    rows.extend(self._conn.execute(
+                        query + f" WHERE p.image_id IN ({','.join('?' * len(chunk))})",
+                        chunk
+                    ).fetchall())
+        return {
+            r[0]: {
+                "is_completed": bool(r[1]),
+                "annotation_count": r[3],
+                "types": r[4].split("\x1f") if r[4] else [],
+                "character_ids": r[5].split("\x1f") if r[5] else [],
+                "stamp": r[2],
+            }
+            for r in rows
+        }
+
+    def import_json_dir(self, json_dir: Path) -> dict:
+        """既存のJSONツリーを一括で取り込む（再実行しても同じ結果になる）"""
+        from models import ImageAnnotation
+
+        source = JsonStorage(json_dir)
+        # ジャーナルの内容をJSONに反映してから取り込む
+        source.compact_journals()
+        imported, failed, mismatched = 0, [], []
+        for image_id in sorted(source.page_ids()):
+            try:
+                raw = source.path(image_id).read_text(encoding='utf-8')
+                data = ImageAnnotation(**source.load(image_id)).model_dump()
+                self.save(image_id, data)
+            except Exception as e:
+                failed.append((image_id, str(e)))
+                continue
+            imported += 1
+            # アプリ以外で編集されたファイルは書式が異なる可能性があるので報告する
+            if dump_page_json(self.load(image_id)) != raw:
+                mismatched.append(image_id)
+        return {"imported": imported, "failed": failed, "not_byte_identical": mismatched}
+
+    def export_json_dir(self, out_dir: Path) -> int:
+        """全ページを従来形式のJSONファイルとして書き出す"""
+        # 書き出すのはページのJSONだけ（版番号のファイルは作らない）
+        target = JsonStorage(out_dir, journal=False, keep_versions=False)
+        count = 0
+        for image_id in sorted(self.page_ids()):
+            target.save(image_id, self.load(image_id))
+            count += 1
+        return count
+
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(anno_dir: Path):
+    """アノテーションディレクトリに対応するバックエンドを返す（ディレクトリごとに1つ）"""
+    key = str(Path(anno_dir))
+    with _storages_lock:
+        storage = _storages.get(key)
+        if storage is None:
+            if ANNOTATION_STORAGE == "sqlite":
+                storage = SQLiteStorage(Path(anno_dir))
+            else:
+                storage = JsonStorage(Path(anno_dir))
+            _storages[key] = storage
+        return storage
+
+
+if __name__ == "__main__":
+    import argparse
+    from utils import DEFAULT_ANNO_DIR
+
+    parser = argparse.ArgumentParser(description="アノテーションの SQLite 移行 / JSON エクスポート")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate", help="JSONツリーを SQLite に取り込む")
+    migrate.add_argument("--anno-dir", type=Path, default=DEFAULT_ANNO_DIR)
+    export = sub.add_parser("export", help="SQLite の内容をJSONファイルに書き出す")
+    export.add_argument("--anno-dir", type=Path, default=DEFAULT_ANNO_DIR)
+    export.add_argument("--out", type=Path, required=True)
+    compact = sub.add_parser("compact", help="JSONバックエンドのジャーナルをページのJSONに反映する")
+    compact.add_argument("--anno-dir", type=Path, default=DEFAULT_ANNO_DIR)
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        count = JsonStorage(args.anno_dir).compact_journals()
+        print(f"Compacted {count} journals in {args.anno_dir}")
+        raise SystemExit(0)
+
+    db = SQLiteStorage(args.anno_dir)
+    if args.command == "migrate":
+        result = db.import_json_dir(args.anno_dir)
+        print(f"Imported {result['imported']} pages into {db.db_path}")
+        for image_id, error in result["failed"]:
+            print(f"  failed: {image_id}: {error}")
+        if result["not_byte_identical"]:
+            print(f"  {len(result['not_byte_identical'])} pages will export with different formatting: "
+                  f"{', '.join(result['not_byte_identical'][:20])}")
+    else:
+        count = db.export_json_dir(args.out)
+        print(f"Exported {count} pages to {args.out}")
@@ -0,0 +1,169 @@
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+# 表情関連タグのホワイトリストパターン (faceタイプ用)
+# Danbooruの表情・顔パーツタグリストに基づく
+EXPRESSION_PATTERNS = [
+    # 1. 感情・表情 (Emotions & Expressions)
+    # ポジティブ
+    'smile', 'grin', 'laughing', 'happy', 'smug', 'doyagao', 'gentle_smile', 'excited', 'triumphant',
+    # ネガティブ
+    'angry', 'annoyed', 'frown', 'sad', 'crying', 'sobbing', 'tears', 'streaming_tears',
+    'scared', 'terror', 'screaming', 'nervous', 'worried', 'depressed', 'gloom', 'despair',
+    'serious', 'glare', 'scorn', 'disgust', 'pain',
+    # ニュートラル・その他
+    'expressionless', 'blank_stare', 'bored', 'sleepy', 'confused', 'surprised', 'shy',
+    'embarrassed', 'flustered', 'drunk', 'crazy', 'insane', 'aroused', 'ahegao', 'torogao',
+    'yandere', 'tsundere', 'kuudere',
+
+    # 2. 顔の状態・漫符 (Face States & Effects)
+    # 顔色・演出
+    'blush', 'heavy_blush', 'light_blush', 'blush_stickers', 'blue_face', 'turned_pale',
+    'shadowed_face', 'blood_on_face',
+    # 漫符・記号
+    'sweat', 'sweatdrop', 'flying_sweatdrops', 'anger_vein', 'popping_vein',
+    'gloom_(expression)', 'sparkles', 'breath_puff', 'nose_bubble',
+    # 分泌物・その他
+    'drooling', 'saliva', 'nosebleed', 'tear_drop', 'bags_under_eyes',
+    'cheek_press', 'makeup', 'facepaint',
+
+    # 3. 目の状態 (Eye States)
+    # 開閉・形状
+    'closed_eyes', 'half-closed_eyes', 'squinting', 'narrowed_eyes', 'wide_eyed', 'wink',
+    'one_eye_closed', 'forced_shut_eyes', 'tsurime', 'tareme', 'jitome', 'sanpaku',
+    # 瞳孔・ハイライト
+    'empty_eyes', 'hollow_eyes', 'button_eyes', 'constricted_pupils', 'dilated_pupils',
+    'slit_pupils', 'heart-shaped_pupils', 'star-shaped_pupils', 'symbol-shaped_pupils',
+    'mismatched_pupils', 'heterochromia', 'rolling_eyes', 'cross-eyed', 'no_pupils',
+    # 視線
+    'looking_at_viewer', 'looking_away', 'looking_back', 'looking_down', 'looking_up',
+    'looking_to_the_side', 'eye_contact',
+
+    # 4. 口の状態 (Mouth States)
+    # 開閉・基本
+    'open_mouth', 'closed_mouth', 'parted_lips', 'wide_mouth', 'pout', 'puffy_cheeks',
+    'grimace', 'lip_biting', 'holding_breath',
+    # 歯・舌
+    'clenched_teeth', 'showing_teeth', 'skin_fang', 'fang', 'sharp_teeth', 'shark_teeth',
+    'buck_teeth', 'tongue', 'tongue_out', 'licking_lips', 'forked_tongue',
+    # 形状・記号
+    'cat_mouth', ':3', 'triangle_mouth', 'wavy_mouth', 'dot_mouth', 'shark_mouth',
+
+    # 5. 顔文字・アスキーアートタグ (Kaomoji)
+    '^_^', '>_<', '@_@', '+_+', '=_=', 'o_o', '3_3', ';)', ':d', ':p', ':o',
+
+    # 6. 性的な表情・状態 (NSFW / Sexual Expressions & States)
+    'ahegao', 'torogao', 'orgasm_face', 'ecstasy', 'aroused',
+    'cum_on_face', 'ejaculated_on_face', 'cum_in_mouth', 'cum_on_tongue', 'facial', 'bukkake',
+    'cum_strings', 'cum_drip', 'saliva_strings',
+    'fellatio', 'deep_throat', 'blowjob', 'oral',
+    'gag', 'gagged', 'bit_gag', 'ball_gag', 'cleave_gag', 'ring_gag', 'spider_gag', 'tape_gag', 'hair_gag',
+    'collar', 'leash', 'neck_bell', 'neck_bolt', 'blindfold', 'eye_mask', 'nose_hook', 'mouth_mask',
+    'nuzzle', 'kiss', 'kissing', 'hickey', 'neck_kiss', 'cum_in_eye', 'cum_on_hair',
+]
+
+
+# 基本構造タグ（General カテゴリだが Rating の次に優先して並べる）
+PRIORITY_TAGS = {'1girl', '1boy', 'solo', 'monochrome', 'greyscale'}
+
+# キャラクタータグ・Rating のカテゴリ番号
+CHARACTER_CATEGORY = 4
+RATING_CATEGORY = 9
+
+# コンパイル済みのタグ表を保持する数（モデル × 除外タグ設定）
+TAG_TABLE_CACHE_SIZE = 8
+
+
+def is_expression_tag(tag_name: str) -> bool:
+    tag_lower = tag_name.lower()
+    return any(pattern in tag_lower for pattern in EXPRESSION_PATTERNS)
+
+
+class TagTable:
+    """ラベル表をタグの選別用の NumPy マスクにまとめたもの
+
+    除外タグ・キャラクタータグ・表情タグ（face 用ホワイトリスト）・優先タグの判定と、
+    同じ日本語名のタグのまとめ用の番号をラベルごとに1回だけ計算しておき、
+    推論結果ごとの選別・並べ替え・重複排除は配列演算で行います。
+    判定には元の英名を使用します（あれば）。
+    """
+
+    def __init__(self, labels: List[str], categories: Optional[List[int]], orig_labels: Optional[List[str]],
+                 excluded_tags: Sequence[str] = ()):
+        self.labels = list(labels)
+        filtering_names = orig_labels if orig_labels else self.labels
+        excluded = {t.lower() for t in excluded_tags}
+
+        category = np.asarray(categories if categories else [0] * len(self.labels), dtype=np.int32)
+        self.categories = category
+        self.rating = category == RATING_CATEGORY
+        self.priority = np.array([name in PRIORITY_TAGS for name in filtering_names], dtype=bool)
+        self.excluded = np.array([
+            name.lower() in excluded or label.lower() in excluded
+            for name, label in zip(filtering_names, self.labels)
+        ], dtype=bool)
+        self.expression = np.array([is_expression_tag(name) for name in filtering_names], dtype=bool)
+
+        # 除外タグとキャラクタータグ（カテゴリ4）は常に除く。faceタイプは表情関連タグのみ許可
+        self.allowed = ~self.excluded & (category != CHARACTER_CATEGORY)
+        self.face_allowed = self.allowed & self.expression
+
+        # 同じ表示名（日本語名）のラベルに同じ番号を振る
+        name_ids = {}
+        self.name_ids = np.array([name_ids.setdefault(label, len(name_ids)) for label in self.labels], dtype=np.int64)
+
+    def ranked(self, probs, threshold: float, annotation_type: Optional[str] = None, dedupe: bool = True):
+        """選別して並べ替えたラベルの番号と信頼度（dedupe=False なら同じ日本語名のタグもまとめない）"""
+        probs = np.asarray(probs)
+        allowed = self.face_allowed if annotation_type == 'face' else self.allowed
+        index = np.flatnonzero((probs >= threshold) & allowed)
+        confidence = probs[index]
+
+        # 1. カテゴリ9 (Rating) 2. 基本構造タグ 3. 信頼度の高い順（lexsort は安定なので同順位は元の順）
+        order = np.lexsort((-confidence, ~self.priority[index], ~self.rating[index]))
+        index, confidence = index[order], confidence[order]
+
+        if not dedupe:
+            return index, confidence
+
+        # 同じ日本語名のタグは信頼度が最も高いもの（同じなら先に並ぶもの）だけを、その位置に残す
+        groups = self.name_ids[index]
+        by_group = np.lexsort((np.arange(len(index)), -confidence, groups))
+        first = np.ones(len(by_group), dtype=bool)
+        first[1:] = groups[by_group][1:] != groups[by_group][:-1]
+        keep = np.sort(by_group[first])
+        return index[keep], confidence[keep]
+
+    def select(self, probs, threshold: float, annotation_type: Optional[str] = None):
+        """タグごとの確率から、閾値・除外タグ・アノテーションタイプに応じたタグ一覧を作る
+
+        戻り値は (カンマ区切りのタグ文字列, [{"tag", "confidence"}, ...])。
+        """
+        index, confidence = self.ranked(probs, threshold, annotation_type)
+        tags = [{"tag": self.labels[i], "confidence": float(c)} for i, c in zip(index, confidence)]
+        tag_text = ", ".join(t["tag"] for t in tags)
+        return tag_text, tags
+
+
+_tables: "OrderedDict[tuple, TagTable]" = OrderedDict()
+_tables_lock = threading.Lock()
+
+
+def get_tag_table(model_id: str, labels: List[str], categories: Optional[List[int]],
+                  orig_labels: Optional[List[str]], excluded_tags: Sequence[str] = ()) -> TagTable:
+    """モデルと除外タグ設定ごとにコンパイル済みの TagTable を返す"""
+    key = (model_id, frozenset(t.lower() for t in excluded_tags))
+    with _tables_lock:
+        table = _tables.get(key)
+        if table is not None:
+            _tables.move_to_end(key)
+            return table
+    table = TagTable(labels, categories, orig_labels, excluded_tags)
+    with _tables_lock:
+        _tables[key] = table
+        while len(_tables) > TAG_TABLE_CACHE_SIZE:
+            _tables.popitem(last=False)
+    return table
@@ -3,9 +3,8 @@ from PIL import Image
 from pathlib import Path
 import timm
 from timm.data import resolve_data_config, create_transform
-from huggingface_hub import hf_hub_download
-import csv
-import os
+
+from inference import load_tag_table
 
 # WD Tagger の設定
 TAGGER_THRESHOLD = 0.6
@@ -29,31 +28,10 @@ def initialize_tagger():
     config = resolve_data_config(model.pretrained_cfg)
     transform = create_transform(**config)
     
-    # ラベルファイル取得 (ローカルの日本語版があれば優先)
-    backend_dir = Path(__file__).parent
-    local_label_path = backend_dir / "selected_tags_ja.csv"
-    
-    orig_labels = None
-    
-    if local_label_path.exists():
-        print(f"Loading local Japanese tag labels from {local_label_path}")
-        with open(local_label_path, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-            labels = [row["name"] for row in rows]
-            categories = [int(row.get("category", 0)) for row in rows]
-            if "original_en" in rows[0]:
-                orig_labels = [row["original_en"] for row in rows]
-    else:
-        print(f"Downloading labels from Hugging Face...")
-        label_path = hf_hub_download(repo_id=MODEL_ID, filename="selected_tags.csv")
-        with open(label_path, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-            labels = [row["name"] for row in rows]
-            categories = [int(row.get("category", 0)) for row in rows]
+    # ラベルは API と同じ選別表（キャラクタータグ・優先タグのマスク。除外タグは使わない）にまとめて読み込む
+    tag_table = load_tag_table(MODEL_ID)
     
-    return model, transform, labels, categories, orig_labels
+    return model, transform, tag_table
 
 def main():
     # 画像パス
@@ -64,7 +42,7 @@ def main():
         return
 
     # Taggerの初期化
-    model, transform, labels, categories, orig_labels = initialize_tagger()
+    model, transform, tag_table = initialize_tagger()
     
     # 画像の読み込みと変換
     img = Image.open(image_path)
@@ -82,41 +60,13 @@ def main():
         outputs = model(input_tensor)
         probs = torch.sigmoid(outputs).cpu().numpy()[0]
     
-    # タグの抽出
-    detected_tags = []
-    for i, prob in enumerate(probs):
-        if prob >= TAGGER_THRESHOLD:
-            tag_name = labels[i]
-            filtering_name = orig_labels[i] if orig_labels else tag_name
-            category = categories[i] if categories else 0
-            
-            # キャラクタータグ（カテゴリ4）を除外
-            if category == 4:
-                continue
-                
-            detected_tags.append({
-                "tag": tag_name,
-                "confidence": float(prob),
-                "category": category,
-                "orig_tag": filtering_name
-            })
-    
-    # ソート (Rating優先, その他信頼度順)
-    priority_tags = {'1girl', '1boy', 'solo', 'monochrome', 'greyscale'}
-    def sort_key(x):
-        is_rating = (x["category"] == 9)
-        is_priority = (x.get("orig_tag", x["tag"]) in priority_tags)
-        k1 = 0 if is_rating else 1
-        k2 = 0 if is_priority else 1
-        k3 = -x["confidence"]
-        return (k1, k2, k3)
-    
-    detected_tags.sort(key=sort_key)
+    # タグの抽出（キャラクタータグを除外し、Rating優先・その他信頼度順。同名のタグもそのまま表示する）
+    index, confidence = tag_table.ranked(probs, TAGGER_THRESHOLD, dedupe=False)
     
     # 結果の表示
     print("\n--- Detected Tags ---")
-    for t in detected_tags:
-        print(f"{t['tag']} (Confidence: {t['confidence']:.4f}, Category: {t['category']})")
+    for i, c in zip(index, confidence):
+        print(f"{tag_table.labels[i]} (Confidence: {c:.4f}, Category: {tag_table.categories[i]})")
 
 if __name__ == "__main__":
     main()
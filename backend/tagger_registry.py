@@ -0,0 +1,136 @@
+import gc
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+# 同時にメモリに置いておく WD Tagger モデルの最大数
+TAGGER_MAX_MODELS = int(os.environ.get("TAGGER_MAX_MODELS", "2"))
+# 読み込んだモデルの合計サイズの上限（バイト、0 なら上限なし）
+TAGGER_MEMORY_BUDGET = int(os.environ.get("TAGGER_MEMORY_BUDGET", "0"))
+
+
+def release_memory():
+    """解放したモデルのメモリを OS に返す"""
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    try:
+        # glibc は解放済みの領域を抱えたままにするので明示的に返す
+        import ctypes
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except Exception:
+        pass
+
+
+class TaggerRegistry:
+    """読み込み済みの WD Tagger モデルの LRU
+
+    キーは (model_id, バックエンド指定)。max_models 個または memory_budget バイトを超える場合は、
+    最後に使われたのが最も古いモデルから捨てて release_memory() で解放します。
+    読み込みは1件ずつ行い、新しいモデルを読み込む前に枠を空けるのでピークのメモリも上限内に収まります。
+    捨てたモデルを推論中のスレッドがあれば、そのモデルは推論が終わった時点で解放されます。
+    """
+
+    def __init__(self, max_models: int = TAGGER_MAX_MODELS, memory_budget: int = TAGGER_MEMORY_BUDGET):
+        self.max_models = max(1, max_models)
+        self.memory_budget = memory_budget
+        self._entries: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._known_sizes = {}  # key -> 前回読み込んだときのサイズ（読み込み前の追い出し量の見積もり用）
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, key: tuple, loader: Callable[[], tuple]):
+        """key のモデルを返す。なければ loader() -> (モデル, サイズ[バイト]) で読み込む"""
+        model = self._lookup(key)
+        if model is not None:
+            return model
+        with self._load_lock:
+            # 待っている間に他のスレッドが読み込んでいればそれを使う
+            model = self._lookup(key)
+            if model is not None:
+                return model
+            with self._lock:
+                evicted = self._evict(self.max_models - 1, self._known_sizes.get(key, 0))
+            if evicted:
+                release_memory()
+            model, nbytes = loader()
+            now = time.time()
+            with self._lock:
+                self._entries[key] = {
+                    "model": model, "bytes": nbytes, "loaded_at": now, "last_used": now, "uses": 1,
+                }
+                self._known_sizes[key] = nbytes
+                self.loads += 1
+                # 読み込んでみて予算を超えていれば、今読み込んだもの以外を追い出す
+                evicted = self._evict(self.max_models, 0, keep=key)
+            if evicted:
+                release_memory()
+            return model
+
+    def _lookup(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            entry["last_used"] = time.time()
+            entry["uses"] += 1
+            return entry["model"]
+
+    def _evict(self, max_entries: int, incoming: int, keep: Optional[tuple] = None) -> list:
+        """件数が max_entries 以下、合計が予算 - incoming 以下になるまで古いものから外す（_lock 内で呼ぶ）"""
+        evicted = []
+        for key in list(self._entries):
+            total = sum(entry["bytes"] for entry in self._entries.values())
+            over_budget = self.memory_budget > 0 and total + incoming > self.memory_budget
+            if len(self._entries) <= max_entries and not over_budget:
+                break
+            if key == keep:
+                continue
+            self._entries.pop(key)
+            evicted.append(key)
+            self.evictions += 1
+            print(f"WD Tagger: unloaded {key[0]} ({key[1][0]})")
+        return evicted
+
+    def unload(self, model_id: Optional[str] = None) -> int:
+        """model_id のモデル（省略時はすべて）を捨てて解放する。捨てた数を返す"""
+        with self._lock:
+            keys = [key for key in self._entries if model_id is None or key[0] == model_id]
+            for key in keys:
+                self._entries.pop(key)
+        if keys:
+            release_memory()
+        return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = [
+                {
+                    "model_id": key[0],
+                    "backend": list(key[1]),
+                    "bytes": entry["bytes"],
+                    "loaded_at": entry["loaded_at"],
+                    "last_used": entry["last_used"],
+                    "uses": entry["uses"],
+                }
+                for key, entry in reversed(self._entries.items())
+            ]
+            return {
+                "pid": os.getpid(),
+                "models": models,
+                "bytes": sum(model["bytes"] for model in models),
+                "max_models": self.max_models,
+                "memory_budget": self.memory_budget,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+tagger_registry = TaggerRegistry()
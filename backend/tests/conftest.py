@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# backend/ のモジュールはフラットに import する
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
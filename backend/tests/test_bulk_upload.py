@@ -0,0 +1,74 @@
+import io
+
+from PIL import Image
+
+import bulk_upload
+from bulk_upload import run_bulk_upload
+
+
+class Upload:
+    def __init__(self, filename: str, data: bytes):
+        self.filename = filename
+        self.file = io.BytesIO(data)
+
+
+class Store:
+    def __init__(self):
+        self.pages = {}
+
+    def put(self, anno_dir, image_id, page):
+        self.pages[image_id] = page
+
+    def flush(self):
+        pass
+
+
+class Manifest:
+    def image_added(self, image_id, image_path):
+        pass
+
+
+def png(width: int, height: int) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def upload(tmp_path, files, upload_id, store=None):
+    return run_bulk_upload(tmp_path / "images", tmp_path / "annotations", files,
+                           store or Store(), Manifest(), upload_id)
+
+
+def test_resume_with_remaining_files(tmp_path, monkeypatch):
+    (tmp_path / "images").mkdir()
+    (tmp_path / "annotations").mkdir()
+    a, b, c = png(5, 5), png(6, 6), png(7, 7)
+
+    write_image = bulk_upload._write_image
+
+    def interrupted(item, image_path):
+        if item.name == "b.png":
+            raise OSError("interrupted")
+        return write_image(item, image_path)
+
+    monkeypatch.setattr(bulk_upload, "_write_image", interrupted)
+    first = upload(tmp_path, [Upload("a.png", a), Upload("b.png", b), Upload("c.png", c)], "resume")
+    assert [r["status"] for r in first["results"]] == ["created", "error", "created"]
+    reserved = first["results"][1]["image_id"]
+
+    # 残りのファイルだけを送り直すと、前回予約した番号で登録される
+    monkeypatch.setattr(bulk_upload, "_write_image", write_image)
+    second = upload(tmp_path, [Upload("b.png", b)], "resume")
+    assert [(r["status"], r["image_id"]) for r in second["results"]] == [("created", reserved)]
+    assert sorted(p.name for p in (tmp_path / "images").iterdir()) == ["00001.png", "00002.png", "00003.png"]
+    assert not bulk_upload.UploadSession(tmp_path / "annotations", "resume").path.exists()
+
+
+def test_identical_files_in_one_request_are_kept_apart(tmp_path):
+    (tmp_path / "images").mkdir()
+    (tmp_path / "annotations").mkdir()
+    same = png(5, 5)
+
+    first = upload(tmp_path, [Upload("dup.png", same), Upload("dup.png", same)], "dup")
+    assert [r["status"] for r in first["results"]] == ["created", "created"]
+    assert first["results"][0]["image_id"] != first["results"][1]["image_id"]
@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from models import ImageAnnotation
+from storage import JsonStorage, SQLiteStorage
+
+
+def make_page(image_id: str, texts, version: int = 0) -> dict:
+    # アプリが保存するときと同じ形（ImageAnnotation.model_dump()）にする
+    return ImageAnnotation(**{
+        "image_id": image_id,
+        "image_filename": f"{image_id}.jpg",
+        "image_size": {"width": 100, "height": 100},
+        "page_summary": "",
+        "is_completed": False,
+        "annotations": [
+            {
+                "id": f"anno_{i}", "type": "dialogue", "order": i + 1, "text": text,
+                "bbox_abs": {"x": 0, "y": 0, "width": 10, "height": 10},
+                "bbox_rel": {"x": 0, "y": 0, "width": 0.1, "height": 0.1},
+                "character_id": None, "subtype": None,
+            }
+            for i, text in enumerate(texts)
+        ],
+        "version": version,
+    }).model_dump()
+
+
+def test_json_undo_walks_back_edits(tmp_path):
+    storage = JsonStorage(tmp_path / "annotations")
+    storage.save("00001", make_page("00001", ["a"], version=1))
+    storage.save("00001", make_page("00001", ["a", "b"], version=2))
+    storage.save("00001", make_page("00001", ["a", "b", "c"], version=3))
+
+    page = storage.undo("00001", version=4)
+    assert [a["text"] for a in page["annotations"]] == ["a", "b"]
+    assert page["version"] == 4
+    page = storage.undo("00001", version=5)
+    assert [a["text"] for a in page["annotations"]] == ["a"]
+    assert page["version"] == 5
+    assert storage.undo("00001", version=6) is None
+
+
+def test_sqlite_undo_is_not_supported(tmp_path):
+    storage = SQLiteStorage(tmp_path / "annotations")
+    storage.save("00001", make_page("00001", ["a"], version=1))
+    # 呼び出し側（POST /annotations/{id}/undo）と同じ引数で 400 用の例外になる
+    with pytest.raises(NotImplementedError):
+        storage.undo("00001", version=2)
+    with pytest.raises(NotImplementedError):
+        storage.undo("00001")
+
+
+def test_version_is_kept_out_of_page_json(tmp_path):
+    storage = JsonStorage(tmp_path / "annotations")
+    storage.save("00001", make_page("00001", ["a"], version=1))
+    storage.save("00001", make_page("00001", ["a", "b"], version=2))
+    storage.compact_journals()
+    assert "version" not in json.loads(storage.path("00001").read_text(encoding="utf-8"))
+    # 再起動後も同じ版番号から続ける
+    assert JsonStorage(tmp_path / "annotations").load("00001")["version"] == 2
+
+    sqlite = SQLiteStorage(tmp_path / "db")
+    result = sqlite.import_json_dir(tmp_path / "annotations")
+    assert result["not_byte_identical"] == []
+    assert sqlite.load("00001")["version"] == 2
+
+    assert sqlite.export_json_dir(tmp_path / "export") == 1
+    exported = (tmp_path / "export" / "00001.json").read_text(encoding="utf-8")
+    assert exported == storage.path("00001").read_text(encoding="utf-8")
+    assert not (tmp_path / "export" / ".journal").exists()
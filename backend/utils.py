@@ -1,4 +1,6 @@
 import json
+import os
+import tempfile
 from pathlib import Path
 from models import BoundingBoxAbs, BoundingBoxRel
 
@@ -7,6 +9,14 @@ DEFAULT_IMAGES_DIR = BASE_DIR / "data" / "images"
 DEFAULT_ANNO_DIR = BASE_DIR / "data" / "annotations"
 
 
+def state_path(data_dir: Path, name: str) -> Path:
+    """ディレクトリに付随する内部状態ファイルのパス (data/.state/{ディレクトリ名}.{name})"""
+    data_dir = Path(data_dir)
+    state_dir = data_dir.parent / ".state"
+    state_dir.mkdir(parents=True, exist_ok=True)
+    return state_dir / f"{data_dir.name}.{name}"
+
+
 def absolute_to_relative(bbox_abs: BoundingBoxAbs, image_width: int, image_height: int) -> BoundingBoxRel:
     """絶対座標を相対座標に変換"""
     return BoundingBoxRel(
@@ -28,9 +38,12 @@ def relative_to_absolute(bbox_rel: BoundingBoxRel, image_width: int, image_heigh
 
 
 def get_next_image_number(image_dir: Path = None, anno_dir: Path = None) -> str:
-    """次の画像番号を取得（5桁の連番）
-    画像ディレクトリとアノテーションディレクトリの両方を確認し、最大の番号+1を返します。
+    """次の画像番号を取得（5桁の連番、予約はしない）
+    永続化されたカウンタを参照します。初回のみ画像・アノテーションの既存ファイルから初期値を決めます。
+    実際にアップロードする場合は id_allocator.get_allocator(...).allocate() で予約してください。
     """
+    from id_allocator import get_allocator
+
     if image_dir is None:
         image_dir = DEFAULT_IMAGES_DIR
     if anno_dir is None:
@@ -39,60 +52,41 @@ def get_next_image_number(image_dir: Path = None, anno_dir: Path = None) -> str:
     image_dir.mkdir(parents=True, exist_ok=True)
     anno_dir.mkdir(parents=True, exist_ok=True)
     
-    # 画像ファイルとJSONファイルの両方をスキャン
-    files = []
-    # すべてのファイルを取得して、拡張子でフィルタリングする方が確実
-    for file in image_dir.iterdir():
-        if file.suffix.lower() in ['.jpg', '.jpeg', '.png', '.webp']:
-            files.append(file)
-            
-    for file in anno_dir.iterdir():
-        if file.suffix.lower() == '.json':
-            files.append(file)
-    
-    print(f"DEBUG: Scanned files: {[f.name for f in files]}")
-    
-    if not files:
-        return "00001"
-    
-    # ファイル名から番号を抽出
-    numbers = []
-    for file in files:
-        stem = file.stem
+    return get_allocator(image_dir, anno_dir).peek()
+
+
+def atomic_write_text(path: Path, text: str):
+    """一時ファイルに書いてから rename する（書きかけのファイルを残さない）"""
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
         try:
-            num = int(stem)
-            numbers.append(num)
-        except ValueError:
-            continue
-    
-    print(f"DEBUG: Found numbers: {numbers}")
-    
-    if not numbers:
-        return "00001"
-    
-    next_num = max(numbers) + 1
-    result = f"{next_num:05d}"
-    print(f"DEBUG: Next number: {result}")
-    return result
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
 
 
-def save_annotation_json(annotation_data: dict, image_id: str, data_dir: Path = DEFAULT_ANNO_DIR):
-    """アノテーションデータをJSONファイルに保存"""
-    data_dir.mkdir(parents=True, exist_ok=True)
-    
-    json_path = Path(data_dir) / f"{image_id}.json"
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(annotation_data, f, ensure_ascii=False, indent=2)
-    
-    return str(json_path)
+def save_annotation_json(annotation_data: dict, image_id: str, data_dir: Path = DEFAULT_ANNO_DIR,
+                         changed_ids=None, removed_ids=None):
+    """アノテーションデータを保存（JSONはアトミック書き込み、SQLiteは変更行のみUPSERT）"""
+    from storage import get_storage
+    return get_storage(Path(data_dir)).save(image_id, annotation_data, changed_ids, removed_ids)
 
 
 def load_annotation_json(image_id: str, data_dir: Path = DEFAULT_ANNO_DIR) -> dict:
-    """アノテーションデータをJSONファイルから読み込み"""
-    json_path = Path(data_dir) / f"{image_id}.json"
-    
-    if not json_path.exists():
-        return None
-    
-    with open(json_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    """アノテーションデータを読み込み（存在しなければ None）"""
+    from storage import get_storage
+    return get_storage(Path(data_dir)).load(image_id)
+
+
+def annotation_stamp(image_id: str, data_dir: Path = DEFAULT_ANNO_DIR):
+    """保存済みデータの更新検出用の値（外部での書き換え検出に使う）"""
+    from storage import get_storage
+    return get_storage(Path(data_dir)).stamp(image_id)
@@ -8,6 +8,7 @@ let startX = 0;
 let startY = 0;
 let currentRect = null;
 let annotations = [];
+let currentPageVersion = null; // 表示中のページの版番号（差分同期と If-Match に使う）
 let loadedImage = null; // キャッシュ用画像オブジェクト
 
 // API Base URL (動的に構築)
@@ -26,6 +27,21 @@ function getAuthHeaders() {
     return headers;
 }
 
+// ページを書き換えるリクエスト用のヘッダー（表示中の版を If-Match で送り、他で更新されていれば 409）
+function pageWriteHeaders() {
+    const headers = getAuthHeaders();
+    if (currentPageVersion !== null) {
+        headers['If-Match'] = `"${currentPageVersion}"`;
+    }
+    return headers;
+}
+
+// レスポンスの ETag からページの版番号を取り出す
+function pageVersionFromResponse(response) {
+    const match = /^(?:W\/)?"(\d+)"$/.exec(response.headers.get('ETag') || '');
+    return match ? parseInt(match[1]) : null;
+}
+
 // 認証エラーハンドリング
 async function handleResponse(response) {
     if (response.status === 401) {
@@ -75,7 +91,9 @@ async function checkAuth() {
                 if (uploadSection) uploadSection.style.display = 'none';
                 if (imageListSection) {
                     imageListSection.style.display = 'block';
+                    imageListEnabled = true;
                     loadImageList(); // ゲスト用画像リストを読み込む
+                    connectEvents();
                 }
             }
         }
@@ -86,28 +104,37 @@ async function checkAuth() {
 
 // OTP生成削除済み
 
-// 画像リストを読み込む (ゲスト用)
-async function loadImageList() {
+// 画像リストのページング状態 (ゲスト用)
+const IMAGE_LIST_PAGE_SIZE = 200;
+const LOAD_MORE_VALUE = '__more__';
+let imageListCursor = null;
+let imageListEnabled = false; // 画像セレクターを使う（ゲスト）なら一覧の変更通知も受け取る
+
+// 画像リストを読み込む (ゲスト用, append=true なら次のページを追加)
+async function loadImageList(append = false) {
     try {
-        const response = await handleResponse(await fetch(`${API_BASE}/annotations-list`, {
+        const params = new URLSearchParams({ limit: IMAGE_LIST_PAGE_SIZE });
+        if (append && imageListCursor) params.set('cursor', imageListCursor);
+
+        const response = await handleResponse(await fetch(`${API_BASE}/annotations-list?${params}`, {
             headers: getAuthHeaders()
         }));
         if (!response.ok) throw new Error('Failed to load image list');
 
         const data = await response.json();
         const selector = document.getElementById('imageSelector');
+        imageListCursor = data.next_cursor;
 
-        // 既存のオプションをクリア（最初のプレースホルダーは残す）
-        selector.innerHTML = '<option value="">-- 画像を選択してください --</option>';
+        if (!append) {
+            // 既存のオプションをクリア（最初のプレースホルダーは残す）
+            selector.innerHTML = '<option value="">-- 画像を選択してください --</option>';
+        } else {
+            // 「さらに読み込む」を一旦外して末尾に追加し直す
+            selector.querySelector(`option[value="${LOAD_MORE_VALUE}"]`)?.remove();
+        }
 
         if (data.images && data.images.length > 0) {
-            // 数値として正しくソート (1, 2, 3, ... 10, 11 の順)
-            data.images.sort((a, b) => {
-                const numA = parseInt(a.id) || 0;
-                const numB = parseInt(b.id) || 0;
-                return numA - numB;
-            });
-
+            // サーバーがID順（数値順）で返すのでそのまま追加
             data.images.forEach(img => {
                 const option = document.createElement('option');
                 option.value = img.id;
@@ -115,13 +142,23 @@ async function loadImageList() {
                 selector.appendChild(option);
             });
 
+            if (imageListCursor) {
+                const more = document.createElement('option');
+                more.value = LOAD_MORE_VALUE;
+                more.textContent = `… さらに読み込む (${data.total} 件中)`;
+                selector.appendChild(more);
+            }
+
             // 選択イベントリスナーを追加
             selector.onchange = (e) => {
-                if (e.target.value) {
+                if (e.target.value === LOAD_MORE_VALUE) {
+                    e.target.value = currentImageId || '';
+                    loadImageList(true);
+                } else if (e.target.value) {
                     selectImageFromList(e.target.value);
                 }
             };
-        } else {
+        } else if (!append) {
             const option = document.createElement('option');
             option.value = '';
             option.textContent = '画像がありません';
@@ -163,25 +200,62 @@ async function compactOrderNumbers() {
     });
 
     // 各アノテーションのorderを更新
-    let updated = false;
+    const operations = [];
     for (const anno of annotations) {
         const newOrder = orderMap[anno.order];
         if (newOrder !== anno.order) {
             anno.order = newOrder;
-            // バックエンドに保存
-            await fetch(`${API_BASE}/annotations/${currentImageId}/${anno.id}`, {
-                method: 'PUT',
-                headers: getAuthHeaders(),
-                body: JSON.stringify(anno)
-            });
-            updated = true;
+            operations.push({ op: 'update', annotation_id: anno.id, data: { order: newOrder } });
+        }
+    }
+
+    // 更新があった場合はまとめてバックエンドに保存してログ出力
+    if (operations.length > 0) {
+        try {
+            // ローカルには同じ変更を適用済みなので、サーバーの新しい版をそのまま手元の版にする
+            const result = await applyAnnotationBatch(currentImageId, operations);
+            currentPageVersion = result.version;
+            console.log('Order numbers compacted:', orderMap);
+        } catch (error) {
+            console.error('Order compaction error:', error);
         }
     }
+}
+
+// 1ページへの複数の編集をまとめて送信（サーバー側ではすべて成功した場合だけ反映され、書き出しも1回）
+async function applyAnnotationBatch(imageId, operations) {
+    const response = await handleResponse(await fetch(`${API_BASE}/annotations/${imageId}/batch`, {
+        method: 'POST',
+        headers: pageWriteHeaders(),
+        body: JSON.stringify({ operations })
+    }));
+    await checkPageWrite(response, '一括更新に失敗しました');
+    return response.json();
+}
+
+// ページを書き換えるリクエストの結果を確認（他の編集で版が進んでいた 409 なら最新の状態を取り込んでからエラー）
+async function checkPageWrite(response, message) {
+    if (response.status === 409) {
+        await syncAnnotations();
+        throw new Error('他の画面での編集と競合しました。最新の状態を読み込んだので、もう一度操作してください');
+    }
+    if (!response.ok) {
+        const errorData = await response.json().catch(() => ({}));
+        throw new Error(typeof errorData.detail === 'string' ? errorData.detail : `${message} (${response.status})`);
+    }
+}
 
-    // 更新があった場合はログ出力
-    if (updated) {
-        console.log('Order numbers compacted:', orderMap);
+// 差分の1件をアノテーション配列に適用（サーバーの storage.apply_page_record と同じ規則）
+function applyPageChange(list, change) {
+    const removed = new Set(change.del || []);
+    const byId = new Map(list.filter(a => !removed.has(a.id)).map(a => [a.id, a]));
+    for (const anno of change.set || []) {
+        byId.set(anno.id, anno);
     }
+    if (!change.ids) return [...byId.values()];
+    const listed = new Set(change.ids);
+    const ordered = change.ids.filter(id => byId.has(id)).map(id => byId.get(id));
+    return ordered.concat([...byId.values()].filter(a => !listed.has(a.id)));
 }
 
 // リストから画像を選択
@@ -196,15 +270,17 @@ async function selectImageFromList(imageId) {
         const data = await response.json();
 
         // グローバル変数を更新
+        if (data.image_id !== currentImageId) currentPageVersion = null;
         currentImageId = data.image_id;
         currentImageSize = data.image_size;
         annotations = data.annotations || [];
+        currentPageVersion = data.version;
 
         // order番号の欠番を自動で詰める処理
         await compactOrderNumbers();
 
         // 画像を読み込む
-        loadImage(data.image_filename);
+        loadImage(data);
 
         // UI更新
         document.getElementById('imageInfo').textContent =
@@ -217,6 +293,9 @@ async function selectImageFromList(imageId) {
         // ページサマリーを表示
         document.getElementById('pageSummaryInput').value = data.page_summary || '';
 
+        // 他の画面での編集の通知を受け取る
+        watchCurrentPage();
+
         showToast(`画像 ${imageId} を読み込みました`);
     } catch (error) {
         console.error('Image selection error:', error);
@@ -224,14 +303,58 @@ async function selectImageFromList(imageId) {
     }
 }
 
-// 認証付きで画像を取得
-async function authFetchImage(filename) {
-    const response = await handleResponse(await fetch(`${API_BASE}/images/${filename}`, {
+// 取得済み画像のオブジェクトURL（内容ハッシュ付きのURLのみ。ページを行き来しても再取得しない）
+const imageUrlCache = new Map();
+const IMAGE_URL_CACHE_SIZE = 16;
+
+// 認証付きで画像を取得（path は /images/... の URL）
+async function authFetchImage(path) {
+    const cached = imageUrlCache.get(path);
+    if (cached) {
+        // 最近使ったものとして末尾に移す
+        imageUrlCache.delete(path);
+        imageUrlCache.set(path, cached);
+        return cached;
+    }
+    const response = await handleResponse(await fetch(`${API_BASE}${path}`, {
         headers: getAuthHeaders()
     }));
     if (!response.ok) throw new Error('Image load failed');
     const blob = await response.blob();
-    return URL.createObjectURL(blob);
+    const url = URL.createObjectURL(blob);
+    if (path.includes('?v=')) {
+        imageUrlCache.set(path, url);
+        if (imageUrlCache.size > IMAGE_URL_CACHE_SIZE) {
+            const [oldPath, oldUrl] = imageUrlCache.entries().next().value;
+            imageUrlCache.delete(oldPath);
+            URL.revokeObjectURL(oldUrl);
+        }
+    }
+    return url;
+}
+
+// キャッシュしていないオブジェクトURLを解放する
+function releaseImageUrl(url) {
+    if (![...imageUrlCache.values()].includes(url)) {
+        URL.revokeObjectURL(url);
+    }
+}
+
+// 表示サイズに合う縮小版のURLを選ぶ（表示幅 × devicePixelRatio 以上で最小のもの、なければ元画像）
+async function pickRenditionUrl(imageId, filename, displayWidth) {
+    try {
+        const response = await handleResponse(await fetch(`${API_BASE}/images/${imageId}/renditions`, {
+            headers: getAuthHeaders()
+        }));
+        if (!response.ok) throw new Error('Rendition list failed');
+        const info = await response.json();
+        const needed = displayWidth * (window.devicePixelRatio || 1);
+        const rendition = info.renditions.find(r => r.width >= needed);
+        return rendition ? rendition.url : info.original;
+    } catch (err) {
+        console.error(err);
+        return `/images/${filename}`;
+    }
 }
 
 // 初期化
@@ -315,9 +438,9 @@ document.addEventListener('DOMContentLoaded', () => {
     imageContainer.addEventListener('drop', (e) => {
         e.preventDefault();
         imageContainer.classList.remove('drag-over');
-        const file = e.dataTransfer.files[0];
-        if (file && file.type.startsWith('image/')) {
-            uploadImage(file);
+        const files = Array.from(e.dataTransfer.files).filter(isUploadableFile);
+        if (files.length > 0) {
+            uploadImage(files);
         }
     });
 
@@ -337,16 +460,29 @@ document.addEventListener('DOMContentLoaded', () => {
 });
 
 // 画像アップロード
+const ARCHIVE_EXTENSIONS = ['.zip', '.cbz'];
+
+function isArchiveFile(file) {
+    const name = file.name.toLowerCase();
+    return ARCHIVE_EXTENSIONS.some(ext => name.endsWith(ext));
+}
+
+function isUploadableFile(file) {
+    return file.type.startsWith('image/') || isArchiveFile(file);
+}
+
 async function uploadImage(fileOrEvent) {
-    let file;
+    let files;
     if (fileOrEvent instanceof File) {
-        file = fileOrEvent;
+        files = [fileOrEvent];
+    } else if (Array.isArray(fileOrEvent)) {
+        files = fileOrEvent;
     } else {
         const fileInput = document.getElementById('imageUpload');
-        file = fileInput.files[0];
+        files = Array.from(fileInput.files);
     }
 
-    if (!file) {
+    if (files.length === 0) {
         // もしイベントから呼ばれてファイルもなければ（ボタン押しのみなど）
         if (!(fileOrEvent instanceof File)) {
             alert('画像ファイルを選択してください');
@@ -354,8 +490,14 @@ async function uploadImage(fileOrEvent) {
         return;
     }
 
+    // 複数ファイルやアーカイブは一括アップロード
+    if (files.length > 1 || isArchiveFile(files[0])) {
+        await uploadImagesBulk(files);
+        return;
+    }
+
     const formData = new FormData();
-    formData.append('file', file);
+    formData.append('file', files[0]);
 
     try {
         const response = await handleResponse(await fetch(`${API_BASE}/upload`, {
@@ -372,37 +514,104 @@ async function uploadImage(fileOrEvent) {
         }
 
         const data = await response.json();
-        currentImageId = data.image_id;
-        currentImageSize = data.image_size;
+        showUploadedImage(data);
+        showToast('画像を読み込みました');
 
-        // 画像を表示
-        loadImage(data.image_filename);
+    } catch (error) {
+        showToast('エラー: ' + error.message, true);
+    }
+}
 
-        // UI更新
-        document.getElementById('imageInfo').textContent =
-            `画像ID: ${data.image_id} | サイズ: ${data.image_size.width}x${data.image_size.height}`;
-        document.getElementById('placeholderText').style.display = 'none';
+// 一括アップロード（失敗したら同じファイルを選び直すと続きから再開）
+async function uploadImagesBulk(files) {
+    // ファイル名とサイズの組で同じ選択かどうかを判定し、前回の upload_id を再利用する
+    // （通信が途中で切れても再開できるよう、送信前に upload_id を決めて保存しておく）
+    const signature = files.map(f => `${f.name}:${f.size}`).join('|');
+    const storageKey = 'bulkUpload:' + signature;
+    let uploadId = localStorage.getItem(storageKey);
+    if (!uploadId) {
+        uploadId = Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+        localStorage.setItem(storageKey, uploadId);
+    }
 
-        // アノテーションをロード
-        loadAnnotations(currentImageId); // Pass currentImageId
-        showToast('画像を読み込みました');
+    const formData = new FormData();
+    files.forEach(file => formData.append('files', file));
+    formData.append('upload_id', uploadId);
+
+    showToast(`${files.length}件のファイルをアップロード中...`);
+
+    try {
+        const response = await handleResponse(await fetch(`${API_BASE}/upload/bulk`, {
+            method: 'POST',
+            headers: {
+                'Authorization': getAuthHeaders()['Authorization']
+            },
+            body: formData
+        }));
+
+        if (!response.ok) {
+            if (response.status === 403) throw new Error('ゲストは画像をアップロードできません');
+            const err = await response.json().catch(() => ({}));
+            throw new Error(err.detail || 'アップロードに失敗しました');
+        }
+
+        const data = await response.json();
+        if (data.errors > 0) {
+            // 失敗した画像があれば、次回同じファイルで再送したときに続きから登録する
+            data.results.filter(r => r.status === 'error')
+                .forEach(r => console.error(`${r.source}: ${r.error}`));
+        } else {
+            localStorage.removeItem(storageKey);
+        }
+
+        const first = data.results.find(r => r.status !== 'error');
+        if (first) {
+            showUploadedImage(first);
+        }
+        let message = `${data.created}件の画像を登録しました`;
+        if (data.skipped > 0) message += `（登録済み ${data.skipped}件）`;
+        if (data.errors > 0) message += `（失敗 ${data.errors}件）`;
+        showToast(message, data.errors > 0);
 
     } catch (error) {
         showToast('エラー: ' + error.message, true);
     }
 }
 
+// アップロードした画像を表示
+function showUploadedImage(data) {
+    if (data.image_id !== currentImageId) currentPageVersion = null;
+    currentImageId = data.image_id;
+    currentImageSize = data.image_size;
+
+    // 画像を表示
+    loadImage(data);
+
+    // UI更新
+    document.getElementById('imageInfo').textContent =
+        `画像ID: ${data.image_id} | サイズ: ${data.image_size.width}x${data.image_size.height}`;
+    document.getElementById('placeholderText').style.display = 'none';
+
+    // アノテーションをロード
+    loadAnnotations(currentImageId); // Pass currentImageId
+}
+
 // 画像を読み込んでCanvasに表示
-function loadImage(filename) {
+// Canvasは元画像の大きさ（アノテーションの座標系）のまま、表示幅に合う縮小版を引き伸ばして描画する
+function loadImage(data) {
+    const imageId = data.image_id;
+    const { width, height } = data.image_size;
+    const displayWidth = Math.min(width, canvas.parentElement.clientWidth || width);
     const img = new Image();
-    authFetchImage(filename).then(url => {
+    pickRenditionUrl(imageId, data.image_filename, displayWidth).then(authFetchImage).then(url => {
         img.onload = () => {
+            releaseImageUrl(url); // キャッシュしていなければメモリ解放
+            if (imageId !== currentImageId) return; // 読み込み中に別の画像が選ばれた
             loadedImage = img; // 画像をキャッシュ
-            canvas.width = img.width;
-            canvas.height = img.height;
+            canvas.width = width;
+            canvas.height = height;
             redrawCanvas();
             canvas.style.display = 'block';
-            URL.revokeObjectURL(url); // メモリ解放
         };
         img.src = url;
     }).catch(err => {
@@ -572,8 +781,8 @@ function redrawCanvas() {
     // Canvasをクリア
     ctx.clearRect(0, 0, canvas.width, canvas.height);
 
-    // キャッシュされた画像を描画
-    ctx.drawImage(loadedImage, 0, 0);
+    // キャッシュされた画像を描画（縮小版は元の大きさに引き伸ばす）
+    ctx.drawImage(loadedImage, 0, 0, canvas.width, canvas.height);
 
     // 既存のアノテーションを描画
     annotations.forEach((anno) => {
@@ -676,11 +885,11 @@ async function saveAnnotation() {
     try {
         const response = await handleResponse(await fetch(`${API_BASE}/annotations`, {
             method: 'POST',
-            headers: getAuthHeaders(),
+            headers: pageWriteHeaders(),
             body: JSON.stringify(annotationData)
         }));
 
-        if (!response.ok) throw new Error('保存に失敗しました');
+        await checkPageWrite(response, '保存に失敗しました');
 
         // フォームをクリア
         clearSelection();
@@ -688,8 +897,8 @@ async function saveAnnotation() {
         document.getElementById('characterInput').value = '';
         document.getElementById('orderInput').value = parseInt(document.getElementById('orderInput').value) + 1;
 
-        // アノテーションを再読み込み
-        loadAnnotations();
+        // 追加分（ずれた order を含む）を差分で取り込む
+        await syncAnnotations();
 
         // キャラクターリストを更新
         if (annotationData.character_id) {
@@ -715,22 +924,192 @@ async function loadAnnotations() {
 
         const data = await response.json();
         annotations = data.annotations || [];
+        currentPageVersion = data.version;
         const pageSummary = data.page_summary || "";
 
         // ページサマリーを表示
         document.getElementById('pageSummaryInput').value = pageSummary;
 
-        displayAnnotations();
-        redrawCanvas();
-
-        // エクスポートボタンを有効化
-        document.getElementById('exportJsonBtn').disabled = annotations.length === 0;
+        showAnnotations();
+        watchCurrentPage();
 
     } catch (error) {
         console.error('アノテーション読み込みエラー:', error);
     }
 }
 
+// 表示中のページを最新にする（手元の版以降の差分だけを取得して適用。記録がなければページ全体）
+async function syncAnnotations() {
+    if (!currentImageId) return;
+    if (currentPageVersion === null) return loadAnnotations();
+
+    const imageId = currentImageId;
+    try {
+        const response = await handleResponse(await fetch(`${API_BASE}/annotations/${imageId}/delta?since=${currentPageVersion}`, {
+            headers: getAuthHeaders()
+        }));
+        if (!response.ok) throw new Error('読み込みに失敗しました');
+        const delta = await response.json();
+        if (imageId !== currentImageId) return; // 取得中に別の画像が選ばれた
+
+        if (delta.version <= currentPageVersion) return; // 取得中に変更通知で取り込み済み
+
+        if (delta.reset) {
+            // 差分の記録が残っていない版からはページ全体が返る
+            annotations = delta.page.annotations || [];
+            showPageSummary(delta.page.page_summary);
+        } else {
+            applyPageChanges(delta.changes.filter(change => change.version > currentPageVersion));
+        }
+        currentPageVersion = delta.version;
+
+        showAnnotations();
+
+    } catch (error) {
+        console.error('アノテーション同期エラー:', error);
+    }
+}
+
+// 差分を古い順に表示中のページへ適用
+function applyPageChanges(changes) {
+    for (const change of changes) {
+        annotations = applyPageChange(annotations, change);
+        if (change.page && 'page_summary' in change.page) {
+            showPageSummary(change.page.page_summary);
+        }
+    }
+}
+
+// ページの説明を表示（入力中なら上書きしない）
+function showPageSummary(summary) {
+    const input = document.getElementById('pageSummaryInput');
+    if (document.activeElement !== input) {
+        input.value = summary || "";
+    }
+}
+
+// --- 変更通知（他の画面での編集をすぐに反映する） ---
+let eventsController = null;
+let eventsImageId = null;
+let eventsRetryDelay = 1000;
+let eventsInterrupted = false;
+
+// 表示中のページと画像一覧（ゲスト用）の変更通知を受け取る
+// EventSource は Authorization ヘッダーを付けられないので、fetch のストリームを読んで SSE を解釈する
+async function connectEvents() {
+    if (eventsController) eventsController.abort();
+    const controller = new AbortController();
+    eventsController = controller;
+    eventsImageId = currentImageId;
+
+    const params = new URLSearchParams({ list: String(imageListEnabled) });
+    if (currentImageId) params.set('pages', currentImageId);
+    try {
+        const response = await handleResponse(await fetch(`${API_BASE}/events?${params}`, {
+            headers: getAuthHeaders(),
+            signal: controller.signal
+        }));
+        if (!response.ok) throw new Error(`events ${response.status}`);
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let end;
+            while ((end = buffer.indexOf('\n\n')) >= 0) {
+                const block = buffer.slice(0, end);
+                buffer = buffer.slice(end + 2);
+                let type = 'message';
+                let data = '';
+                for (const line of block.split('\n')) {
+                    if (line.startsWith('event:')) type = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                }
+                if (data) handleServerEvent(type, JSON.parse(data));
+            }
+        }
+    } catch (error) {
+        if (controller.signal.aborted) return;
+        console.error('Events error:', error);
+    }
+    if (controller !== eventsController) return;
+
+    // 切断されたら間隔を空けてつなぎ直す（つながるまでの変更は ready で取り込む）
+    eventsInterrupted = true;
+    setTimeout(() => {
+        if (controller === eventsController) connectEvents();
+    }, eventsRetryDelay);
+    eventsRetryDelay = Math.min(eventsRetryDelay * 2, 30000);
+}
+
+// 表示中のページが変わったら購読し直す
+function watchCurrentPage() {
+    if (eventsImageId !== currentImageId || !eventsController) connectEvents();
+}
+
+function handleServerEvent(type, data) {
+    if (type === 'ready') {
+        eventsRetryDelay = 1000;
+        if (eventsInterrupted) {
+            // 切断中の一覧の変更は届いていないので読み直す
+            eventsInterrupted = false;
+            if (imageListEnabled) loadImageList();
+        }
+        const version = data.versions[currentImageId];
+        if (currentPageVersion !== null && version !== undefined && version !== currentPageVersion) {
+            syncAnnotations();
+        }
+    } else if (type === 'page') {
+        if (data.image_id !== currentImageId || currentPageVersion === null) return;
+        if (data.version <= currentPageVersion) return; // 自分の保存などで取り込み済み
+        const changes = (data.changes || []).filter(change => change.version > currentPageVersion);
+        if (data.resync || changes.length === 0 || changes[0].version !== currentPageVersion + 1) {
+            // 変更が溜まりすぎた・途中の版が抜けている場合は差分 API で取り直す
+            syncAnnotations();
+            return;
+        }
+        applyPageChanges(changes);
+        currentPageVersion = data.version;
+        showAnnotations();
+    } else if (type === 'list') {
+        data.images.forEach(showImageListEntry);
+    } else if (type === 'reset') {
+        // 通知が追いつかず捨てられたので、一覧と表示中のページを取り直す
+        if (imageListEnabled) loadImageList();
+        syncAnnotations();
+    }
+}
+
+// 通知された一覧の項目を画像セレクターに反映（最後まで読み込んでいれば新しい画像を末尾に追加）
+function showImageListEntry(entry) {
+    const selector = document.getElementById('imageSelector');
+    const label = entry.id + (entry.is_completed ? ' ✓' : '');
+    const option = [...selector.options].find(o => o.value === entry.id);
+    if (option) {
+        option.textContent = label;
+        return;
+    }
+    if (imageListCursor) return;
+    const placeholder = [...selector.options].find(o => o.value === '' && o.disabled);
+    if (placeholder) placeholder.remove();
+    const added = document.createElement('option');
+    added.value = entry.id;
+    added.textContent = label;
+    selector.appendChild(added);
+}
+
+// アノテーション一覧とキャンバスを表示し直す
+function showAnnotations() {
+    displayAnnotations();
+    redrawCanvas();
+
+    // エクスポートボタンを有効化
+    document.getElementById('exportJsonBtn').disabled = annotations.length === 0;
+}
+
 function displayAnnotations() {
     const listContainer = document.getElementById('annotationsList');
 
@@ -864,17 +1243,18 @@ async function saveOrder() {
     try {
         const response = await handleResponse(await fetch(`${API_BASE}/annotations/${currentImageId}/reorder`, {
             method: 'PUT',
-            headers: getAuthHeaders(),
+            headers: pageWriteHeaders(),
             body: JSON.stringify({
                 annotation_ids: annotations.map(a => a.id)
             })
         }));
 
-        if (!response.ok) throw new Error('順序の保存に失敗しました');
+        if (!response.ok) throw new Error(response.status === 409 ? '他の画面での編集と競合しました' : '順序の保存に失敗しました');
 
-        // 表示を更新
+        // 表示を更新（並べ替えはローカルに適用済みなので、差分は版を進めるために取り込む）
         displayAnnotations();
         redrawCanvas();
+        await syncAnnotations();
         showToast('順序を更新しました');
 
     } catch (error) {
@@ -919,12 +1299,12 @@ async function deleteAnnotation(annotationId) {
     try {
         const response = await handleResponse(await fetch(`${API_BASE}/annotations/${currentImageId}/${annotationId}`, {
             method: 'DELETE',
-            headers: getAuthHeaders()
+            headers: pageWriteHeaders()
         }));
 
-        if (!response.ok) throw new Error('削除に失敗しました');
+        await checkPageWrite(response, '削除に失敗しました');
 
-        loadAnnotations();
+        await syncAnnotations();
         showToast('削除しました');
 
     } catch (error) {
@@ -952,7 +1332,8 @@ async function exportJson() {
         }));
         if (!response.ok) throw new Error('データ取得に失敗しました');
 
-        const data = await response.json();
+        // 版番号はサーバー側の管理用なので、保存されるJSONと同じ形にして書き出す
+        const { version, ...data } = await response.json();
 
         // JSONファイルとしてダウンロード
         const blob = new Blob([JSON.stringify(data, null, 2)], { type: 'application/json' });
@@ -1094,12 +1475,15 @@ async function savePageSummary() {
     try {
         const response = await handleResponse(await fetch(`${API_BASE}/annotations/${currentImageId}/summary`, {
             method: 'PATCH',
-            headers: getAuthHeaders(),
+            headers: pageWriteHeaders(),
             body: JSON.stringify({ page_summary: summary })
         }));
 
         if (response.ok) {
+            currentPageVersion = pageVersionFromResponse(response) ?? currentPageVersion;
             showToast('ページ説明を保存しました');
+        } else if (response.status === 409) {
+            await checkPageWrite(response, '保存に失敗しました');
         } else {
             showToast('保存に失敗しました', true);
         }
@@ -1124,6 +1508,8 @@ async function openSettings() {
         document.getElementById('settingThreshold').value = settings.tagger_threshold;
         document.getElementById('thresholdValue').textContent = settings.tagger_threshold.toFixed(2);
         document.getElementById('settingExcludedTags').value = settings.excluded_tags.join(', ');
+        document.getElementById('settingBackend').value = settings.tagger_backend || 'torch';
+        document.getElementById('settingOnnxQuantized').checked = !!settings.onnx_quantized;
 
         document.getElementById('settingsModal').style.display = 'block';
     } catch (error) {
@@ -1148,7 +1534,9 @@ async function saveGlobalSettings() {
     const settings = {
         tagger_model: model,
         tagger_threshold: threshold,
-        excluded_tags: excludedTags
+        excluded_tags: excludedTags,
+        tagger_backend: document.getElementById('settingBackend').value,
+        onnx_quantized: document.getElementById('settingOnnxQuantized').checked
     };
 
     try {
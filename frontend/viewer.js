@@ -1,11 +1,17 @@
 // グローバル変数
 let currentImageId = null;
 let currentAnnotations = [];
+let currentPageVersion = null; // 表示中のページの版番号（差分同期と If-Match に使う）
 let loadedImage = null;
+let currentImageSize = null; // 元画像の大きさ（Canvasの座標系）
+let renditionInfo = null; // 表示中の画像の縮小版一覧
+let loadedRenditionWidth = 0; // 読み込み済みの縮小版の幅
+let renditionTimer = null;
 let canvas = null;
 let ctx = null;
 let currentScale = 1.0;
 let lastFocusedTextArea = null;
+let editListStale = false; // 入力中に届いた変更で編集リストの作り直しを待っている
 
 // 新規描画用
 let isDrawingNew = false;
@@ -39,6 +45,21 @@ function getAuthHeaders() {
     return headers;
 }
 
+// ページを書き換えるリクエスト用のヘッダー（表示中の版を If-Match で送り、他で更新されていれば 409）
+function pageWriteHeaders() {
+    const headers = getAuthHeaders();
+    if (currentPageVersion !== null) {
+        headers['If-Match'] = `"${currentPageVersion}"`;
+    }
+    return headers;
+}
+
+// レスポンスの ETag からページの版番号を取り出す
+function pageVersionFromResponse(response) {
+    const match = /^(?:W\/)?"(\d+)"$/.exec(response.headers.get('ETag') || '');
+    return match ? parseInt(match[1]) : null;
+}
+
 // 認証エラーハンドリング
 async function handleResponse(response) {
     if (response.status === 401) {
@@ -48,14 +69,48 @@ async function handleResponse(response) {
     return response;
 }
 
-// 認証付きで画像を取得
-async function authFetchImage(filename) {
-    const response = await handleResponse(await fetch(`${API_BASE}/images/${filename}`, {
+// 取得済み画像のオブジェクトURL（内容ハッシュ付きのURLのみ。ページを行き来しても再取得しない）
+const imageUrlCache = new Map();
+const IMAGE_URL_CACHE_SIZE = 16;
+
+// 認証付きで画像を取得（path は /images/... の URL）
+async function authFetchImage(path) {
+    const cached = imageUrlCache.get(path);
+    if (cached) {
+        // 最近使ったものとして末尾に移す
+        imageUrlCache.delete(path);
+        imageUrlCache.set(path, cached);
+        return cached;
+    }
+    const response = await handleResponse(await fetch(`${API_BASE}${path}`, {
         headers: getAuthHeaders()
     }));
     if (!response.ok) throw new Error('Image load failed');
     const blob = await response.blob();
-    return URL.createObjectURL(blob);
+    const url = URL.createObjectURL(blob);
+    if (path.includes('?v=')) {
+        imageUrlCache.set(path, url);
+        if (imageUrlCache.size > IMAGE_URL_CACHE_SIZE) {
+            const [oldPath, oldUrl] = imageUrlCache.entries().next().value;
+            imageUrlCache.delete(oldPath);
+            URL.revokeObjectURL(oldUrl);
+        }
+    }
+    return url;
+}
+
+// キャッシュしていないオブジェクトURLを解放する
+function releaseImageUrl(url) {
+    if (![...imageUrlCache.values()].includes(url)) {
+        URL.revokeObjectURL(url);
+    }
+}
+
+// 表示サイズに合う縮小版を選ぶ（表示幅 × devicePixelRatio 以上で最小のもの、なければ元画像）
+function pickRendition(info, displayWidth) {
+    const needed = displayWidth * (window.devicePixelRatio || 1);
+    const rendition = info.renditions.find(r => r.width >= needed);
+    return rendition || { url: info.original, width: info.width };
 }
 
 // 初期化
@@ -92,6 +147,25 @@ document.addEventListener('DOMContentLoaded', () => {
 
     loadImagesList();
     loadTaggerSettings();
+    connectEvents();
+
+    // 入力中に届いた変更は、フォーカスが編集リストの外に出てから表示に反映する
+    const editListEl = document.getElementById('editList');
+    editListEl.addEventListener('focusout', (e) => {
+        if (editListStale && !editListEl.contains(e.relatedTarget)) {
+            editListStale = false;
+            displayEditList();
+        }
+    });
+
+    // 画像一覧: 末尾近くまでスクロールしたら次のページを読み込む
+    const imageListEl = document.getElementById('imageList');
+    imageListEl.addEventListener('scroll', () => {
+        if (imageListEl.scrollTop + imageListEl.clientHeight >= imageListEl.scrollHeight - 200) {
+            loadImagesList(false);
+        }
+    });
+    document.getElementById('imageListFilter')?.addEventListener('change', () => loadImagesList(true));
 
     // 新規アノテーション関連のイベント
     document.getElementById('btnAddNew').addEventListener('click', toggleAddNewMode);
@@ -169,68 +243,100 @@ async function checkAuth() {
     }
 }
 
-// 画像一覧を読み込み
-async function loadImagesList() {
+// 画像一覧のページング状態
+const IMAGE_LIST_PAGE_SIZE = 200;
+let imageListCursor = null;
+let imageListLoading = false;
+let imageListInitialized = false;
+
+// 画像一覧の1項目を作成
+function createImageListItem(imgData) {
+    const item = document.createElement('div');
+    item.className = 'image-item';
+    if (imgData.is_completed) item.classList.add('completed');
+    if (imgData.id === currentImageId) item.classList.add('active');
+    item.id = `item-${imgData.id}`;
+
+    // 完了アイコン
+    const statusIcon = imgData.is_completed ? '✅ ' : '⬜ ';
+    item.textContent = statusIcon + imgData.id;
+
+    item.addEventListener('click', () => selectImage(imgData.id));
+    return item;
+}
+
+// 一覧の項目だけを書き換える（一覧全体は読み直さない）
+function updateImageListItem(imageId, isCompleted) {
+    const item = document.getElementById(`item-${imageId}`);
+    if (!item) return;
+    item.classList.toggle('completed', isCompleted);
+    item.textContent = (isCompleted ? '✅ ' : '⬜ ') + imageId;
+}
+
+// 画像一覧を読み込み (reset=false なら次のページを末尾に追加)
+async function loadImagesList(reset = true) {
+    if (imageListLoading) return;
+    if (!reset && !imageListCursor) return;
+    imageListLoading = true;
+
     try {
-        const response = await handleResponse(await fetch(`${API_BASE}/annotations-list`, {
+        // 絞り込み・ページングはサーバー側で行う
+        const params = new URLSearchParams({ limit: IMAGE_LIST_PAGE_SIZE });
+        const filter = document.getElementById('imageListFilter')?.value || '';
+        if (filter === 'incomplete') params.set('is_completed', 'false');
+        if (filter === 'completed') params.set('is_completed', 'true');
+        if (filter === 'unannotated') params.set('has_annotation', 'false');
+        if (!reset) params.set('cursor', imageListCursor);
+
+        const response = await handleResponse(await fetch(`${API_BASE}/annotations-list?${params}`, {
             headers: getAuthHeaders()
         }));
         if (!response.ok) throw new Error('一覧の取得に失敗しました');
 
         const data = await response.json();
         const listContainer = document.getElementById('imageList');
+        imageListCursor = data.next_cursor;
 
-        // files_list (backend main.py returns {"images": [...]}) NOT image_ids
-        // Backend changes: return {"images": [{"id":..., "has_annotation":..., "is_completed":...}]}
-
-        if (!data.images || data.images.length === 0) {
-            listContainer.innerHTML = '<p style="text-align:center; color:#64748b;">アノテーションされた画像がありません</p>';
-            return;
+        if (reset) {
+            if (!data.images || data.images.length === 0) {
+                listContainer.innerHTML = '<p style="text-align:center; color:#64748b;">アノテーションされた画像がありません</p>';
+                return;
+            }
+            // 既存の内容をクリアして生成
+            listContainer.innerHTML = '';
         }
 
-        // 既存の内容をクリアして生成
-        listContainer.innerHTML = '';
+        // サーバーがID順（数値順）で返すのでそのまま追加
+        const fragment = document.createDocumentFragment();
+        data.images.forEach(imgData => fragment.appendChild(createImageListItem(imgData)));
+        listContainer.appendChild(fragment);
 
-        // 数値として正しくソート (1, 2, 3, ... 10, 11 の順)
-        data.images.sort((a, b) => {
-            const numA = parseInt(a.id) || 0;
-            const numB = parseInt(b.id) || 0;
-            return numA - numB;
-        });
-
-        data.images.forEach(imgData => {
-            const item = document.createElement('div');
-            item.className = 'image-item';
-            if (imgData.is_completed) item.classList.add('completed');
-            item.id = `item-${imgData.id}`;
-
-            // 完了アイコン
-            const statusIcon = imgData.is_completed ? '✅ ' : '⬜ ';
-            item.textContent = statusIcon + imgData.id;
-
-            item.addEventListener('click', () => selectImage(imgData.id));
-            listContainer.appendChild(item);
-        });
+        // 初回のみ表示する画像を決める
+        if (reset && !imageListInitialized) {
+            imageListInitialized = true;
 
-        // URLパラメータから画像IDを取得
-        const urlParams = new URLSearchParams(window.location.search);
-        const imageParam = urlParams.get('image');
+            // URLパラメータから画像IDを取得
+            const urlParams = new URLSearchParams(window.location.search);
+            const imageParam = urlParams.get('image');
 
-        // URLパラメータで指定された画像があれば、それを選択
-        if (imageParam && data.images.some(img => img.id === imageParam)) {
-            setTimeout(() => {
-                selectImage(imageParam);
-            }, 100);
-        }
-        // なければ最初の画像を選択（もしあれば）
-        else if (data.images.length > 0) {
-            setTimeout(() => {
-                selectImage(data.images[0].id);
-            }, 100);
+            // URLパラメータで指定された画像があれば、それを選択（一覧の未読み込みページにあってもよい）
+            if (imageParam) {
+                setTimeout(() => {
+                    selectImage(imageParam);
+                }, 100);
+            }
+            // なければ最初の画像を選択（もしあれば）
+            else if (data.images.length > 0) {
+                setTimeout(() => {
+                    selectImage(data.images[0].id);
+                }, 100);
+            }
         }
     } catch (error) {
         console.error('List load error:', error);
         document.getElementById('imageList').innerHTML = '<p style="text-align:center; color:#ef4444;">読み込みエラーが発生しました</p>';
+    } finally {
+        imageListLoading = false;
     }
 }
 
@@ -265,20 +371,250 @@ async function compactOrderNumbers() {
     });
 
     // 各アノテーションのorderを更新
-    let updated = false;
+    const operations = [];
     for (const anno of currentAnnotations) {
         const newOrder = orderMap[anno.order];
         if (newOrder !== anno.order) {
             anno.order = newOrder;
-            await saveAnnotation(anno.id);
-            updated = true;
+            operations.push({ op: 'update', annotation_id: anno.id, data: { order: newOrder } });
+        }
+    }
+
+    // 更新があった場合はまとめてバックエンドに保存してログ出力
+    if (operations.length > 0) {
+        try {
+            // ローカルには同じ変更を適用済みなので、サーバーの新しい版をそのまま手元の版にする
+            const result = await applyAnnotationBatch(currentImageId, operations);
+            currentPageVersion = result.version;
+            console.log('Order numbers compacted:', orderMap);
+        } catch (error) {
+            console.error('Order compaction error:', error);
+        }
+    }
+}
+
+// 1ページへの複数の編集をまとめて送信（サーバー側ではすべて成功した場合だけ反映され、書き出しも1回）
+async function applyAnnotationBatch(imageId, operations) {
+    const response = await handleResponse(await fetch(`${API_BASE}/annotations/${imageId}/batch`, {
+        method: 'POST',
+        headers: pageWriteHeaders(),
+        body: JSON.stringify({ operations })
+    }));
+    await checkPageWrite(response, '一括更新に失敗しました');
+    return response.json();
+}
+
+// ページを書き換えるリクエストの結果を確認（他の編集で版が進んでいた 409 なら最新の状態を取り込んでからエラー）
+async function checkPageWrite(response, message) {
+    if (response.status === 409) {
+        await syncAnnotations().catch(error => console.error('Sync error:', error));
+        throw new Error('他の画面での編集と競合しました。最新の状態を読み込んだので、もう一度操作してください');
+    }
+    if (!response.ok) {
+        const errorData = await response.json().catch(() => ({}));
+        throw new Error(typeof errorData.detail === 'string' ? errorData.detail : `${message} (${response.status})`);
+    }
+}
+
+// 差分の1件をアノテーション配列に適用（サーバーの storage.apply_page_record と同じ規則）
+function applyPageChange(annotations, change) {
+    const removed = new Set(change.del || []);
+    const byId = new Map(annotations.filter(a => !removed.has(a.id)).map(a => [a.id, a]));
+    for (const anno of change.set || []) {
+        byId.set(anno.id, anno);
+    }
+    if (!change.ids) return [...byId.values()];
+    const listed = new Set(change.ids);
+    const ordered = change.ids.filter(id => byId.has(id)).map(id => byId.get(id));
+    return ordered.concat([...byId.values()].filter(a => !listed.has(a.id)));
+}
+
+// ページの項目（説明・完了ステータス）を表示に反映
+function showPageFields(fields) {
+    if ('page_summary' in fields) {
+        const summaryInput = document.getElementById('pageSummaryText');
+        // 入力中の説明は上書きしない
+        if (summaryInput && document.activeElement !== summaryInput) {
+            summaryInput.value = fields.page_summary || "";
+        }
+    }
+    if ('is_completed' in fields) {
+        const completeBtn = document.getElementById('btnToggleComplete');
+        if (completeBtn) {
+            completeBtn.textContent = fields.is_completed ? '完了済み (解除)' : '完了にする';
+            completeBtn.classList.toggle('btn-success', fields.is_completed);
+            completeBtn.classList.toggle('btn-secondary', !fields.is_completed);
+        }
+    }
+}
+
+// 表示中のページを最新にする（手元の版以降の差分だけを取得して適用し、画像は読み直さない）
+async function syncAnnotations() {
+    if (!currentImageId) return;
+    if (currentPageVersion === null) return selectImage(currentImageId, true);
+
+    const imageId = currentImageId;
+    const response = await handleResponse(await fetch(`${API_BASE}/annotations/${imageId}/delta?since=${currentPageVersion}`, {
+        headers: getAuthHeaders()
+    }));
+    if (!response.ok) throw new Error('アノテーションの取得に失敗しました');
+    const delta = await response.json();
+    if (imageId !== currentImageId) return; // 取得中に別の画像が選ばれた
+
+    if (delta.version <= currentPageVersion) return; // 取得中に変更通知で取り込み済み
+
+    if (delta.reset) {
+        // 差分の記録が残っていない版からはページ全体が返る
+        currentAnnotations = delta.page.annotations || [];
+        showPageFields(delta.page);
+        updateImageListItem(imageId, delta.page.is_completed);
+    } else {
+        applyPageChanges(imageId, delta.changes.filter(change => change.version > currentPageVersion));
+    }
+    currentPageVersion = delta.version;
+    refreshPageView();
+}
+
+// 差分を古い順に表示中のページへ適用
+function applyPageChanges(imageId, changes) {
+    for (const change of changes) {
+        currentAnnotations = applyPageChange(currentAnnotations, change);
+        if (change.page) {
+            showPageFields(change.page);
+            if ('is_completed' in change.page) updateImageListItem(imageId, change.page.is_completed);
         }
     }
+}
 
-    // 更新があった場合はログ出力
-    if (updated) {
-        console.log('Order numbers compacted:', orderMap);
+// 取り込んだ変更を編集リスト・キャンバスに反映
+function refreshPageView() {
+    currentAnnotations = currentAnnotations.sort((a, b) => a.order - b.order);
+    if (selectedAnnotationId && !currentAnnotations.some(a => a.id === selectedAnnotationId)) {
+        selectedAnnotationId = null;
+    }
+    // 入力中の編集欄は作り直さない（フォーカスが編集リストの外に出たときに作り直す）
+    const editList = document.getElementById('editList');
+    const active = document.activeElement;
+    if (editList && editList.contains(active) && active.matches('input, textarea, select')) {
+        editListStale = true;
+    } else {
+        displayEditList();
     }
+    updateCharacterTags();
+    redrawCanvas();
+}
+
+// --- 変更通知（他の画面での編集をすぐに反映する） ---
+let eventsController = null;
+let eventsImageId = null;
+let eventsRetryDelay = 1000;
+let eventsInterrupted = false;
+
+// 表示中のページと画像一覧の変更通知を受け取る
+// EventSource は Authorization ヘッダーを付けられないので、fetch のストリームを読んで SSE を解釈する
+async function connectEvents() {
+    if (eventsController) eventsController.abort();
+    const controller = new AbortController();
+    eventsController = controller;
+    eventsImageId = currentImageId;
+
+    const params = new URLSearchParams({ list: 'true' });
+    if (currentImageId) params.set('pages', currentImageId);
+    try {
+        const response = await handleResponse(await fetch(`${API_BASE}/events?${params}`, {
+            headers: getAuthHeaders(),
+            signal: controller.signal
+        }));
+        if (!response.ok) throw new Error(`events ${response.status}`);
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let end;
+            while ((end = buffer.indexOf('\n\n')) >= 0) {
+                const block = buffer.slice(0, end);
+                buffer = buffer.slice(end + 2);
+                let type = 'message';
+                let data = '';
+                for (const line of block.split('\n')) {
+                    if (line.startsWith('event:')) type = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                }
+                if (data) handleServerEvent(type, JSON.parse(data));
+            }
+        }
+    } catch (error) {
+        if (controller.signal.aborted) return;
+        console.error('Events error:', error);
+    }
+    if (controller !== eventsController) return;
+
+    // 切断されたら間隔を空けてつなぎ直す（つながるまでの変更は ready で取り込む）
+    eventsInterrupted = true;
+    setTimeout(() => {
+        if (controller === eventsController) connectEvents();
+    }, eventsRetryDelay);
+    eventsRetryDelay = Math.min(eventsRetryDelay * 2, 30000);
+}
+
+// 表示中のページが変わったら購読し直す
+function watchCurrentPage() {
+    if (eventsImageId !== currentImageId || !eventsController) connectEvents();
+}
+
+function handleServerEvent(type, data) {
+    if (type === 'ready') {
+        eventsRetryDelay = 1000;
+        if (eventsInterrupted) {
+            // 切断中の一覧の変更は届いていないので読み直す
+            eventsInterrupted = false;
+            loadImagesList(true);
+        }
+        const version = data.versions[currentImageId];
+        if (currentPageVersion !== null && version !== undefined && version !== currentPageVersion) {
+            syncAnnotations().catch(error => console.error('Sync error:', error));
+        }
+    } else if (type === 'page') {
+        if (data.image_id !== currentImageId || currentPageVersion === null) return;
+        if (data.version <= currentPageVersion) return; // 自分の保存などで取り込み済み
+        const changes = (data.changes || []).filter(change => change.version > currentPageVersion);
+        if (data.resync || changes.length === 0 || changes[0].version !== currentPageVersion + 1) {
+            // 変更が溜まりすぎた・途中の版が抜けている場合は差分 API で取り直す
+            syncAnnotations().catch(error => console.error('Sync error:', error));
+            return;
+        }
+        applyPageChanges(currentImageId, changes);
+        currentPageVersion = data.version;
+        refreshPageView();
+    } else if (type === 'list') {
+        data.images.forEach(showImageListEntry);
+    } else if (type === 'reset') {
+        // 通知が追いつかず捨てられたので、一覧と表示中のページを取り直す
+        loadImagesList(true);
+        syncAnnotations().catch(error => console.error('Sync error:', error));
+    }
+}
+
+// 通知された一覧の項目を反映
+// 読み込み済みの範囲にない画像は、一覧を最後まで読み込んでいて絞り込みに合うときだけ末尾に追加する
+function showImageListEntry(entry) {
+    if (document.getElementById(`item-${entry.id}`)) {
+        updateImageListItem(entry.id, entry.is_completed);
+        return;
+    }
+    if (!imageListInitialized || imageListLoading || imageListCursor) return;
+    const filter = document.getElementById('imageListFilter')?.value || '';
+    if (filter === 'unannotated') return;
+    if (filter === 'incomplete' && entry.is_completed) return;
+    if (filter === 'completed' && !entry.is_completed) return;
+
+    const listContainer = document.getElementById('imageList');
+    listContainer.querySelector('p')?.remove();
+    listContainer.appendChild(createImageListItem(entry));
 }
 
 async function selectImage(imageId, preserveZoom = false) {
@@ -291,6 +627,7 @@ async function selectImage(imageId, preserveZoom = false) {
         targetItem.classList.add('active');
     }
 
+    if (imageId !== currentImageId) currentPageVersion = null;
     currentImageId = imageId;
 
     try {
@@ -302,28 +639,18 @@ async function selectImage(imageId, preserveZoom = false) {
 
         const data = await response.json();
         currentAnnotations = data.annotations || [];
+        currentPageVersion = data.version;
 
         // order番号の欠番を自動で詰める処理
         await compactOrderNumbers();
 
-        // ページサマリーを表示
-        const summaryInput = document.getElementById('pageSummaryText');
-        if (summaryInput) {
-            summaryInput.value = data.page_summary || "";
-        }
-
-        // 完了ボタンの状態更新 (ボタンがあれば)
-        const completeBtn = document.getElementById('btnToggleComplete');
-        if (completeBtn) {
-            completeBtn.textContent = data.is_completed ? '完了済み (解除)' : '完了にする';
-            completeBtn.classList.toggle('btn-success', data.is_completed);
-            completeBtn.classList.toggle('btn-secondary', !data.is_completed);
-        }
+        // ページサマリーと完了ボタンの状態を表示
+        showPageFields(data);
 
         currentAnnotations = currentAnnotations.sort((a, b) => a.order - b.order);
 
-        // 画像を表示
-        loadImage(data.image_filename);
+        // 画像を表示（preserveZoomがfalseなら、縮小版を選ぶ前に高さに合わせる）
+        loadImage(data, !preserveZoom);
 
         // 編集リストを表示
         displayEditList();
@@ -331,10 +658,8 @@ async function selectImage(imageId, preserveZoom = false) {
         // キャラクタータグを更新
         updateCharacterTags();
 
-        // 読み込み直後にフィットさせる（preserveZoomがfalseの場合のみ）
-        if (!preserveZoom) {
-            setTimeout(fitToHeight, 200);
-        }
+        // 他の画面での編集の通知を受け取る
+        watchCurrentPage();
 
     } catch (error) {
         console.error('Image select error:', error);
@@ -343,27 +668,72 @@ async function selectImage(imageId, preserveZoom = false) {
 }
 
 // 画像を読み込んでCanvasに表示
-function loadImage(filename) {
-    if (!filename) return;
-
-    const img = new Image();
-    authFetchImage(filename).then(url => {
-        img.onload = () => {
-            loadedImage = img;
-            canvas.width = img.width;
-            canvas.height = img.height;
-            applyScale(); // 現在のスケールを適用
-            redrawCanvas();
+// Canvasは元画像の大きさ（アノテーションの座標系）のまま、表示倍率に合う縮小版を引き伸ばして描画する
+async function loadImage(data, fit = false) {
+    if (!data.image_filename) return;
+
+    const imageId = data.image_id;
+    currentImageSize = data.image_size;
+    loadedImage = null;
+    renditionInfo = null;
+    loadedRenditionWidth = 0;
+    canvas.width = currentImageSize.width;
+    canvas.height = currentImageSize.height;
+    if (fit) {
+        fitToHeight();
+    } else {
+        applyScale(); // 現在のスケールを適用
+    }
 
-            // スクロールをトップに戻す（中央キャンバス）
-            document.querySelector('.viewer-main').scrollTop = 0;
-            URL.revokeObjectURL(url);
-        };
-        img.src = url;
-    }).catch(err => {
-        showToast('画像の読み込みに失敗しました: ' + filename, true);
+    try {
+        const response = await handleResponse(await fetch(`${API_BASE}/images/${imageId}/renditions`, {
+            headers: getAuthHeaders()
+        }));
+        if (!response.ok) throw new Error('Rendition list failed');
+        renditionInfo = await response.json();
+    } catch (err) {
+        // 縮小版が使えなければ元画像を表示する
         console.error(err);
-    });
+        renditionInfo = { width: currentImageSize.width, original: `/images/${data.image_filename}`, renditions: [] };
+    }
+    if (imageId !== currentImageId) return; // 読み込み中に別の画像が選ばれた
+
+    await showRendition(imageId, pickRendition(renditionInfo, currentImageSize.width * currentScale));
+    // スクロールをトップに戻す（中央キャンバス）
+    document.querySelector('.viewer-main').scrollTop = 0;
+}
+
+// 縮小版を取得して表示中の画像と差し替える
+async function showRendition(imageId, rendition) {
+    try {
+        const url = await authFetchImage(rendition.url);
+        const img = new Image();
+        await new Promise((resolve, reject) => {
+            img.onload = resolve;
+            img.onerror = reject;
+            img.src = url;
+        });
+        releaseImageUrl(url);
+        if (imageId !== currentImageId) return;
+        loadedImage = img;
+        loadedRenditionWidth = rendition.width;
+        redrawCanvas();
+    } catch (err) {
+        showToast('画像の読み込みに失敗しました: ' + imageId, true);
+        console.error(err);
+    }
+}
+
+// 拡大して縮小版の解像度が足りなくなったら、大きい縮小版（または元画像）に差し替える
+function upgradeRendition() {
+    clearTimeout(renditionTimer);
+    renditionTimer = setTimeout(() => {
+        if (!loadedImage || !renditionInfo || !currentImageSize) return;
+        const rendition = pickRendition(renditionInfo, currentImageSize.width * currentScale);
+        if (rendition.width > loadedRenditionWidth) {
+            showRendition(currentImageId, rendition);
+        }
+    }, 300);
 }
 
 // Canvasを再描画
@@ -371,7 +741,7 @@ function redrawCanvas() {
     if (!loadedImage) return;
 
     ctx.clearRect(0, 0, canvas.width, canvas.height);
-    ctx.drawImage(loadedImage, 0, 0);
+    ctx.drawImage(loadedImage, 0, 0, canvas.width, canvas.height);
 
     // アノテーションと矢印を描画
     drawAnnotations();
@@ -471,26 +841,27 @@ function updateScale(scale) {
 
 // スケールをCSSに適用
 function applyScale() {
-    if (!loadedImage) return;
-    canvas.style.width = `${loadedImage.width * currentScale}px`;
-    canvas.style.height = `${loadedImage.height * currentScale}px`;
+    if (!currentImageSize) return;
+    canvas.style.width = `${currentImageSize.width * currentScale}px`;
+    canvas.style.height = `${currentImageSize.height * currentScale}px`;
+    upgradeRendition();
 }
 
 // 幅に合わせる
 function fitToWidth() {
-    if (!loadedImage) return;
+    if (!currentImageSize) return;
     const container = document.querySelector('.viewer-main');
     const padding = 40;
-    const scale = (container.clientWidth - padding) / loadedImage.width;
+    const scale = (container.clientWidth - padding) / currentImageSize.width;
     updateScale(scale);
 }
 
 // 高さに合わせる
 function fitToHeight() {
-    if (!loadedImage) return;
+    if (!currentImageSize) return;
     const container = document.querySelector('.viewer-main');
     const padding = 40;
-    const scale = (container.clientHeight - padding) / loadedImage.height;
+    const scale = (container.clientHeight - padding) / currentImageSize.height;
     updateScale(scale);
 }
 
@@ -939,7 +1310,7 @@ async function saveBoxChange(annotationId) {
     try {
         const response = await handleResponse(await fetch(`${API_BASE}/annotations/${currentImageId}/${annotationId}`, {
             method: 'PUT',
-            headers: getAuthHeaders(),
+            headers: pageWriteHeaders(),
             body: JSON.stringify({
                 image_id: currentImageId,
                 type: anno.type,
@@ -951,7 +1322,10 @@ async function saveBoxChange(annotationId) {
             })
         }));
 
-        if (!response.ok) throw new Error('保存に失敗しました');
+        await checkPageWrite(response, '保存に失敗しました');
+        // 変わったのはこのアノテーションだけなので、返ってきた内容（相対座標を含む）と版をそのまま反映
+        Object.assign(anno, await response.json());
+        currentPageVersion = pageVersionFromResponse(response) ?? currentPageVersion;
         showToast('ボックスを更新しました');
 
     } catch (error) {
@@ -997,21 +1371,21 @@ async function saveNewAnnotation() {
     try {
         const response = await handleResponse(await fetch(`${API_BASE}/annotations`, {
             method: 'POST',
-            headers: getAuthHeaders(),
+            headers: pageWriteHeaders(),
             body: JSON.stringify(annotationData)
         }));
 
-        if (!response.ok) throw new Error('保存に失敗しました');
+        await checkPageWrite(response, '保存に失敗しました');
 
         showToast('新規アノテーションを追加しました');
 
-        // リセットして再読込（ズーム倍率は保持）
+        // リセットして差分を反映（画像とズーム倍率はそのまま）
         cancelAddNew();
         document.getElementById('newTextInput').value = '';
         document.getElementById('newCharacterInput').value = '';
         document.getElementById('newOrderInput').value = '';
         currentNewRect = null;
-        await selectImage(currentImageId, true); // preserveZoom = true
+        await syncAnnotations();
 
     } catch (error) {
         console.error('Save error:', error);
@@ -1024,6 +1398,7 @@ async function saveNewAnnotation() {
 // 編集用リストを表示
 function displayEditList() {
     const container = document.getElementById('editList');
+    editListStale = false;
 
     if (!currentAnnotations || currentAnnotations.length === 0) {
         container.innerHTML = '<p style="text-align:center; color:#64748b;">アノテーションがありません</p>';
@@ -1190,26 +1565,22 @@ function displayEditList() {
                 if (newOrder && newOrder >= 1 && newOrder <= maxOrder && newOrder !== oldOrder) {
                     try {
                         // 1. 対象のアノテーションのorder番号を変更
-                        anno.order = newOrder;
-                        await saveAnnotation(anno.id);
+                        const operations = [{ op: 'update', annotation_id: anno.id, data: { order: newOrder } }];
 
                         // 2. oldOrderより後ろのアノテーションを全て-1して詰める
                         // これにより、欠番が発生しても順番が詰まる
                         const toUpdate = currentAnnotations.filter(a =>
                             a.id !== anno.id && a.order > oldOrder
                         );
+                        toUpdate.forEach(a => {
+                            operations.push({ op: 'update', annotation_id: a.id, data: { order: a.order - 1 } });
+                        });
 
-                        if (toUpdate.length > 0) {
-                            // orderでソートしてから順に-1
-                            toUpdate.sort((a, b) => a.order - b.order);
-                            for (const a of toUpdate) {
-                                a.order = a.order - 1;
-                                await saveAnnotation(a.id);
-                            }
-                        }
+                        // まとめて1回で保存
+                        await applyAnnotationBatch(currentImageId, operations);
 
-                        // 3. 画像を再読み込みして最新の状態を表示
-                        await selectImage(currentImageId);
+                        // 3. 差分を取り込んで最新の状態を表示
+                        await syncAnnotations();
                         showToast('順番を更新しました');
                     } catch (error) {
                         console.error('Order update error:', error);
@@ -1367,14 +1738,14 @@ async function saveAnnotation(annotationId) {
     try {
         const response = await handleResponse(await fetch(`${API_BASE}/annotations/${currentImageId}/${annotationId}`, {
             method: 'PUT',
-            headers: getAuthHeaders(),
+            headers: pageWriteHeaders(),
             body: JSON.stringify(updatedData)
         }));
 
-        if (!response.ok) throw new Error('保存に失敗しました');
+        await checkPageWrite(response, '保存に失敗しました');
 
-        // ローカルデータを更新して再読込（リスト表示やキャンバスを最新にするため）
-        await selectImage(currentImageId);
+        // 差分を取り込んでリスト表示やキャンバスを最新にする
+        await syncAnnotations();
         showToast('保存しました');
     } catch (error) {
         console.error('Save error:', error);
@@ -1412,12 +1783,13 @@ async function moveAnnotation(annotationId, direction) {
 
     try {
         // バックエンドに送信
-        const response = await fetch(`${API_BASE}/annotations/${currentImageId}/reorder`, {
+        const response = await handleResponse(await fetch(`${API_BASE}/annotations/${currentImageId}/reorder`, {
             method: 'PUT',
-            headers: { 'Content-Type': 'application/json' },
+            headers: pageWriteHeaders(),
             body: JSON.stringify({ annotation_ids: newOrder })
-        });
+        }));
 
+        if (response.status === 409) await checkPageWrite(response, '順番の更新に失敗しました');
         if (!response.ok) {
             const errorData = await response.json().catch(() => ({}));
             console.error('Reorder failed:', response.status, errorData);
@@ -1427,8 +1799,8 @@ async function moveAnnotation(annotationId, direction) {
             throw new Error(`順番の更新に失敗しました (${response.status})`);
         }
 
-        // 成功したら再読み込み（orderフィールドを正しく更新するため）
-        await selectImage(currentImageId);
+        // 成功したら差分を取り込む（orderフィールドを正しく更新するため）
+        await syncAnnotations();
         showToast('順番を更新しました');
     } catch (error) {
         console.error('Reorder error:', error);
@@ -1461,10 +1833,11 @@ async function moveAnnotationToPosition(annotationId, newPosition) {
         // バックエンドに送信
         const response = await handleResponse(await fetch(`${API_BASE}/annotations/${currentImageId}/reorder`, {
             method: 'PUT',
-            headers: getAuthHeaders(),
+            headers: pageWriteHeaders(),
             body: JSON.stringify({ annotation_ids: newOrder })
         }));
 
+        if (response.status === 409) await checkPageWrite(response, '順番の更新に失敗しました');
         if (!response.ok) {
             const errorData = await response.json().catch(() => ({}));
             console.error('Reorder failed:', response.status, errorData);
@@ -1474,8 +1847,8 @@ async function moveAnnotationToPosition(annotationId, newPosition) {
             throw new Error(`順番の更新に失敗しました (${response.status})`);
         }
 
-        // 成功したら再読み込み（orderフィールドを正しく更新するため）
-        await selectImage(currentImageId);
+        // 成功したら差分を取り込む（orderフィールドを正しく更新するため）
+        await syncAnnotations();
         showToast(`${newPosition}番に移動しました`);
     } catch (error) {
         console.error('Reorder error:', error);
@@ -1503,18 +1876,16 @@ async function toggleCompletionStatus() {
 
         const response = await handleResponse(await fetch(`${API_BASE}/annotations/${currentImageId}/status`, {
             method: 'PATCH',
-            headers: getAuthHeaders(),
+            headers: pageWriteHeaders(),
             body: JSON.stringify({ is_completed: newStatus })
         }));
 
-        if (!response.ok) throw new Error('ステータス更新に失敗しました');
+        await checkPageWrite(response, 'ステータス更新に失敗しました');
+        currentPageVersion = pageVersionFromResponse(response) ?? currentPageVersion;
 
-        // UI更新 (reload list to update checkmark, and button)
-        await loadImagesList(); // Refresh sidebar list
-        // Update button state immediately for responsiveness
-        btn.textContent = newStatus ? '完了済み (解除)' : '完了にする';
-        btn.classList.toggle('btn-success', newStatus);
-        btn.classList.toggle('btn-secondary', !newStatus);
+        // UI更新 (一覧は該当項目のチェックマークだけを更新)
+        updateImageListItem(currentImageId, newStatus);
+        showPageFields({ is_completed: newStatus });
 
         showToast(newStatus ? '完了としてマークしました' : '完了を取り消しました');
 
@@ -1539,12 +1910,15 @@ async function savePageSummary() {
     try {
         const response = await handleResponse(await fetch(`${API_BASE}/annotations/${currentImageId}/summary`, {
             method: 'PATCH',
-            headers: getAuthHeaders(),
+            headers: pageWriteHeaders(),
             body: JSON.stringify({ page_summary: summary })
         }));
 
         if (response.ok) {
+            currentPageVersion = pageVersionFromResponse(response) ?? currentPageVersion;
             showToast('ページ説明を保存しました');
+        } else if (response.status === 409) {
+            await checkPageWrite(response, '保存に失敗しました');
         } else {
             showToast('保存に失敗しました', true);
         }